@@ -0,0 +1,194 @@
+"""
+Admission control for cone searches
+
+The cost of a search is estimated as the number of catalog sources it reads:
+for catsHTM, the sources in the HTM trixels that overlap each cone (taken
+from the index), and for extcats, the mean source density of the catalog
+times the area of each cone. Searches estimated to read more than
+settings.expensive_search_cost sources are expensive, the others cheap.
+
+Each class admits a limited number of concurrent searches per process
+(settings.max_expensive_searches and settings.max_cheap_searches). Beyond
+that, searches are rejected at once rather than queued: expensive ones with
+429, asking the client to back off, and cheap ones with 503, as the worker
+is overloaded. Expensive searches thus never hold up cheap ones at
+admission. Without limits, costs are not estimated.
+
+Estimates that may load a catalog index or query Mongo run in the
+threadpool. Single-position searches of catsHTM catalogs whose indexes are
+already loaded, with radii up to MAX_INLINE_RADIUS_ARCSEC, are estimated on
+the event loop instead, as a walk of a few HTM trixels is cheaper than the
+hop to a thread.
+"""
+
+import math
+import threading
+from contextlib import asynccontextmanager
+from functools import lru_cache, singledispatch
+from typing import TYPE_CHECKING, AsyncIterator, Dict, Optional, Sequence, Union
+
+import numpy as np
+from astropy.coordinates import SkyCoord
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+
+from . import metrics
+from .catshtm import get_catshtm, loaded_catshtm
+from .models import CatsHTMQueryItem, ExtcatsQueryItem
+from .mongo import get_catq
+from .settings import settings
+
+if TYPE_CHECKING:
+    from extcats.CatalogQuery import CatalogQuery
+
+
+@lru_cache(maxsize=128)
+def extcats_density(catq: "CatalogQuery") -> float:
+    """
+    Mean number of sources per steradian
+    """
+    return catq.src_coll.estimated_document_count() / (4 * math.pi)
+
+
+@singledispatch
+def search_cost(item, coords: SkyCoord) -> float:
+    """
+    Estimate the number of sources read to search a catalog around each
+    position
+    """
+    raise NotImplementedError
+
+
+@search_cost.register  # type: ignore[no-redef]
+def _(item: CatsHTMQueryItem, coords: SkyCoord) -> float:
+    catalog = get_catshtm(item.name, settings.catshtm_dir)
+    trixels = catalog.trixels(
+        coords.ra.rad, coords.dec.rad, np.radians(item.rs_arcsec / 3600)
+    )
+    return float(sum(catalog.num_sources[ids].sum() for ids in trixels))
+
+
+@search_cost.register  # type: ignore[no-redef]
+def _(item: ExtcatsQueryItem, coords: SkyCoord) -> float:
+    if (catq := get_catq(item.name)) is None:
+        raise ValueError(f"{item.name} is not a valid extcats catalog")
+    # solid angle of the cone
+    area = 2 * math.pi * (1 - math.cos(math.radians(item.rs_arcsec / 3600)))
+    return extcats_density(catq) * area * coords.size
+
+
+def request_cost(
+    items: Sequence[Union[ExtcatsQueryItem, CatsHTMQueryItem]], coords: SkyCoord
+) -> float:
+    return sum(search_cost(item, coords) for item in items)
+
+
+# largest cone whose cost is estimated on the event loop; wider ones overlap
+# too many trixels
+MAX_INLINE_RADIUS_ARCSEC = 3600
+
+
+def estimate_inline(
+    items: Sequence[Union[ExtcatsQueryItem, CatsHTMQueryItem]], coords: SkyCoord
+) -> bool:
+    """
+    Can the cost of a search be estimated on the event loop, quickly and
+    without I/O?
+    """
+    if (catalogs_dir := settings.catshtm_dir) is None or coords.size != 1:
+        return False
+    return all(
+        isinstance(item, CatsHTMQueryItem)
+        and item.rs_arcsec <= MAX_INLINE_RADIUS_ARCSEC
+        and loaded_catshtm(item.name, catalogs_dir) is not None
+        for item in items
+    )
+
+
+class Admission:
+    """
+    Searches in progress per cost class
+    """
+
+    status_codes = {"cheap": 503, "expensive": 429}
+
+    def __init__(self) -> None:
+        self.active: Dict[str, int] = {"cheap": 0, "expensive": 0}
+        # streamed responses may be released by the garbage collector
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def limits() -> Dict[str, int]:
+        return {
+            "cheap": settings.max_cheap_searches,
+            "expensive": settings.max_expensive_searches,
+        }
+
+    def enabled(self) -> bool:
+        return any(limit > 0 for limit in self.limits().values())
+
+    def acquire(self, cost: float) -> str:
+        """
+        Admit a search of the given cost, or raise HTTPException
+
+        :returns: cost class of the search
+        """
+        if cost > settings.expensive_search_cost:
+            cost_class = "expensive"
+        else:
+            cost_class = "cheap"
+        limit = self.limits()[cost_class]
+        with self._lock:
+            if 0 < limit <= self.active[cost_class]:
+                metrics.rejected_searches.inc(cost_class=cost_class)
+                raise HTTPException(
+                    status_code=self.status_codes[cost_class],
+                    detail=(
+                        f"Too many {cost_class} searches in progress "
+                        f"(estimated cost {cost:.0f} sources)"
+                    ),
+                    headers={"Retry-After": "1"},
+                )
+            self.active[cost_class] += 1
+        metrics.admitted_searches.inc(cost_class=cost_class)
+        return cost_class
+
+    def release(self, cost_class: Optional[str]) -> None:
+        if cost_class is None:
+            return
+        with self._lock:
+            self.active[cost_class] -= 1
+        metrics.admitted_searches.dec(cost_class=cost_class)
+
+    async def admit(
+        self,
+        items: Sequence[Union[ExtcatsQueryItem, CatsHTMQueryItem]],
+        coords: SkyCoord,
+    ) -> Optional[str]:
+        """
+        Estimate the cost of a search, and admit it
+
+        :returns: cost class of the search, or None if admission control is
+            disabled
+        """
+        if not self.enabled():
+            return None
+        if estimate_inline(items, coords):
+            return self.acquire(request_cost(items, coords))
+        # catalog indexes may have to be loaded
+        return self.acquire(await run_in_threadpool(request_cost, items, coords))
+
+    @asynccontextmanager
+    async def admitted(
+        self,
+        items: Sequence[Union[ExtcatsQueryItem, CatsHTMQueryItem]],
+        coords: SkyCoord,
+    ) -> AsyncIterator[None]:
+        cost_class = await self.admit(items, coords)
+        try:
+            yield
+        finally:
+            self.release(cost_class)
+
+
+admission = Admission()
@@ -1,162 +1,258 @@
 import io
 import logging
+import os
 import re
-from functools import lru_cache
-from typing import Any, Dict, List
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Tuple
 
-from fastapi import APIRouter, Depends
-from pymongo import MongoClient
+import orjson
+from fastapi import APIRouter, HTTPException
+from pymongo.collection import Collection
 from pymongo.errors import OperationFailure
 
-from .models import CatalogDescription
-from .mongo import get_catq, get_mongo
+from .models import CatalogDescription, NameLookupRequest
+from .mongo import get_mongo, has_name_index
+from .registry import registry
 from .settings import settings
 
+if TYPE_CHECKING:
+    from extcats.CatalogQuery import CatalogQuery
+
 log = logging.getLogger(__name__)
 
 
-def catshtm_catalog_descriptions():
+CATSHTM_README = """
+2MASS (input name: TMASS)
+2MASSxsc (input name: TMASSxsc) - 2MASS extended source catalog
+AKARI (input name: AKARI)
+APASS (input name: APASS) - AAVSO All Sky Photometric Sky Survey (~5.5x10^7 sources)
+Cosmos (input name: Cosmos) - Sources in the Cosmos field
+DECaLS (input name: DECaLS) - DECaLS DR5 release
+FIRST (input name: FIRST) - (~9.5x10^5 sources)
+GAIA/DR1 (input name: GAIADR1) - (~1.1x10^9 sources).
+GAIA/DR2 (input name: GAIADR2) - NEW! (~1.6x10^9 sources)
+GALEX (input name: GALEX) - GALAEX/GR6Plus7 (~1.7x10^8 sources).
+HSC/v2 (input name: HSCv2)- Hubble source catalog
+IPHAS/DR2 (input name: IPHAS)
+NED redshifts (input name: NEDz)
+NVSS (input name: NVSS) - (~1.8x10^6 sources)
+PS1 (input name: PS1) - Pan-STARRS (~2.6x10^9 sources; A cleaned version of the PS1 stack catalog; some missing tiles below declination of zero [being corrected])
+PTFpc (input name: PTFpc) - PTF photometric catalog
+ROSATfsc (input name: ROSATfsc) - ROSAT faint source catalog
+SDSS/DR10 (input name: SDSSDR10)- Primary sources from SDSS/DR10 (last photometric release)
+Skymapper - will be added soon.
+SpecSDSS/DR14 (input name: SpecSDSS) - SDSS spectroscopic catalog
+Spitzer/SAGE (input name SAGE)
+Spitzer/IRAC (input name IRACgc) - Spitzer IRAC galactic center survey
+UCAC4 (input name: UCAC4) - (~1.1x10^8 sources)
+UKIDSS/DR10 (input name: UKIDSS)
+USNOB1 (not yet available)
+VISTA/Viking/DR3 (not yet available)
+VST/ATLAS/DR3 (input name: VSTatlas)
+VST/KiDS/DR3 (input name: VSTkids)
+WISE (input name: WISE) - ~5.6x10^8 sources
+XMM (input name: XMM)- 7.3x10^5 sources 3XMM-DR7 (Rosen et al. 2016; A&A 26, 590)
+"""
+
+
+def catshtm_readme_entries() -> List[Tuple[str, str]]:
     """
-    Parse metadata from catsHTM README and MATLAB files
+    Parse names and descriptions of catsHTM catalogs from the catsHTM README
     """
-    from catsHTM import params
-    from catsHTM.script import get_CatDir
-    from scipy.io import loadmat
-
-    catalogs = []
-    if settings.catshtm_dir is None:
-        return catalogs
-
-    for line in io.StringIO(
-        """
-        2MASS (input name: TMASS)
-        2MASSxsc (input name: TMASSxsc) - 2MASS extended source catalog
-        AKARI (input name: AKARI)
-        APASS (input name: APASS) - AAVSO All Sky Photometric Sky Survey (~5.5x10^7 sources)
-        Cosmos (input name: Cosmos) - Sources in the Cosmos field
-        DECaLS (input name: DECaLS) - DECaLS DR5 release
-        FIRST (input name: FIRST) - (~9.5x10^5 sources)
-        GAIA/DR1 (input name: GAIADR1) - (~1.1x10^9 sources).
-        GAIA/DR2 (input name: GAIADR2) - NEW! (~1.6x10^9 sources)
-        GALEX (input name: GALEX) - GALAEX/GR6Plus7 (~1.7x10^8 sources).
-        HSC/v2 (input name: HSCv2)- Hubble source catalog
-        IPHAS/DR2 (input name: IPHAS)
-        NED redshifts (input name: NEDz)
-        NVSS (input name: NVSS) - (~1.8x10^6 sources)
-        PS1 (input name: PS1) - Pan-STARRS (~2.6x10^9 sources; A cleaned version of the PS1 stack catalog; some missing tiles below declination of zero [being corrected])
-        PTFpc (input name: PTFpc) - PTF photometric catalog
-        ROSATfsc (input name: ROSATfsc) - ROSAT faint source catalog
-        SDSS/DR10 (input name: SDSSDR10)- Primary sources from SDSS/DR10 (last photometric release)
-        Skymapper - will be added soon.
-        SpecSDSS/DR14 (input name: SpecSDSS) - SDSS spectroscopic catalog
-        Spitzer/SAGE (input name SAGE)
-        Spitzer/IRAC (input name IRACgc) - Spitzer IRAC galactic center survey
-        UCAC4 (input name: UCAC4) - (~1.1x10^8 sources)
-        UKIDSS/DR10 (input name: UKIDSS)
-        USNOB1 (not yet available)
-        VISTA/Viking/DR3 (not yet available)
-        VST/ATLAS/DR3 (input name: VSTatlas)
-        VST/KiDS/DR3 (input name: VSTkids)
-        WISE (input name: WISE) - ~5.6x10^8 sources
-        XMM (input name: XMM)- 7.3x10^5 sources 3XMM-DR7 (Rosen et al. 2016; A&A 26, 590)
-        """.strip()
-    ).readlines():
+    entries = []
+    for line in io.StringIO(CATSHTM_README.strip()).readlines():
         match = re.match(
             r"(?P<name>[\w/]+) \(input name: (?P<key>\w+)\)(\s*-\s*(?P<description>.*))?",
             line.strip(),
         )
         if match:
-            name = match.group("key")
-            try:
-                meta = loadmat(
-                    str(
-                        settings.catshtm_dir
-                        / get_CatDir(name)
-                        / (params.ColCelFile % name)
-                    )
-                )
-            except FileNotFoundError:
-                continue
-            catalogs.append(
-                {
-                    "name": name,
-                    "use": "catsHTM",
-                    "description": " -- ".join(
+            entries.append(
+                (
+                    match.group("key"),
+                    " -- ".join(
                         [
                             s
                             for s in (match.group("name"), match.group("description"))
                             if s
                         ]
                     ),
-                    "reference": "https://doi.org/10.1088/1538-3873/aac410",
-                    "contact": "Eran Ofek <eran.ofek@weizmann.ac.il>",
-                    "columns": [
-                        {"name": str(k[0]), "unit": str(u[0]) if len(u) else None}
-                        for k, u in zip(
-                            meta["ColCell"].flatten(), meta["ColUnits"].flatten()
-                        )
-                    ],
-                }
-            )
-    return catalogs
-
-
-def extcats_catalog_descriptions() -> List[Dict[str,Any]]:
-    catalogs = []
-    mongo = get_mongo()
-    for db in mongo.list_database_names():
-        if db in {"local", "config", "admin"}:
-            continue
-        # only return catalogs for which a CatalogQuery can be instantiated
-        if (catq := get_catq(db)) is None:
-            continue
-        try:
-            meta: Dict[str, Any] = next(
-                mongo[db].get_collection("meta").find({"_id": "science"}, {"_id": 0}),
-                {},
+                )
             )
-        except OperationFailure:
-            # unauthorized
-            meta = {}
-        # use first entry as an example, minus index fields
-        projection = {"_id": 0, **{k: 0 for k in [catq.hp_key, catq.s2d_key] if k is not None}}
-        src: Dict[str, Any] = next(catq.src_coll.find({}, projection), {})
-        catalogs.append(
-            {
-                "name": db,
-                "use": "extcats",
-                "columns": [{"name": k, "unit": None} for k in src.keys()],
-                "description": meta.get("description"),
-                "reference": meta.get("ref"),
-                "contact": f"{meta['contact']} <{meta.get('email')}>" if 'contact' in meta else None
-            }
+    return entries
+
+
+def describe_catshtm(name: str, description: str, colcell: Path) -> Dict[str, Any]:
+    """
+    Parse metadata from a catsHTM MATLAB file
+    """
+    from scipy.io import loadmat
+
+    meta = loadmat(str(colcell))
+    return {
+        "name": name,
+        "use": "catsHTM",
+        "description": description,
+        "reference": "https://doi.org/10.1088/1538-3873/aac410",
+        "contact": "Eran Ofek <eran.ofek@weizmann.ac.il>",
+        "columns": [
+            {"name": str(k[0]), "unit": str(u[0]) if len(u) else None}
+            for k, u in zip(meta["ColCell"].flatten(), meta["ColUnits"].flatten())
+        ],
+    }
+
+
+def describe_extcats(name: str, catq: "CatalogQuery") -> Dict[str, Any]:
+    try:
+        meta: Dict[str, Any] = next(
+            catq.cat_db.get_collection("meta").find({"_id": "science"}, {"_id": 0}),
+            {},
+        )
+    except OperationFailure:
+        # unauthorized
+        meta = {}
+    # use first entry as an example, minus index fields
+    projection = {"_id": 0, **{k: 0 for k in [catq.hp_key, catq.s2d_key] if k is not None}}
+    src: Dict[str, Any] = next(catq.src_coll.find({}, projection), {})
+    return {
+        "name": name,
+        "use": "extcats",
+        "columns": [{"name": k, "unit": None} for k in src.keys()],
+        "description": meta.get("description"),
+        "reference": meta.get("ref"),
+        "contact": f"{meta['contact']} <{meta.get('email')}>" if 'contact' in meta else None
+    }
+
+
+def build_catalog_descriptions() -> List[Dict[str, Any]]:
+    """
+    Describe all catalogs in the registry, in parallel. Catalogs that can not
+    be described are omitted.
+    """
+    from catsHTM import params
+
+    registry.ensure()
+    # only return catalogs for which a CatalogQuery can be instantiated
+    tasks: List[Tuple[Callable[..., Dict[str, Any]], tuple]] = [
+        (describe_extcats, (name, catq)) for name, catq in registry.extcats.items()
+    ]
+    tasks += [
+        (
+            describe_catshtm,
+            (name, description, path.parent / (params.ColCelFile % name)),
         )
-    return catalogs
+        for name, description in catshtm_readme_entries()
+        if (path := registry.catshtm.get(name)) is not None
+    ]
 
+    def describe(task):
+        func, args = task
+        try:
+            return func(*args)
+        except Exception:
+            log.exception(f"Failed to describe catalog {args[0]}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=settings.max_parallelism) as executor:
+        return [d for d in executor.map(describe, tasks) if d is not None]
+
+
+class CatalogDescriptions:
+    """
+    Catalog descriptions, rebuilt on refresh() and optionally persisted to
+    settings.catalog_snapshot_path, so that a fresh worker can serve the
+    last known listing while the current one is being built
+    """
+
+    def __init__(self) -> None:
+        self.descriptions: Optional[List[Dict[str, Any]]] = None
+        self._lock = threading.Lock()
+
+    def load_snapshot(self) -> bool:
+        if (path := settings.catalog_snapshot_path) is None or not path.exists():
+            return False
+        try:
+            descriptions = orjson.loads(path.read_bytes())
+        except Exception:
+            log.exception(f"Failed to read catalog snapshot {path}")
+            return False
+        with self._lock:
+            if self.descriptions is None:
+                self.descriptions = descriptions
+        return True
+
+    def save_snapshot(self, descriptions: List[Dict[str, Any]]) -> None:
+        if (path := settings.catalog_snapshot_path) is None:
+            return
+        try:
+            # replace atomically, as other workers may be reading
+            tmp = path.with_name(f".{path.name}.{os.getpid()}")
+            tmp.write_bytes(orjson.dumps(descriptions))
+            os.replace(tmp, path)
+        except OSError:
+            log.exception(f"Failed to write catalog snapshot {path}")
+
+    def refresh(self) -> List[Dict[str, Any]]:
+        descriptions = build_catalog_descriptions()
+        with self._lock:
+            self.descriptions = descriptions
+        self.save_snapshot(descriptions)
+        return descriptions
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self.descriptions = None
 
-@lru_cache(maxsize=1)
-def catalog_descriptions():
-    return extcats_catalog_descriptions() + catshtm_catalog_descriptions() 
+    def get(self) -> List[Dict[str, Any]]:
+        if (descriptions := self.descriptions) is None:
+            descriptions = self.refresh()
+        return descriptions
+
+
+catalog_descriptions = CatalogDescriptions()
 
 
 router = APIRouter()
 
 
 @router.get("/", response_model=List[CatalogDescription])
-def list_catalogs() -> List[CatalogDescription]:
+def list_catalogs() -> List[Dict[str, Any]]:
     """
     Get set of usable catalogs
     """
-    return catalog_descriptions()
+    return catalog_descriptions.get()
 
 
-@router.get("/{catalog}/{name}")
-def lookup(catalog: str, name: str, mongo = Depends(get_mongo)):
-    collection = mongo.get_database(catalog).get_collection("srcs")
+# names per query in batch lookups, to stay well below the BSON size limit
+NAME_CHUNK_SIZE = 10000
+
+
+def name_collection(catalog: str) -> Collection:
     # ensure search will be indexed
-    try:
-        if not any("name" in dict(idx["key"]) for idx in collection.index_information().values()):
-            raise HTTPException(status_code=404)
-    except OperationalError:
+    if not has_name_index(catalog):
         raise HTTPException(status_code=404)
-    return collection.find_one({"name": name}, {"_id": 0, "pos": 0})
+    return get_mongo().get_database(catalog).get_collection("srcs")
+
+
+@router.post("/{catalog}", response_model=List[Optional[Dict[str, Any]]])
+def lookup_batch(catalog: str, request: NameLookupRequest):
+    """
+    Look up sources by name. Results are in the order of the requested names,
+    with null for names that were not found.
+    """
+    collection = name_collection(catalog)
+    names = list(dict.fromkeys(request.names))
+    found: Dict[str, Dict[str, Any]] = {}
+    for i in range(0, len(names), NAME_CHUNK_SIZE):
+        for doc in collection.find(
+            {"name": {"$in": names[i : i + NAME_CHUNK_SIZE]}}, {"_id": 0, "pos": 0}
+        ):
+            # keep the first match, like find_one()
+            found.setdefault(doc["name"], doc)
+    return [found.get(name) for name in request.names]
+
+
+@router.get("/{catalog}/{name}")
+def lookup(catalog: str, name: str):
+    return name_collection(catalog).find_one({"name": name}, {"_id": 0, "pos": 0})
@@ -0,0 +1,316 @@
+import logging
+import math
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import groupby
+from pathlib import Path
+from typing import (
+    TYPE_CHECKING,
+    Dict,
+    Hashable,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+from weakref import WeakValueDictionary
+
+import numpy as np
+
+from . import metrics
+from .columnar import ColumnarTiles, sidecar_path
+from .metrics import stage
+from .settings import settings
+from .spherical import within
+
+if TYPE_CHECKING:
+    import h5py
+
+log = logging.getLogger(__name__)
+
+
+def unit_vectors(lon: np.ndarray, lat: np.ndarray) -> np.ndarray:
+    """
+    Convert spherical coordinates (radians) to unit vectors of shape (..., 3)
+    """
+    cos_lat = np.cos(lat)
+    return np.stack(
+        [cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)], axis=-1
+    )
+
+
+class TrixelCache:
+    """
+    Thread-safe LRU cache of decoded trixel arrays, bounded by the total
+    size of the cached arrays
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[Hashable, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[np.ndarray]:
+        with self._lock:
+            if (value := self._entries.get(key)) is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value: np.ndarray) -> None:
+        if value.nbytes > self.max_bytes:
+            return
+        # entries are shared between requests
+        value.setflags(write=False)
+        with self._lock:
+            if (old := self._entries.pop(key, None)) is not None:
+                self.nbytes -= old.nbytes
+            self._entries[key] = value
+            self.nbytes += value.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                self.evictions += 1
+
+    def discard(self, catalog: str) -> None:
+        """
+        Drop the entries of a catalog, i.e. those keyed by (catalog, ...)
+        """
+        with self._lock:
+            for key in [
+                key
+                for key in self._entries
+                if isinstance(key, tuple) and key[0] == catalog
+            ]:
+                self.nbytes -= self._entries.pop(key).nbytes
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+        }
+
+
+trixel_cache = TrixelCache(settings.catshtm_cache_bytes)
+metrics.register_cache("trixel", lambda: trixel_cache)
+
+
+class CatsHTMCatalog:
+    """
+    In-process cone search over a catsHTM catalog, operating on many positions
+    at once.
+
+    The HTM index is read once and traversed for all positions in lockstep,
+    each HDF5 file is opened at most once per search, and the angular
+    distance cut is applied to all candidate sources in a single array
+    operation.
+    """
+
+    def __init__(self, name: str, catalogs_dir: Path):
+        # catsHTM imports scipy.io, and h5py is slow to import; load them on
+        # first use rather than at startup
+        import h5py
+        from catsHTM import params
+        from catsHTM.script import get_CatDir, load_colcell
+
+        self.name = name
+        self.path = Path(catalogs_dir) / get_CatDir(name)
+        colnames, colunits = load_colcell(str(self.path), name)
+        self.colnames: List[str] = [str(c) for c in colnames]
+        index_path = self.path / (params.IndexFileTemplate % name)
+        # catalogs are replaced rather than modified in place
+        self.version = str(index_path.stat().st_mtime_ns)
+        with h5py.File(index_path, "r") as f:
+            # rows: level, father, 4 sons (1-based), 3 poles (lon, lat), Nsrc
+            index = np.asarray(f[f"{name}_HTM"])
+        sons = index[2:6].T
+        self.is_leaf = np.isnan(sons).all(axis=1)
+        self.sons = np.where(np.isnan(sons), 0, sons - 1).astype(np.int64)
+        # each trixel is the intersection of 3 hemispheres, given by their poles
+        self.poles = unit_vectors(index[6:12:2].T, index[7:12:2].T)
+        self.num_sources = np.nan_to_num(index[12])
+        # prefer the memory-mapped sidecar if present and up to date
+        self.columnar: Optional[ColumnarTiles] = None
+        if ColumnarTiles.exists(path := sidecar_path(self.path, name)):
+            if ColumnarTiles.source_version(path) == self.version:
+                self.columnar = ColumnarTiles(path)
+            else:
+                log.warning(
+                    f"Ignoring columnar sidecar of {name}, which was converted "
+                    "from a previous version of the catalog"
+                )
+
+    def trixels(
+        self, ra: np.ndarray, dec: np.ndarray, radius: np.ndarray
+    ) -> List[np.ndarray]:
+        """
+        Find the non-empty leaf trixels that intersect each cone (radians)
+        """
+        ra, dec, radius = np.broadcast_arrays(
+            np.atleast_1d(ra), np.atleast_1d(dec), np.atleast_1d(radius)
+        )
+        if not len(ra):
+            return []
+        targets = unit_vectors(ra, dec)
+        # a cone intersects a hemisphere if its center is less than 90 deg
+        # plus its radius away from the pole (and always, beyond 180 deg)
+        threshold = np.cos(np.minimum(0.5 * math.pi + radius, math.pi))
+        # descend the tree breadth-first for all positions at once, starting
+        # with the 8 root trixels
+        pos = np.repeat(np.arange(len(ra)), 8)
+        node = np.tile(np.arange(8), len(ra))
+        leaves = []
+        while len(node):
+            hit = (
+                np.einsum("ijk,ik->ij", self.poles[node], targets[pos])
+                >= threshold[pos, None]
+            ).all(axis=1)
+            pos, node = pos[hit], node[hit]
+            leaf = self.is_leaf[node]
+            leaves.append((pos[leaf], node[leaf]))
+            pos = np.repeat(pos[~leaf], 4)
+            node = self.sons[node[~leaf]].ravel()
+        pos = np.concatenate([p for p, _ in leaves])
+        node = np.concatenate([n for _, n in leaves])
+        keep = self.num_sources[node] > 0
+        pos, node = pos[keep], node[keep]
+        order = np.lexsort((node, pos))
+        pos, node = pos[order], node[order]
+        return np.split(node, np.searchsorted(pos, np.arange(1, len(ra))))
+
+    def iter_datasets(self, ids: Iterable[int]) -> Iterator[Tuple[int, "h5py.Dataset"]]:
+        """
+        Iterate over the HDF5 datasets of the given trixels in id order,
+        opening each file only once
+        """
+        import h5py
+        from catsHTM import params
+
+        # NB: trixel ids are 1-based in file and dataset names
+        file_id = lambda id: int((id + 1) // params.NcatinFile * params.NcatinFile)
+        for fid, group in groupby(sorted(ids), key=file_id):
+            # as in catsHTM, a missing file means that the trixels are empty
+            if not (path := self.path / (params.CatFileTemplate % (self.name, fid))).exists():
+                continue
+            with h5py.File(path, "r") as f:
+                for id in group:
+                    if (dataset := params.htmTemplate % (id + 1)) in f:
+                        yield id, f[dataset]
+
+    def read_trixels(self, ids: Iterable[int]) -> Dict[int, np.ndarray]:
+        """
+        Read the sources in the given trixels, from the trixel cache if
+        possible. Entries are keyed by catalog version, so that tiles of a
+        catalog replaced on disk are never served.
+        """
+        tiles: Dict[int, np.ndarray] = {}
+        missing = []
+        for id in ids:
+            if (tile := trixel_cache.get((self.name, self.version, id))) is None:
+                missing.append(id)
+            else:
+                tiles[id] = tile
+        for id, dataset in self.iter_datasets(missing):
+            tiles[id] = np.ascontiguousarray(np.asarray(dataset).T)
+            trixel_cache.put((self.name, self.version, id), tiles[id])
+        return tiles
+
+    def cone_search(
+        self,
+        ra: Union[float, np.ndarray],
+        dec: Union[float, np.ndarray],
+        radius: Union[float, np.ndarray],
+    ) -> List[np.ndarray]:
+        """
+        Find sources within radius of each position (all in radians)
+
+        :returns: an array of sources (rows) for each position
+        """
+        ra, dec, radius = np.broadcast_arrays(
+            np.atleast_1d(ra), np.atleast_1d(dec), np.atleast_1d(radius)
+        )
+        if not len(ra):
+            return []
+        with stage("htm_lookup"):
+            trixels = self.trixels(ra, dec, radius)
+        # (position, trixel) pairs, sorted by position
+        pair_pos = np.repeat(np.arange(len(ra)), [len(t) for t in trixels])
+        uniq, pair_tile = np.unique(
+            np.concatenate(trixels).astype(np.int64), return_inverse=True
+        )
+        # columns of all candidate sources, and the range of each trixel
+        columns: np.ndarray
+        if self.columnar is not None:
+            with stage("columnar_read"):
+                columns = self.columnar.columns
+                starts, sizes = self.columnar.locate(uniq)
+        else:
+            with stage("hdf5_read"):
+                tiles = self.read_trixels(uniq.tolist())
+            empty = np.empty((0, len(self.colnames)))
+            columns = np.concatenate(
+                [empty] + [tiles.get(id, empty) for id in uniq]
+            ).T
+            sizes = np.array([len(tiles.get(id, empty)) for id in uniq], dtype=np.int64)
+            starts = np.cumsum(sizes) - sizes
+        # expand pairs into (position, source row) pairs
+        pair_sizes = sizes[pair_tile]
+        row_pos = np.repeat(pair_pos, pair_sizes)
+        row_idx = np.repeat(
+            starts[pair_tile] - (np.cumsum(pair_sizes) - pair_sizes), pair_sizes
+        ) + np.arange(pair_sizes.sum())
+        with stage("distance"):
+            keep, _ = within(
+                columns[0][row_idx],
+                columns[1][row_idx],
+                ra[row_pos],
+                dec[row_pos],
+                radius[row_pos],
+            )
+        row_pos, row_idx = row_pos[keep], row_idx[keep]
+        return [
+            columns[:, idx].T
+            for idx in np.split(row_idx, np.searchsorted(row_pos, np.arange(1, len(ra))))
+        ]
+
+
+# catalogs opened by get_catshtm() and still in use
+opened_catalogs: "WeakValueDictionary[Tuple[str, Path], CatsHTMCatalog]" = (
+    WeakValueDictionary()
+)
+
+
+@lru_cache(maxsize=128)
+def get_catshtm(name: str, catalogs_dir: Path) -> CatsHTMCatalog:
+    catalog = CatsHTMCatalog(name, catalogs_dir)
+    opened_catalogs[(name, Path(catalogs_dir))] = catalog
+    return catalog
+
+
+def loaded_catshtm(name: str, catalogs_dir: Path) -> Optional[CatsHTMCatalog]:
+    """
+    Return a catalog if it has already been opened, without touching the
+    filesystem
+    """
+    return opened_catalogs.get((name, Path(catalogs_dir)))
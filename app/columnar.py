@@ -0,0 +1,127 @@
+"""
+Memory-mapped columnar layout for catsHTM catalogs
+
+The sidecar lives next to the HDF5 files, in ``<CatDir>/<CatName>_columnar``,
+and consists of three NumPy arrays and a header:
+
+- ``trixels.npy``: sorted ids of the non-empty trixels
+- ``offsets.npy``: start of each trixel's sources in ``columns.npy``, plus
+  the total number of sources
+- ``columns.npy``: all sources, one contiguous array per column
+- ``version``: version (HTM index mtime) of the catalog it was converted
+  from. A sidecar left behind by a catalog that has since been replaced is
+  ignored, and the catalog read from HDF5 until it is converted again.
+
+Convert a catalog with ``python -m app.columnar CATALOGS_DIR NAME [NAME ...]``.
+"""
+
+import argparse
+import shutil
+from pathlib import Path
+from typing import TYPE_CHECKING, Optional, Tuple
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from .catshtm import CatsHTMCatalog
+
+
+def sidecar_path(catalog_path: Path, name: str) -> Path:
+    return catalog_path / f"{name}_columnar"
+
+
+class ColumnarTiles:
+    """
+    Read-only view of a columnar sidecar. Columns are memory-mapped, so
+    processes share the OS page cache, and trixels are zero-copy slices.
+    """
+
+    def __init__(self, path: Path):
+        self.trixels = np.load(path / "trixels.npy")
+        self.offsets = np.load(path / "offsets.npy")
+        self.columns = np.load(path / "columns.npy", mmap_mode="r")
+
+    @classmethod
+    def exists(cls, path: Path) -> bool:
+        return all(
+            (path / f).exists() for f in ("trixels.npy", "offsets.npy", "columns.npy")
+        )
+
+    @staticmethod
+    def source_version(path: Path) -> Optional[str]:
+        """
+        Version of the catalog the sidecar was converted from
+        """
+        try:
+            return (path / "version").read_text().strip()
+        except FileNotFoundError:
+            return None
+
+    def locate(self, ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the start and number of sources of each trixel in ``columns``
+        """
+        if not len(self.trixels):
+            return np.zeros(len(ids), dtype=np.int64), np.zeros(len(ids), dtype=np.int64)
+        idx = np.minimum(np.searchsorted(self.trixels, ids), len(self.trixels) - 1)
+        valid = self.trixels[idx] == ids
+        starts = np.where(valid, self.offsets[idx], 0)
+        sizes = np.where(valid, self.offsets[idx + 1] - self.offsets[idx], 0)
+        return starts, sizes
+
+
+def write_columnar(catalog: "CatsHTMCatalog") -> Path:
+    """
+    Convert a catsHTM catalog to the columnar layout, one tile at a time
+    """
+    ids = np.flatnonzero(catalog.is_leaf & (catalog.num_sources > 0))
+    # first pass: sizes and types from HDF5 metadata only
+    shapes = [
+        (id, dataset.shape, dataset.dtype) for id, dataset in catalog.iter_datasets(ids)
+    ]
+    trixels = np.array([id for id, _, _ in shapes], dtype=np.int64)
+    offsets = np.concatenate(
+        [[0], np.cumsum([shape[1] for _, shape, _ in shapes])]
+    ).astype(np.int64)
+    dtype = np.result_type(*(dtype for _, _, dtype in shapes)) if shapes else np.float64
+
+    dest = sidecar_path(catalog.path, catalog.name)
+    # write to a temporary directory, so that readers never see a partial sidecar
+    tmp = dest.with_name(dest.name + ".tmp")
+    if tmp.exists():
+        shutil.rmtree(tmp)
+    tmp.mkdir()
+    np.save(tmp / "trixels.npy", trixels)
+    np.save(tmp / "offsets.npy", offsets)
+    columns = np.lib.format.open_memmap(
+        tmp / "columns.npy",
+        mode="w+",
+        dtype=dtype,
+        shape=(len(catalog.colnames), int(offsets[-1])),
+    )
+    for (id, dataset), start, stop in zip(
+        catalog.iter_datasets(trixels), offsets[:-1], offsets[1:]
+    ):
+        columns[:, start:stop] = dataset[()]
+    columns.flush()
+    del columns
+    (tmp / "version").write_text(catalog.version)
+    if dest.exists():
+        shutil.rmtree(dest)
+    tmp.rename(dest)
+    return dest
+
+
+def main() -> None:
+    from .catshtm import CatsHTMCatalog
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("catalogs_dir", type=Path, help="catsHTM catalog directory")
+    parser.add_argument("names", nargs="+", help="catalogs to convert, e.g. PS1")
+    args = parser.parse_args()
+    for name in args.names:
+        print(write_columnar(CatsHTMCatalog(name, args.catalogs_dir)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,54 @@
+import asyncio
 import math
-from functools import singledispatch
-from typing import Any, Dict, List, Optional, Set, Tuple, TYPE_CHECKING
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, singledispatch
+from itertools import islice
+from operator import itemgetter
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    TYPE_CHECKING,
+    Union,
+)
 
 import numpy as np
+import orjson
+import pymongo
 from astropy.coordinates import SkyCoord
-from astropy.table import Table
-from catsHTM import cone_search
-from extcats.catquery_utils import get_closest, get_distances
-from fastapi import APIRouter
+from astropy.table import Column, Table, vstack
+from fastapi import APIRouter, Header, HTTPException, Query
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from pydantic import ValidationError
+from pymongo.errors import PyMongoError
+from starlette.concurrency import run_in_threadpool
 
+from . import formats, metrics, spherical
+from .admission import admission
+from .metrics import stage
+from .catshtm import get_catshtm
 from .models import (
+    BatchConeSearchRequest,
     CatalogItem,
     CatsHTMQueryItem,
     ConeSearchRequest,
     ExtcatsQueryItem,
 )
-from .mongo import CatalogQuery, get_catq
+from .mongo import find_within_batch, get_catq, iter_within
+from .result_cache import cached_search
 from .settings import settings
 
 if TYPE_CHECKING:
     from astropy.table.row import Row
+    from extcats.CatalogQuery import CatalogQuery
 
 
 def sanitize_json(obj):
@@ -30,6 +58,8 @@ def sanitize_json(obj):
         return [sanitize_json(v) for v in obj]
     elif isinstance(obj, float) and math.isnan(obj):
         return None
+    elif isinstance(obj, bytes):
+        return obj.decode(errors="replace")
     elif hasattr(obj, "tolist"):
         # general conversion from numpy to python types
         return obj.tolist()
@@ -37,6 +67,41 @@ def sanitize_json(obj):
         return obj
 
 
+def column_to_json(column: Any) -> List[Any]:
+    """
+    Convert a table column to a list of JSON-compatible values
+    """
+    values = np.ma.getdata(column)
+    if values.dtype.kind == "f" and values.ndim == 1:
+        converted = np.where(np.isnan(values), None, values)
+    elif values.dtype.kind in "iubU" and values.ndim == 1:
+        converted = values
+    elif values.dtype.kind == "S" and values.ndim == 1:
+        # byte strings, e.g. from HDF5 or FITS
+        converted = np.char.decode(values, errors="replace")
+    else:
+        # nested or object values
+        converted = np.empty(len(values), dtype=object)
+        converted[:] = [sanitize_json(v) for v in values.tolist()]
+    if (mask := np.ma.getmask(column)) is not np.ma.nomask and mask.ndim == 1:
+        converted = np.where(mask, None, converted)
+    return converted.tolist()
+
+
+def columns_to_json(
+    keys: List[str], columns: Sequence[Any], num_rows: int
+) -> List[Dict[str, Any]]:
+    """
+    Convert parallel columns to a list of JSON-compatible rows
+    """
+    if not keys:
+        return [{} for _ in range(num_rows)]
+    with stage("json"):
+        return [
+            dict(zip(keys, row)) for row in zip(*(column_to_json(c) for c in columns))
+        ]
+
+
 def table_to_json(
     table: Optional["Table"],
     allow_keys: Optional[Set[str]],
@@ -44,25 +109,12 @@ def table_to_json(
 ) -> Optional[List[Dict[str, Any]]]:
     if table is None:
         return None
-    keys = table.keys()
-    rows = [
-        {
-            k: sanitize_json(v)
-            for k, v in zip(keys, row)
-            if (allow_keys is None or k in allow_keys)
-        }
-        for row in table.iterrows()
-    ]
-    for row in rows:
-        assert not any(type(c) == np.int64 for c in row.values())
-    return [
-        {
-            k: sanitize_json(v)
-            for k, v in zip(keys, np.asarray(row).tolist())
-            if (allow_keys is None or k in allow_keys) and (k not in disallow_keys)
-        }
-        for row in table.iterrows()
+    keys = [
+        k
+        for k in table.keys()
+        if (allow_keys is None or k in allow_keys) and (k not in disallow_keys)
     ]
+    return columns_to_json(keys, [table[k] for k in keys], len(table))
 
 
 def row_to_json(
@@ -80,6 +132,92 @@ def row_to_json(
     }
 
 
+# a CatalogItem, as it appears in the response body. Results are serialized
+# directly rather than through CatalogItem, which would validate every row
+Match = Dict[str, Any]
+
+
+def match(body: Optional[Dict[str, Any]], dist_arcsec: float) -> Match:
+    return {"body": body, "dist_arcsec": float(dist_arcsec)}
+
+
+def with_distances(table: Table, keys: List[str], dists: np.ndarray) -> Table:
+    """
+    Select columns of a table of matches, and append their distances
+    """
+    with stage("table"):
+        return Table(
+            [
+                *(table[k] for k in keys),
+                Column(dists, name="dist_arcsec", unit="arcsec"),
+            ],
+            copy=False,
+        )
+
+
+def table_matches(table: Optional[Table]) -> Optional[List[Match]]:
+    if table is None or not len(table):
+        return None
+    rows = table_to_json(table, None, {"dist_arcsec"})
+    return [match(row, dist) for row, dist in zip(rows, table["dist_arcsec"])]
+
+
+def stack_positions(tables: List[Optional[Table]]) -> Optional[Table]:
+    """
+    Combine the matches for many positions into a single table, with the
+    index of the position in a leading column
+    """
+    tables = [
+        Table(
+            [Column(np.full(len(t), i), name="position"), *t.itercols()], copy=False
+        )
+        for i, t in enumerate(tables)
+        if t is not None
+    ]
+    if not tables:
+        return None
+    with stage("table"):
+        return vstack(tables, join_type="outer", metadata_conflicts="silent")
+
+
+# sources converted at a time when streaming
+STREAM_CHUNK_SIZE = 1000
+
+
+class NDJSONResponse(StreamingResponse):
+    media_type = "application/x-ndjson"
+
+    def __init__(
+        self, content: Any, on_close: Optional[Callable[[], None]] = None, **kwargs: Any
+    ):
+        super().__init__(content, **kwargs)
+        # called exactly once: when the response has been sent, when sending
+        # it failed (e.g. the client disconnected), or when it is discarded
+        # without being sent
+        self.on_close = None if on_close is None else weakref.finalize(self, on_close)
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            # as in StreamingResponse, but with explicit tasks, since
+            # asyncio.wait() no longer accepts bare coroutines
+            tasks = [
+                asyncio.ensure_future(self.stream_response(send)),
+                asyncio.ensure_future(self.listen_for_disconnect(receive)),
+            ]
+            done, pending = await asyncio.wait(
+                tasks, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in pending:
+                task.cancel()
+            for task in done:
+                task.result()
+        finally:
+            if self.on_close is not None:
+                self.on_close()
+        if self.background is not None:
+            await self.background()
+
+
 @singledispatch
 def search_any_item(item, coord: SkyCoord) -> bool:
     raise NotImplementedError
@@ -87,84 +225,235 @@ def search_any_item(item, coord: SkyCoord) -> bool:
 
 
 @singledispatch
-def search_nearest_item(item, coord: SkyCoord) -> Optional[CatalogItem]:
+def search_nearest_item(item, coord: SkyCoord) -> Optional[Match]:
     raise NotImplementedError
     return False
 
 
 @singledispatch
-def search_all_item(item, coord: SkyCoord) -> Optional[List[CatalogItem]]:
+def search_all_item(item, coord: SkyCoord) -> Optional[List[Match]]:
     raise NotImplementedError
     return None
 
 
-@search_any_item.register  # type: ignore[no-redef]
-def _(item: CatsHTMQueryItem, coord: SkyCoord) -> bool:
-    srcs, colnames, colunits = cone_search(
-        item.name,
-        coord.ra.rad,
-        coord.dec.rad,
-        item.rs_arcsec,
-        catalogs_dir=str(settings.catshtm_dir),
-    )
-    return len(srcs) > 0
+@singledispatch
+def iter_all_item(item, coord: SkyCoord) -> Iterator[Match]:
+    """
+    Like search_all_item, but produce matches incrementally
+    """
+    raise NotImplementedError
 
 
-@search_nearest_item.register  # type: ignore[no-redef]
-def _(item: CatsHTMQueryItem, coord: SkyCoord) -> Optional[CatalogItem]:  # type: ignore[no-redef]
-    srcs, colnames, colunits = cone_search(
-        item.name,
-        coord.ra.rad,
-        coord.dec.rad,
-        item.rs_arcsec,
-        catalogs_dir=str(settings.catshtm_dir),
+@singledispatch
+def search_all_table(item, coord: SkyCoord) -> Optional[Table]:
+    """
+    Like search_all_item, but return matches as a table, with distances in
+    a column named dist_arcsec
+    """
+    raise NotImplementedError
+
+
+@singledispatch
+def search_all_table_batch(item, coords: SkyCoord) -> Optional[Table]:
+    """
+    Like search_all_table, but for many positions, with the index of the
+    position in a column named position
+    """
+    raise NotImplementedError
+
+
+@singledispatch
+def search_any_batch(item, coords: SkyCoord) -> List[bool]:
+    raise NotImplementedError
+
+
+@singledispatch
+def search_nearest_batch(item, coords: SkyCoord) -> List[Optional[Match]]:
+    raise NotImplementedError
+
+
+@singledispatch
+def search_all_batch(item, coords: SkyCoord) -> List[Optional[List[Match]]]:
+    raise NotImplementedError
+
+
+def catshtm_cone_search(
+    item: CatsHTMQueryItem, coord: SkyCoord
+) -> Tuple[np.ndarray, List[str]]:
+    srcs, colnames = catshtm_cone_search_batch(item, coord.reshape((1,)))
+    return srcs[0], colnames
+
+
+def catshtm_cone_search_batch(
+    item: CatsHTMQueryItem, coords: SkyCoord
+) -> Tuple[List[np.ndarray], List[str]]:
+    catalog = get_catshtm(item.name, settings.catshtm_dir)
+    srcs = catalog.cone_search(
+        coords.ra.rad, coords.dec.rad, math.radians(item.rs_arcsec / 3600)
     )
-    if not len(srcs):
+    return srcs, catalog.colnames
+
+
+def catshtm_output_columns(
+    item: CatsHTMQueryItem, colnames: List[str]
+) -> Tuple[List[str], List[int]]:
+    """
+    Names and indices of the requested columns
+    """
+    output = [
+        (k, i)
+        for i, k in enumerate(colnames)
+        if item.keys_to_append is None or k in item.keys_to_append
+    ]
+    return [k for k, _ in output], [i for _, i in output]
+
+
+def catshtm_distances(coord: SkyCoord, srcs: np.ndarray) -> np.ndarray:
+    # catsHTM positions are in radians, in the first two columns
+    with stage("distance"):
+        return spherical.to_arcsec(
+            spherical.separation(coord.ra.rad, coord.dec.rad, srcs[:, 0], srcs[:, 1])
+        )
+
+
+def catshtm_nearest(
+    item: CatsHTMQueryItem, coord: SkyCoord, srcs: np.ndarray, colnames: List[str]
+) -> Optional[Match]:
+    with stage("distance"):
+        idx, dist = spherical.nearest(
+            srcs[:, 0], srcs[:, 1], coord.ra.rad, coord.dec.rad
+        )
+    if idx is None:
         return None
-    srcs_tab = Table(np.asarray(srcs), names=colnames)
-    srcs_tab["_ra"] = np.degrees(srcs_tab[colnames[0]])
-    srcs_tab["_dec"] = np.degrees(srcs_tab[colnames[1]])
-    row, dist = get_closest(
-        coord.ra.degree,
-        coord.dec.degree,
-        srcs_tab,
-        "_ra",
-        "_dec",
-    )
-    output_keys = set(colnames if item.keys_to_append is None else item.keys_to_append)
-    return CatalogItem(body=row_to_json(row, output_keys), dist_arcsec=dist)
+    keys, columns = catshtm_output_columns(item, colnames)
+    (body,) = columns_to_json(keys, srcs[idx : idx + 1, columns].T, 1)
+    return match(body, spherical.to_arcsec(dist))
 
 
-@search_all_item.register  # type: ignore[no-redef]
-def _(item: CatsHTMQueryItem, coord: SkyCoord) -> Optional[List[CatalogItem]]:
-    srcs, colnames, colunits = cone_search(
-        item.name,
-        coord.ra.rad,
-        coord.dec.rad,
-        item.rs_arcsec,
-        catalogs_dir=str(settings.catshtm_dir),
+def catshtm_flatten(
+    coords: SkyCoord, srcs: List[np.ndarray], colnames: List[str]
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Concatenate the sources found for many positions
+
+    :returns: sources, index of the position each source was found for, and
+        distance to that position in arcseconds
+    """
+    flat = np.concatenate([np.empty((0, len(colnames)))] + list(srcs))
+    pos = np.repeat(np.arange(len(srcs)), [len(s) for s in srcs])
+    with stage("distance"):
+        dists = spherical.to_arcsec(
+            spherical.separation(
+                coords.ra.rad[pos], coords.dec.rad[pos], flat[:, 0], flat[:, 1]
+            )
+        )
+    return flat, pos, dists
+
+
+def catshtm_nearest_batch(
+    item: CatsHTMQueryItem,
+    coords: SkyCoord,
+    srcs: List[np.ndarray],
+    colnames: List[str],
+) -> List[Optional[Match]]:
+    flat, pos, dists = catshtm_flatten(coords, srcs, colnames)
+    # first source of each position, in order of distance
+    order = np.lexsort((dists, pos))
+    nearest = order[np.searchsorted(pos[order], np.unique(pos))]
+    keys, columns = catshtm_output_columns(item, colnames)
+    rows = columns_to_json(keys, flat[nearest][:, columns].T, len(nearest))
+    results: List[Optional[Match]] = [None] * len(srcs)
+    for i, row, dist in zip(pos[nearest], rows, dists[nearest]):
+        results[i] = match(row, dist)
+    return results
+
+
+def catshtm_all_batch(
+    item: CatsHTMQueryItem,
+    coords: SkyCoord,
+    srcs: List[np.ndarray],
+    colnames: List[str],
+) -> List[Optional[List[Match]]]:
+    flat, pos, dists = catshtm_flatten(coords, srcs, colnames)
+    keys, columns = catshtm_output_columns(item, colnames)
+    rows = columns_to_json(keys, flat[:, columns].T, len(flat))
+    return split_positions(
+        [match(row, dist) for row, dist in zip(rows, dists)], pos, len(srcs)
     )
+
+
+def catshtm_table(
+    item: CatsHTMQueryItem, coord: SkyCoord, srcs: np.ndarray, colnames: List[str]
+) -> Table:
+    srcs = np.asarray(srcs).reshape(-1, len(colnames))
+    keys, columns = catshtm_output_columns(item, colnames)
+    with stage("table"):
+        table = Table(srcs[:, columns], names=keys)
+    return with_distances(table, keys, catshtm_distances(coord, srcs))
+
+
+def catshtm_all(
+    item: CatsHTMQueryItem, coord: SkyCoord, srcs: np.ndarray, colnames: List[str]
+) -> Optional[List[Match]]:
     if not len(srcs):
         return None
-    srcs_tab = Table(np.asarray(srcs), names=colnames)
-    srcs_tab["_ra"] = np.degrees(srcs_tab[colnames[0]])
-    srcs_tab["_dec"] = np.degrees(srcs_tab[colnames[1]])
-    dists = get_distances(
-        coord.ra.degree,
-        coord.dec.degree,
-        srcs_tab,
-        "_ra",
-        "_dec",
+    keys, columns = catshtm_output_columns(item, colnames)
+    rows = columns_to_json(keys, srcs[:, columns].T, len(srcs))
+    return [match(row, dist) for row, dist in zip(rows, catshtm_distances(coord, srcs))]
+
+
+@search_any_item.register  # type: ignore[no-redef]
+def _(item: CatsHTMQueryItem, coord: SkyCoord) -> bool:
+    srcs, colnames = catshtm_cone_search(item, coord)
+    return len(srcs) > 0
+
+
+@search_nearest_item.register  # type: ignore[no-redef]
+def _(item: CatsHTMQueryItem, coord: SkyCoord) -> Optional[Match]:  # type: ignore[no-redef]
+    return catshtm_nearest(item, coord, *catshtm_cone_search(item, coord))
+
+
+@search_all_item.register  # type: ignore[no-redef]
+def _(item: CatsHTMQueryItem, coord: SkyCoord) -> Optional[List[Match]]:
+    return catshtm_all(item, coord, *catshtm_cone_search(item, coord))
+
+
+@search_all_table.register  # type: ignore[no-redef]
+def _(item: CatsHTMQueryItem, coord: SkyCoord) -> Optional[Table]:
+    return catshtm_table(item, coord, *catshtm_cone_search(item, coord))
+
+
+@iter_all_item.register  # type: ignore[no-redef]
+def _(item: CatsHTMQueryItem, coord: SkyCoord) -> Iterator[Match]:
+    srcs, colnames = catshtm_cone_search(item, coord)
+    for start in range(0, len(srcs), STREAM_CHUNK_SIZE):
+        yield from catshtm_all(
+            item, coord, srcs[start : start + STREAM_CHUNK_SIZE], colnames
+        ) or []
+
+
+@search_any_batch.register  # type: ignore[no-redef]
+def _(item: CatsHTMQueryItem, coords: SkyCoord) -> List[bool]:
+    srcs, colnames = catshtm_cone_search_batch(item, coords)
+    return [len(s) > 0 for s in srcs]
+
+
+@search_nearest_batch.register  # type: ignore[no-redef]
+def _(item: CatsHTMQueryItem, coords: SkyCoord) -> List[Optional[Match]]:
+    return catshtm_nearest_batch(item, coords, *catshtm_cone_search_batch(item, coords))
+
+
+@search_all_batch.register  # type: ignore[no-redef]
+def _(item: CatsHTMQueryItem, coords: SkyCoord) -> List[Optional[List[Match]]]:
+    return catshtm_all_batch(item, coords, *catshtm_cone_search_batch(item, coords))
+
+
+@search_all_table_batch.register  # type: ignore[no-redef]
+def _(item: CatsHTMQueryItem, coords: SkyCoord) -> Optional[Table]:
+    srcs, colnames = catshtm_cone_search_batch(item, coords)
+    return stack_positions(
+        [catshtm_table(item, coord, s, colnames) for coord, s in zip(coords, srcs)]
     )
-    output_keys = set(colnames if item.keys_to_append is None else item.keys_to_append)
-    rows = table_to_json(srcs_tab, output_keys)
-    return [
-        CatalogItem(
-            body=row,
-            dist_arcsec=dist,
-        )
-        for row, dist in zip(rows, dists)
-    ]
 
 
 @search_any_item.register  # type: ignore[no-redef]
@@ -172,7 +461,7 @@ def _(item: ExtcatsQueryItem, coord: SkyCoord) -> bool:
     # sic
     if (catq := get_catq(item.name)) is None:
         raise ValueError(f"{item.name} is not a valid extcats catalog")
-    else:
+    with stage("mongo_query"):
         return catq.binaryserach(
             coord.ra.deg,
             coord.dec.deg,
@@ -184,7 +473,7 @@ def _(item: ExtcatsQueryItem, coord: SkyCoord) -> bool:
 
 def get_catq_with_projection(
     item: ExtcatsQueryItem,
-) -> Tuple[CatalogQuery, Dict[str, Any], Optional[Set[str]], Set[str]]:
+) -> Tuple["CatalogQuery", Dict[str, Any], Optional[Set[str]], Set[str]]:
     if (catq := get_catq(item.name)) is None:
         raise ValueError(f"{item.name} is not a valid extcats catalog")
     # do not return structured index fields
@@ -205,77 +494,801 @@ def get_catq_with_projection(
 
 
 @search_nearest_item.register  # type: ignore[no-redef]
-def _(item: ExtcatsQueryItem, coord: SkyCoord) -> Optional[CatalogItem]:  # type: ignore[no-redef]
+def _(item: ExtcatsQueryItem, coord: SkyCoord) -> Optional[Match]:  # type: ignore[no-redef]
     catq, projection, allow_keys, disallow_keys = get_catq_with_projection(item)
-    row, dist = catq.findclosest(
-        coord.ra.deg,
-        coord.dec.deg,
-        item.rs_arcsec,
-        projection=projection,
-        pre_filter=item.pre_filter,
-        post_filter=item.post_filter,
-    )
-    if row:
-        return CatalogItem(
-            body=row_to_json(row, allow_keys, disallow_keys),
-            dist_arcsec=dist,
+    with stage("mongo_query"):
+        srcs_tab = catq.findwithin(
+            coord.ra.deg,
+            coord.dec.deg,
+            item.rs_arcsec,
+            projection=projection,
+            pre_filter=item.pre_filter,
+            post_filter=item.post_filter,
         )
+    if not srcs_tab:
+        return None
+    with stage("distance"):
+        idx, dist = spherical.nearest(
+            np.radians(srcs_tab[catq.ra_key]),
+            np.radians(srcs_tab[catq.dec_key]),
+            coord.ra.rad,
+            coord.dec.rad,
+        )
+    if idx is None or (dist_arcsec := spherical.to_arcsec(dist)) > item.rs_arcsec:
+        return None
+    return match(row_to_json(srcs_tab[idx], allow_keys, disallow_keys), dist_arcsec)
+
+
+@search_all_table.register  # type: ignore[no-redef]
+def _(item: ExtcatsQueryItem, coord: SkyCoord) -> Optional[Table]:
+    catq, projection, allow_keys, disallow_keys = get_catq_with_projection(item)
+    with stage("mongo_query"):
+        srcs_tab = catq.findwithin(
+            coord.ra.deg,
+            coord.dec.deg,
+            item.rs_arcsec,
+            projection=projection,
+            pre_filter=item.pre_filter,
+            post_filter=item.post_filter,
+        )
+    if srcs_tab:
+        with stage("distance"):
+            dists = spherical.to_arcsec(
+                spherical.separation(
+                    coord.ra.rad,
+                    coord.dec.rad,
+                    np.radians(srcs_tab[catq.ra_key]),
+                    np.radians(srcs_tab[catq.dec_key]),
+                )
+            )
+        output_keys = [
+            k
+            for k in srcs_tab.keys()
+            if (allow_keys is None or k in allow_keys) and (k not in disallow_keys)
+        ]
+        return with_distances(srcs_tab, output_keys, dists)
     else:
         return None
 
 
 @search_all_item.register  # type: ignore[no-redef]
-def _(item: ExtcatsQueryItem, coord: SkyCoord) -> Optional[List[CatalogItem]]:
+def _(item: ExtcatsQueryItem, coord: SkyCoord) -> Optional[List[Match]]:
+    return table_matches(search_all_table(item, coord))
+
+
+@iter_all_item.register  # type: ignore[no-redef]
+def _(item: ExtcatsQueryItem, coord: SkyCoord) -> Iterator[Match]:
     catq, projection, allow_keys, disallow_keys = get_catq_with_projection(item)
-    srcs_tab = catq.findwithin(
+    for doc, dist in iter_within(
+        catq,
         coord.ra.deg,
         coord.dec.deg,
         item.rs_arcsec,
         projection=projection,
         pre_filter=item.pre_filter,
         post_filter=item.post_filter,
-    )
-    if srcs_tab:
-        dists = get_distances(
-            coord.ra.degree,
-            coord.dec.degree,
-            srcs_tab,
-            catq.ra_key,
-            catq.dec_key,
+        batch_size=STREAM_CHUNK_SIZE,
+    ):
+        yield match(
+            {
+                k: sanitize_json(v)
+                for k, v in doc.items()
+                if (allow_keys is None or k in allow_keys)
+                and (k not in disallow_keys | {"_id"})
+            },
+            dist,
         )
-        rows = table_to_json(srcs_tab, allow_keys, disallow_keys)
-        return [
-            CatalogItem(body=row, dist_arcsec=dist) for row, dist in zip(rows, dists)
+
+
+def extcats_batch(
+    search_item: Callable[[ExtcatsQueryItem, SkyCoord], Any],
+    item: ExtcatsQueryItem,
+    coords: SkyCoord,
+) -> List[Any]:
+    """
+    Apply a single-position extcats search to many positions, visiting them
+    in index-cell order and querying repeated positions only once
+    """
+    from healpy import ang2pix
+
+    if (catq := get_catq(item.name)) is None:
+        raise ValueError(f"{item.name} is not a valid extcats catalog")
+    # geoJSON-indexed catalogs are grouped by a coarse healpix grid instead
+    order = catq.hp_order if catq.has_hp else 6
+    nest = catq.hp_nest if catq.has_hp else True
+    ra, dec = coords.ra.deg, coords.dec.deg
+    cells = ang2pix(2 ** order, ra, dec, nest=nest, lonlat=True)
+    results: List[Any] = [None] * len(coords)
+    done: Dict[Tuple[float, float], Any] = {}
+    for i in np.argsort(cells, kind="stable"):
+        if (key := (ra[i], dec[i])) not in done:
+            done[key] = search_item(item, coords[i])
+        results[i] = done[key]
+    return results
+
+
+def extcats_bulk(
+    item: ExtcatsQueryItem, coords: SkyCoord
+) -> Optional[Tuple[Table, np.ndarray, np.ndarray]]:
+    """
+    Search many positions with bulk index queries
+
+    :returns: a table with the requested columns of each match, and the
+        position and distance of each match, sorted by position. None if
+        the catalog can only be searched position by position.
+    """
+    catq, projection, allow_keys, disallow_keys = get_catq_with_projection(item)
+    if not len(coords) or (
+        found := find_within_batch(
+            catq,
+            coords.ra.deg,
+            coords.dec.deg,
+            item.rs_arcsec,
+            projection=projection,
+            pre_filter=item.pre_filter,
+            post_filter=item.post_filter,
+        )
+    ) is None:
+        return None
+    docs, pos, doc_idx, dists = found
+    if not len(doc_idx):
+        return Table(), pos, dists
+    with stage("table"):
+        # NB: as in CatalogQuery.findwithin
+        srcs_tab = Table(docs)[doc_idx]
+        output_keys = [
+            k
+            for k in srcs_tab.keys()
+            if (allow_keys is None or k in allow_keys) and (k not in disallow_keys)
         ]
+        return Table([srcs_tab[k] for k in output_keys], copy=False), pos, dists
+
+
+def split_positions(
+    values: List[Any], pos: np.ndarray, num_positions: int
+) -> List[Any]:
+    """
+    Group values sorted by position into a list for each position, or None
+    """
+    bounds = np.searchsorted(pos, np.arange(num_positions + 1))
+    return [
+        values[start:stop] if stop > start else None
+        for start, stop in zip(bounds[:-1], bounds[1:])
+    ]
+
+
+@search_any_batch.register  # type: ignore[no-redef]
+def _(item: ExtcatsQueryItem, coords: SkyCoord) -> List[bool]:
+    if (bulk := extcats_bulk(item, coords)) is None:
+        return extcats_batch(search_any_item, item, coords)
+    _, pos, _ = bulk
+    return (np.bincount(pos, minlength=len(coords)) > 0).tolist()
+
+
+@search_nearest_batch.register  # type: ignore[no-redef]
+def _(item: ExtcatsQueryItem, coords: SkyCoord) -> List[Optional[Match]]:
+    if (bulk := extcats_bulk(item, coords)) is None:
+        return extcats_batch(search_nearest_item, item, coords)
+    srcs_tab, pos, dists = bulk
+    order = np.lexsort((dists, pos))
+    nearest = order[np.searchsorted(pos[order], np.unique(pos))]
+    rows = table_to_json(srcs_tab[nearest], None) if len(nearest) else []
+    results: List[Optional[Match]] = [None] * len(coords)
+    for i, row, dist in zip(pos[nearest], rows, dists[nearest]):
+        results[i] = match(row, dist)
+    return results
+
+
+@search_all_batch.register  # type: ignore[no-redef]
+def _(item: ExtcatsQueryItem, coords: SkyCoord) -> List[Optional[List[Match]]]:
+    if (bulk := extcats_bulk(item, coords)) is None:
+        return extcats_batch(search_all_item, item, coords)
+    srcs_tab, pos, dists = bulk
+    rows = table_to_json(srcs_tab, None) if len(pos) else []
+    return split_positions(
+        [match(row, dist) for row, dist in zip(rows, dists)], pos, len(coords)
+    )
+
+
+@search_all_table_batch.register  # type: ignore[no-redef]
+def _(item: ExtcatsQueryItem, coords: SkyCoord) -> Optional[Table]:
+    if (bulk := extcats_bulk(item, coords)) is None:
+        return stack_positions(extcats_batch(search_all_table, item, coords))
+    srcs_tab, pos, dists = bulk
+    if not len(pos):
+        return None
+    return Table(
+        [
+            Column(pos, name="position"),
+            *with_distances(srcs_tab, srcs_tab.colnames, dists).itercols(),
+        ],
+        copy=False,
+    )
+
+
+# catsHTM searches are bound by HDF5 reads and numpy, and get their own
+# threads so that they do not hold up extcats queries
+catshtm_executor = ThreadPoolExecutor(
+    settings.max_parallelism, thread_name_prefix="catshtm"
+)
+
+
+class LatencyTracker:
+    """
+    Exponentially weighted moving average of search latency per catalog
+    """
+
+    def __init__(self, alpha: float = 0.2):
+        self.alpha = alpha
+        self._latency: Dict[Tuple[str, str], float] = {}
+
+    def observe(
+        self, item: Union[ExtcatsQueryItem, CatsHTMQueryItem], seconds: float
+    ) -> None:
+        key = (item.use, item.name)
+        if (previous := self._latency.get(key)) is None:
+            self._latency[key] = seconds
+        else:
+            self._latency[key] = previous + self.alpha * (seconds - previous)
+
+    def estimate(self, item: Union[ExtcatsQueryItem, CatsHTMQueryItem]) -> float:
+        # unseen catalogs go first, so that they are measured
+        return self._latency.get((item.use, item.name), 0.0)
+
+
+search_latency = LatencyTracker()
+
+# single-position searches whose results go through the result cache
+CACHED_SEARCHES: Dict[Callable[..., Any], str] = {
+    search_any_item: "any",
+    search_nearest_item: "nearest",
+    search_all_item: "all",
+}
+
+
+def instrumented(
+    search_item: Callable[..., Any], method: str
+) -> Callable[..., Any]:
+    """
+    Record the duration and result size of a search, and attribute the
+    stages timed within it to its catalog
+    """
+
+    def search(item: Union[ExtcatsQueryItem, CatsHTMQueryItem], *args: Any) -> Any:
+        labels = {"backend": item.use, "catalog": item.name, "method": method}
+        start = time.perf_counter()
+        with metrics.catalog_context(item.use, item.name):
+            try:
+                result = search_item(item, *args)
+            except Exception:
+                metrics.search_errors.inc(**labels)
+                raise
+        metrics.search_seconds.observe(time.perf_counter() - start, **labels)
+        metrics.search_results.inc(metrics.result_size(result), **labels)
+        return result
+
+    return search
+
+
+def mongo_timeout(
+    search_item: Callable[..., Any], seconds: float
+) -> Callable[..., Any]:
+    """
+    Stop the Mongo operations of a search at its deadline, rather than
+    leaving them to run to completion after the search has been abandoned
+    """
+    if settings.mongo_max_time_ms is not None:
+        seconds = min(seconds, settings.mongo_max_time_ms / 1000)
+
+    def search(*args: Any) -> Any:
+        with pymongo.timeout(seconds):
+            return search_item(*args)
+
+    return search
+
+
+async def search_catalog(
+    search_item: Callable[..., Any],
+    item: Union[ExtcatsQueryItem, CatsHTMQueryItem],
+    *args: Any,
+    timeout: Optional[float] = None,
+) -> Any:
+    """
+    Apply a search to a single catalog off the event loop
+    """
+    method = search_item.__name__
+    if (cached := CACHED_SEARCHES.get(search_item)) is not None:
+        search_item = partial(cached_search, search_item, cached)
+    search = instrumented(search_item, method)
+    if timeout is not None and isinstance(item, ExtcatsQueryItem):
+        search = mongo_timeout(search, timeout)
+    start = time.perf_counter()
+    if isinstance(item, CatsHTMQueryItem):
+        result = await asyncio.get_running_loop().run_in_executor(
+            catshtm_executor, search, item, *args
+        )
     else:
+        result = await run_in_threadpool(search, item, *args)
+    search_latency.observe(item, time.perf_counter() - start)
+    return result
+
+
+class Deadline:
+    """
+    Time limits for the catalog searches of a request: the request's
+    timeout_s (or settings.search_timeout) for all of them, and each
+    catalog's timeout_s (or settings.catalog_timeout). Catalogs that are not
+    searched in time get a null result, and are listed by index in the
+    X-Timed-Out-Catalogs response header.
+
+    Searches are abandoned rather than interrupted: a catsHTM search runs to
+    completion in its thread, while the Mongo operations of an extcats
+    search are stopped at the deadline.
+    """
+
+    header = "X-Timed-Out-Catalogs"
+
+    def __init__(self, timeout: Optional[float] = None):
+        if timeout is None:
+            timeout = settings.search_timeout
+        self.expires = None if timeout is None else time.monotonic() + timeout
+        self.timed_out: Set[int] = set()
+
+    def remaining(
+        self, item: Union[ExtcatsQueryItem, CatsHTMQueryItem]
+    ) -> Optional[float]:
+        """
+        Seconds left to search a catalog, or None if unlimited
+        """
+        if (timeout := item.timeout_s) is None:
+            timeout = settings.catalog_timeout
+        if self.expires is not None:
+            left = self.expires - time.monotonic()
+            timeout = left if timeout is None else min(timeout, left)
+        return timeout
+
+    async def search(
+        self,
+        index: int,
+        search_item: Callable[..., Any],
+        item: Union[ExtcatsQueryItem, CatsHTMQueryItem],
+        *args: Any,
+    ) -> Any:
+        """
+        Apply a search to a catalog, giving up on it when its time runs out
+        """
+        if (timeout := self.remaining(item)) is None:
+            return await search_catalog(search_item, item, *args)
+        if timeout > 0:
+            try:
+                return await asyncio.wait_for(
+                    search_catalog(search_item, item, *args, timeout=timeout), timeout
+                )
+            except asyncio.TimeoutError:
+                pass
+            except PyMongoError as exc:
+                if not exc.timeout:
+                    raise
+        self.timed_out.add(index)
+        metrics.search_timeouts.inc(
+            backend=item.use, catalog=item.name, method=search_item.__name__
+        )
+        return None
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        if not self.timed_out:
+            return {}
+        return {self.header: ",".join(str(i) for i in sorted(self.timed_out))}
+
+
+async def search_items(
+    search_item: Callable[..., Any],
+    items: Sequence[Union[ExtcatsQueryItem, CatsHTMQueryItem]],
+    *args: Any,
+    deadline: Optional[Deadline] = None,
+) -> List[Any]:
+    """
+    Apply a search to each catalog, searching up to settings.max_parallelism
+    catalogs at a time
+    """
+    limit = asyncio.Semaphore(max(settings.max_parallelism, 1))
+    if deadline is None:
+        deadline = Deadline()
+
+    async def search(
+        index: int, item: Union[ExtcatsQueryItem, CatsHTMQueryItem]
+    ) -> Any:
+        async with limit:
+            return await deadline.search(index, search_item, item, *args)
+
+    return await asyncio.gather(*(search(*entry) for entry in enumerate(items)))
+
+
+async def search_first(
+    search_item: Callable[..., bool],
+    items: Sequence[Union[ExtcatsQueryItem, CatsHTMQueryItem]],
+    *args: Any,
+    deadline: Optional[Deadline] = None,
+) -> bool:
+    """
+    Is there a match in any catalog? Catalogs are searched in order of
+    increasing observed latency, and the answer is returned at the first
+    match. Searches still waiting for a slot then never start, but those
+    already running are not interrupted: their threads run to completion,
+    and their results are discarded. Catalogs that time out count as no
+    match.
+    """
+    limit = asyncio.Semaphore(max(settings.max_parallelism, 1))
+    if deadline is None:
+        deadline = Deadline()
+    found = False
+
+    async def search(
+        index: int, item: Union[ExtcatsQueryItem, CatsHTMQueryItem]
+    ) -> bool:
+        nonlocal found
+        async with limit:
+            # searches still waiting for a slot at the first match never start
+            if not found and await deadline.search(index, search_item, item, *args):
+                found = True
+        return found
+
+    # searches acquire the semaphore in creation order
+    tasks = [
+        asyncio.ensure_future(search(*entry))
+        for entry in sorted(
+            enumerate(items), key=lambda entry: search_latency.estimate(entry[1])
+        )
+    ]
+    try:
+        for task in asyncio.as_completed(tasks):
+            if await task:
+                return True
+        return False
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+# lines per chunk of a streamed response. Starlette advances the stream in
+# the threadpool, so each chunk costs a round trip to a thread.
+STREAM_CHUNK_LINES = 256
+
+
+def stream_all(
+    items: Sequence[Union[ExtcatsQueryItem, CatsHTMQueryItem]],
+    coords: SkyCoord,
+    limit: Optional[int] = None,
+) -> Iterator[bytes]:
+    """
+    Produce matches as newline-delimited JSON, catalog by catalog (and
+    position by position), as they are read from the catalogs, in chunks of
+    up to STREAM_CHUNK_LINES lines. With a limit, the first matches read are
+    kept rather than the nearest.
+    """
+    lines: List[bytes] = []
+    for position, coord in enumerate(coords.reshape(-1)):
+        for catalog, item in enumerate(items):
+            for m in islice(iter_all_item(item, coord), limit):
+                location = {"catalog": catalog}
+                if not coords.isscalar:
+                    location["position"] = position
+                lines.append(orjson.dumps({**location, **m}) + b"\n")
+                if len(lines) >= STREAM_CHUNK_LINES:
+                    yield b"".join(lines)
+                    lines = []
+    if lines:
+        yield b"".join(lines)
+
+
+def result_limit(max_results: Optional[int]) -> Optional[int]:
+    """
+    Number of sources to return per catalog and position: the request's
+    max_results, capped at settings.max_results
+    """
+    limits = [n for n in (max_results, settings.max_results) if n is not None]
+    return min(limits) if limits else None
+
+
+def truncate_matches(
+    matches: Optional[List[Match]], limit: int
+) -> Optional[List[Match]]:
+    """
+    Keep the nearest matches
+    """
+    if matches is None or len(matches) <= limit:
+        return matches
+    return sorted(matches, key=itemgetter("dist_arcsec"))[:limit]
+
+
+def truncate_batch(
+    results: Optional[List[Optional[List[Match]]]], limit: int
+) -> Optional[List[Optional[List[Match]]]]:
+    if results is None:
         return None
+    truncated = [truncate_matches(matches, limit) for matches in results]
+    if all(t is r for t, r in zip(truncated, results)):
+        return results
+    return truncated
+
+
+def truncate_table(table: Optional[Table], limit: int) -> Optional[Table]:
+    """
+    Keep the nearest rows, per position if the table has a position column
+    """
+    if table is None or len(table) <= limit:
+        return table
+    position = (
+        np.asarray(table["position"])
+        if "position" in table.colnames
+        else np.zeros(len(table), dtype=np.int64)
+    )
+    order = np.lexsort((np.asarray(table["dist_arcsec"]), position))
+    groups = position[order]
+    rank = np.arange(len(order)) - np.searchsorted(groups, groups)
+    if (keep := rank < limit).all():
+        return table
+    return table[np.sort(order[keep])]
+
+
+def truncate(
+    results: List[Any], limit: Optional[int], truncate_result: Callable[[Any, int], Any]
+) -> Tuple[List[Any], Dict[str, str]]:
+    """
+    Apply a limit to the result of each catalog
+
+    :returns: the results, and response headers listing the catalogs whose
+        results were truncated
+    """
+    if limit is None:
+        return results, {}
+    truncated = [truncate_result(r, limit) for r in results]
+    indices = [str(i) for i, (t, r) in enumerate(zip(truncated, results)) if t is not r]
+    return truncated, ({"X-Truncated-Catalogs": ",".join(indices)} if indices else {})
+
+
+async def search_tables(
+    search_table: Callable[..., Optional[Table]],
+    items: Sequence[Union[ExtcatsQueryItem, CatsHTMQueryItem]],
+    coords: SkyCoord,
+    media_type: str,
+    deadline: Deadline,
+    limit: Optional[int],
+) -> Response:
+    """
+    Search catalogs for tables of matches, and serialize them in the
+    requested columnar format
+    """
+    if media_type not in (available := formats.available_media_types()):
+        raise HTTPException(
+            status_code=406,
+            detail=f"{media_type} is not available; use one of {available}",
+        )
+    tables, truncated = truncate(
+        await search_items(search_table, items, coords, deadline=deadline),
+        limit,
+        truncate_table,
+    )
 
+    def serialize() -> bytes:
+        with stage("serialize"):
+            return formats.serialize(
+                media_type,
+                [item.name for item in items],
+                tables,
+                deadline.timed_out,
+            )
+
+    return Response(
+        await run_in_threadpool(serialize),
+        media_type=media_type,
+        headers={**deadline.headers, **truncated},
+    )
+
+
+def by_position(results: List[List[Any]], num_positions: int) -> List[List[Any]]:
+    """
+    Transpose per-catalog results to per-position results. Catalogs that
+    timed out have a null result at every position.
+    """
+    return [
+        [None if r is None else r[i] for r in results] for i in range(num_positions)
+    ]
+
+
+AnyResult = Union[List[bool], bool]
 
 router = APIRouter()
 
 
-@router.post("/any", response_model=List[bool])
-def search_any(request: ConeSearchRequest) -> List[bool]:
+@router.post(
+    "/any",
+    response_class=ORJSONResponse,
+    response_model=AnyResult,
+)
+async def search_any(
+    request: ConeSearchRequest,
+    short_circuit: bool = Query(
+        False,
+        description="Return a single boolean indicating whether any catalog has sources in the search radius, stopping at the first match",
+    ),
+) -> ORJSONResponse:
     """
     Are there sources in the search radius?
     """
     coord = SkyCoord(request.ra_deg, request.dec_deg, unit="deg")
-    return [search_any_item(item, coord) for item in request.catalogs]
+    deadline = Deadline(request.timeout_s)
+    async with admission.admitted(request.catalogs, coord):
+        if short_circuit:
+            found = await search_first(
+                search_any_item, request.catalogs, coord, deadline=deadline
+            )
+            return ORJSONResponse(found, headers=deadline.headers)
+        return ORJSONResponse(
+            await search_items(
+                search_any_item, request.catalogs, coord, deadline=deadline
+            ),
+            headers=deadline.headers,
+        )
 
 
-@router.post("/nearest", response_model=List[Optional[CatalogItem]])
-def search_nearest(request: ConeSearchRequest) -> List[Optional[CatalogItem]]:
+@router.post(
+    "/nearest",
+    response_class=ORJSONResponse,
+    response_model=List[Optional[CatalogItem]],
+)
+async def search_nearest(request: ConeSearchRequest) -> ORJSONResponse:
     """
     Find nearest source in search radius
     """
     coord = SkyCoord(request.ra_deg, request.dec_deg, unit="deg")
-    return [search_nearest_item(item, coord) for item in request.catalogs]
+    deadline = Deadline(request.timeout_s)
+    async with admission.admitted(request.catalogs, coord):
+        return ORJSONResponse(
+            await search_items(
+                search_nearest_item, request.catalogs, coord, deadline=deadline
+            ),
+            headers=deadline.headers,
+        )
 
 
-@router.post("/all", response_model=List[Optional[List[CatalogItem]]])
-def search_all(request: ConeSearchRequest) -> List[Optional[List[CatalogItem]]]:
+@router.post(
+    "/all",
+    response_class=ORJSONResponse,
+    response_model=List[Optional[List[CatalogItem]]],
+)
+async def search_all(
+    request: ConeSearchRequest,
+    accept: Optional[str] = Header(None),
+) -> Union[ORJSONResponse, NDJSONResponse, Response]:
     """
     Find all sources in the search radius
+
+    With `Accept: application/x-ndjson`, stream one line per source of the
+    form `{"catalog": index, "body": {...}, "dist_arcsec": dist}` instead.
+
+    With `Accept: application/x-votable+xml` (or, if pyarrow is installed,
+    `application/vnd.apache.arrow.stream`), return one table per catalog
+    instead, with the requested columns and a dist_arcsec column.
     """
     coord = SkyCoord(request.ra_deg, request.dec_deg, unit="deg")
-    return [search_all_item(item, coord) for item in request.catalogs]
+    limit = result_limit(request.max_results)
+    if accept is not None and NDJSONResponse.media_type in accept:
+        cost_class = await admission.admit(request.catalogs, coord)
+        return NDJSONResponse(
+            stream_all(request.catalogs, coord, limit),
+            on_close=partial(admission.release, cost_class),
+        )
+    deadline = Deadline(request.timeout_s)
+    async with admission.admitted(request.catalogs, coord):
+        if media_type := formats.requested_media_type(accept):
+            return await search_tables(
+                search_all_table, request.catalogs, coord, media_type, deadline, limit
+            )
+        results, truncated = truncate(
+            await search_items(
+                search_all_item, request.catalogs, coord, deadline=deadline
+            ),
+            limit,
+            truncate_matches,
+        )
+        return ORJSONResponse(results, headers={**deadline.headers, **truncated})
+
+
+@router.post(
+    "/batch/any",
+    response_class=ORJSONResponse,
+    response_model=List[List[bool]],
+)
+async def search_any_batched(request: BatchConeSearchRequest) -> ORJSONResponse:
+    """
+    Are there sources in the search radius of each position?
+    """
+    coords = SkyCoord(request.ra_deg, request.dec_deg, unit="deg")
+    deadline = Deadline(request.timeout_s)
+    async with admission.admitted(request.catalogs, coords):
+        return ORJSONResponse(
+            by_position(
+                await search_items(
+                    search_any_batch, request.catalogs, coords, deadline=deadline
+                ),
+                len(coords),
+            ),
+            headers=deadline.headers,
+        )
+
+
+@router.post(
+    "/batch/nearest",
+    response_class=ORJSONResponse,
+    response_model=List[List[Optional[CatalogItem]]],
+)
+async def search_nearest_batched(request: BatchConeSearchRequest) -> ORJSONResponse:
+    """
+    Find nearest source in the search radius of each position
+    """
+    coords = SkyCoord(request.ra_deg, request.dec_deg, unit="deg")
+    deadline = Deadline(request.timeout_s)
+    async with admission.admitted(request.catalogs, coords):
+        return ORJSONResponse(
+            by_position(
+                await search_items(
+                    search_nearest_batch, request.catalogs, coords, deadline=deadline
+                ),
+                len(coords),
+            ),
+            headers=deadline.headers,
+        )
+
+
+@router.post(
+    "/batch/all",
+    response_class=ORJSONResponse,
+    response_model=List[List[Optional[List[CatalogItem]]]],
+)
+async def search_all_batched(
+    request: BatchConeSearchRequest,
+    accept: Optional[str] = Header(None),
+) -> Union[ORJSONResponse, NDJSONResponse, Response]:
+    """
+    Find all sources in the search radius of each position
+
+    With `Accept: application/x-ndjson`, stream one line per source of the
+    form `{"catalog": index, "position": index, "body": {...}, "dist_arcsec": dist}`
+    instead.
+
+    With a columnar format in the Accept header (see /all), return one table
+    per catalog, with the index of the position in a column named position.
+    """
+    coords = SkyCoord(request.ra_deg, request.dec_deg, unit="deg")
+    limit = result_limit(request.max_results)
+    if accept is not None and NDJSONResponse.media_type in accept:
+        cost_class = await admission.admit(request.catalogs, coords)
+        return NDJSONResponse(
+            stream_all(request.catalogs, coords, limit),
+            on_close=partial(admission.release, cost_class),
+        )
+    deadline = Deadline(request.timeout_s)
+    async with admission.admitted(request.catalogs, coords):
+        if media_type := formats.requested_media_type(accept):
+            return await search_tables(
+                search_all_table_batch,
+                request.catalogs,
+                coords,
+                media_type,
+                deadline,
+                limit,
+            )
+        results, truncated = truncate(
+            await search_items(
+                search_all_batch, request.catalogs, coords, deadline=deadline
+            ),
+            limit,
+            truncate_batch,
+        )
+        return ORJSONResponse(
+            by_position(results, len(coords)),
+            headers={**deadline.headers, **truncated},
+        )
@@ -0,0 +1,72 @@
+from typing import Any, Callable, List, Optional, Union
+
+import numpy as np
+from astropy.coordinates import SkyCoord
+from fastapi import APIRouter
+from fastapi.responses import ORJSONResponse
+
+from .cone_search import Deadline, Match, search_all_batch, search_nearest_batch
+from .models import CatalogItem, CrossmatchRequest
+
+# positions searched at a time. Each chunk covers a compact patch of sky, so
+# that catsHTM trixels and extcats index cells are visited once per chunk.
+CHUNK_SIZE = 10000
+# healpix order used to sort positions (~3.4 arcmin cells)
+SORT_ORDER = 10
+
+
+def spatial_order(coords: SkyCoord) -> np.ndarray:
+    """
+    Order positions along the nested healpix curve, keeping neighbors on
+    the sky close together
+    """
+    from healpy import ang2pix
+
+    cells = ang2pix(
+        2 ** SORT_ORDER, coords.ra.deg, coords.dec.deg, nest=True, lonlat=True
+    )
+    return np.argsort(cells, kind="stable")
+
+
+CrossmatchResult = Union[
+    List[Optional[CatalogItem]], List[Optional[List[CatalogItem]]]
+]
+
+router = APIRouter()
+
+
+@router.post(
+    "",
+    response_class=ORJSONResponse,
+    response_model=CrossmatchResult,
+)
+async def crossmatch(request: CrossmatchRequest) -> ORJSONResponse:
+    """
+    Match a list of positions against a single catalog
+
+    Returns the nearest source in the search radius of each position (or, with
+    `all`, every source in the search radius), in the same order as the
+    positions.
+
+    The time limit of the catalog (its timeout_s) covers the whole crossmatch.
+    Positions not searched in time get a null result, and the catalog is
+    listed in the X-Timed-Out-Catalogs response header.
+    """
+    coords = SkyCoord(request.ra_deg, request.dec_deg, unit="deg")
+    search_batch: Callable[..., Any]
+    if request.all:
+        search_batch = search_all_batch
+    else:
+        search_batch = search_nearest_batch
+    # one deadline for all chunks, rather than one per chunk
+    deadline = Deadline(Deadline().remaining(request.catalog))
+    results: List[Union[Optional[Match], Optional[List[Match]]]] = [None] * len(coords)
+    order = spatial_order(coords)
+    for start in range(0, len(order), CHUNK_SIZE):
+        chunk = order[start : start + CHUNK_SIZE]
+        found = await deadline.search(0, search_batch, request.catalog, coords[chunk])
+        if found is None:
+            break
+        for i, result in zip(chunk, found):
+            results[i] = result
+    return ORJSONResponse(results, headers=deadline.headers)
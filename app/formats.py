@@ -0,0 +1,202 @@
+"""
+Binary, columnar representations of cone search results
+
+Each catalog in a request becomes one table, with the requested columns of
+the matched sources and their distance from the search position. Catalogs
+that were not searched in time are marked as timed out.
+"""
+
+import importlib.util
+import io
+from typing import TYPE_CHECKING, AbstractSet, Any, Dict, List, Optional, Sequence
+
+import numpy as np
+import orjson
+from astropy.table import Table
+
+if TYPE_CHECKING:
+    import pyarrow as pa
+
+VOTABLE = "application/x-votable+xml"
+ARROW_STREAM = "application/vnd.apache.arrow.stream"
+
+
+def available_media_types() -> List[str]:
+    # pyarrow is optional, and only imported to serialize a response
+    has_arrow = importlib.util.find_spec("pyarrow") is not None
+    return [VOTABLE] + ([ARROW_STREAM] if has_arrow else [])
+
+
+def requested_media_type(accept: Optional[str]) -> Optional[str]:
+    """
+    Return the columnar media type named in an Accept header, if any
+    """
+    if accept is None:
+        return None
+    for media_range in accept.split(","):
+        media_type = media_range.split(";")[0].strip()
+        if media_type in (VOTABLE, ARROW_STREAM):
+            return media_type
+    return None
+
+
+def empty_table() -> Table:
+    return Table({"dist_arcsec": np.empty(0)})
+
+
+def json_default(obj: Any) -> Any:
+    if isinstance(obj, bytes):
+        return obj.decode(errors="replace")
+    raise TypeError
+
+
+def encode_objects(table: Table) -> Table:
+    """
+    Replace columns of arbitrary Python objects (e.g. nested documents) with
+    their JSON encoding, and byte strings with text, as in JSON responses
+    """
+    table = table.copy(copy_data=False)
+    for name in table.colnames:
+        column = table[name]
+        if column.dtype.kind == "O":
+            table[name] = [
+                orjson.dumps(
+                    v, option=orjson.OPT_SERIALIZE_NUMPY, default=json_default
+                ).decode()
+                for v in column
+            ]
+        elif column.dtype.kind == "S":
+            decoded = np.char.decode(np.ma.getdata(column), errors="replace")
+            if (mask := np.ma.getmask(column)) is not np.ma.nomask:
+                decoded = np.ma.MaskedArray(decoded, mask=mask)
+            table[name] = decoded
+    return table
+
+
+def to_votable(
+    names: Sequence[str],
+    tables: Sequence[Optional[Table]],
+    timed_out: AbstractSet[int] = frozenset(),
+) -> bytes:
+    """
+    Serialize tables as a VOTable with BINARY2 serialization, one TABLE per
+    catalog. Tables of catalogs that timed out have an INFO named timed_out.
+    """
+    from astropy.io.votable.tree import Info, Resource, VOTableFile
+
+    try:
+        from astropy.io.votable.tree import TableElement as VOTable
+    except ImportError:  # astropy < 6
+        from astropy.io.votable.tree import Table as VOTable
+
+    votable = VOTableFile()
+    resource = Resource()
+    votable.resources.append(resource)
+    for i, (name, table) in enumerate(zip(names, tables)):
+        vot = VOTable.from_table(
+            votable, encode_objects(empty_table() if table is None else table)
+        )
+        vot.ID = f"catalog_{i}"
+        vot.name = name
+        if i in timed_out:
+            vot.infos.append(
+                Info(ID=f"catalog_{i}_timed_out", name="timed_out", value="true")
+            )
+        resource.tables.append(vot)
+    buf = io.BytesIO()
+    votable.to_xml(buf, tabledata_format="binary2")
+    return buf.getvalue()
+
+
+def to_arrow_table(table: Table) -> "pa.Table":
+    import pyarrow as pa
+
+    columns = {}
+    for colname in table.colnames:
+        column = table[colname]
+        mask = np.ma.getmask(column)
+        columns[colname] = pa.array(
+            np.ma.getdata(column),
+            mask=None if mask is np.ma.nomask else np.asarray(mask),
+        )
+    return pa.table(columns)
+
+
+def unify_schemas(tables: Sequence["pa.Table"]) -> "pa.Schema":
+    """
+    Combine the columns of all tables, after a catalog index column. Columns
+    of the same name but different types become float64 if all the types are
+    numeric, and strings otherwise.
+    """
+    import pyarrow as pa
+
+    types: Dict[str, List[pa.DataType]] = {}
+    for table in tables:
+        for field in table.schema:
+            types.setdefault(field.name, []).append(field.type)
+    fields = [pa.field("catalog", pa.int32(), nullable=False)]
+    for name, column_types in types.items():
+        if all(t == column_types[0] for t in column_types):
+            column_type = column_types[0]
+        elif all(
+            pa.types.is_integer(t) or pa.types.is_floating(t) for t in column_types
+        ):
+            column_type = pa.float64()
+        else:
+            column_type = pa.string()
+        fields.append(pa.field(name, column_type))
+    return pa.schema(fields)
+
+
+def to_arrow(
+    names: Sequence[str],
+    tables: Sequence[Optional[Table]],
+    timed_out: AbstractSet[int] = frozenset(),
+) -> bytes:
+    """
+    Serialize tables as a single Arrow IPC stream, with one record batch per
+    catalog. Batches share one schema: the index of the catalog in a column
+    named catalog, and the columns of all catalogs, null where a catalog
+    lacks them. The schema metadata hold the catalog names (catalogs) and the
+    indices of the catalogs that timed out (timed_out), as JSON lists.
+    """
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise RuntimeError("Arrow output requires pyarrow")
+    arrow_tables = [
+        to_arrow_table(encode_objects(empty_table() if table is None else table))
+        for table in tables
+    ]
+    schema = unify_schemas(arrow_tables).with_metadata(
+        {
+            "catalogs": orjson.dumps(list(names)),
+            "timed_out": orjson.dumps(sorted(timed_out)),
+        }
+    )
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        for i, arrow_table in enumerate(arrow_tables):
+            num_rows = arrow_table.num_rows
+            columns = [pa.array(np.full(num_rows, i, dtype=np.int32))] + [
+                arrow_table[field.name].combine_chunks().cast(field.type)
+                if field.name in arrow_table.column_names
+                else pa.nulls(num_rows, field.type)
+                for field in list(schema)[1:]
+            ]
+            writer.write_batch(pa.RecordBatch.from_arrays(columns, schema=schema))
+    return sink.getvalue().to_pybytes()
+
+
+def serialize(
+    media_type: str,
+    names: Sequence[str],
+    tables: Sequence[Optional[Table]],
+    timed_out: AbstractSet[int] = frozenset(),
+) -> bytes:
+    if media_type == VOTABLE:
+        return to_votable(names, tables, timed_out)
+    elif media_type == ARROW_STREAM:
+        return to_arrow(names, tables, timed_out)
+    else:
+        raise ValueError(f"unsupported media type {media_type}")
@@ -0,0 +1,26 @@
+"""
+gunicorn configuration for a preforked deployment:
+
+    gunicorn -c python:app.gunicorn_conf app.main:app
+
+The application is imported and its catalogs loaded once in the arbiter
+(see app.prefork), and shared with the uvicorn workers it forks. Bind
+address and worker count are set as usual, e.g. with --bind and --workers
+(or WEB_CONCURRENCY).
+"""
+
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+
+
+def when_ready(server):
+    # the app has been imported, and no worker forked yet
+    from app.prefork import preload
+
+    preload()
+
+
+def post_fork(server, worker):
+    from app.prefork import after_fork
+
+    after_fork()
@@ -1,9 +1,18 @@
 
+import asyncio
+
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
+from starlette.concurrency import run_in_threadpool
 
+from .catalogs import catalog_descriptions
 from .catalogs import router as catalogs_router
 from .cone_search import router as cone_search_router
+from .crossmatch import router as crossmatch_router
+from .metrics import render as render_metrics
+from .registry import install_refresh_handlers, registry
 from .settings import settings
+from .warmup import warm_up
 
 tags_metadata = [
     {
@@ -14,6 +23,10 @@ tags_metadata = [
         "name": "cone_search",
         "description": "Search for objects in a cone around a celestial direction",
     },
+    {
+        "name": "crossmatch",
+        "description": "Match lists of celestial coordinates against a catalog",
+    },
 ]
 
 app = FastAPI(
@@ -26,6 +39,38 @@ app = FastAPI(
 
 app.include_router(cone_search_router, prefix="/cone_search", tags=["cone_search"])
 app.include_router(catalogs_router, prefix="/catalogs", tags=["catalogs"])
+app.include_router(crossmatch_router, prefix="/crossmatch", tags=["crossmatch"])
+
+
+@app.get("/metrics", include_in_schema=False)
+def metrics() -> PlainTextResponse:
+    """
+    Search timings and result sizes, for Prometheus
+    """
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+def refresh_catalogs():
+    registry.refresh()
+    catalog_descriptions.refresh()
+
+
+async def load_catalogs():
+    await run_in_threadpool(registry.refresh)
+    if catalog_descriptions.descriptions is not None:
+        # inherited from a preloading parent process (see app.prefork)
+        pass
+    elif catalog_descriptions.load_snapshot():
+        # serve the previous listing while building the current one
+        asyncio.get_event_loop().create_task(
+            run_in_threadpool(catalog_descriptions.refresh)
+        )
+    else:
+        await run_in_threadpool(catalog_descriptions.refresh)
+    if settings.warm_up:
+        await run_in_threadpool(warm_up)
+    install_refresh_handlers(refresh_catalogs)
+
 
 # If we are mounted under a (non-stripped) prefix path, create a potemkin root
 # router and mount the actual root as a sub-application. This has no effect
@@ -34,3 +79,6 @@ if settings.root_path:
     wrapper = FastAPI()
     wrapper.mount(settings.root_path, app)
     app = wrapper
+
+# mounted sub-applications do not receive lifespan events
+app.add_event_handler("startup", load_catalogs)
@@ -0,0 +1,382 @@
+"""
+Search metrics in the Prometheus text exposition format
+
+Searches are timed per backend, catalog and method, and their parts per
+stage (e.g. HTM lookup, HDF5 read, Mongo query, distance computation, JSON
+conversion). Stages are attributed to the catalog set with catalog_context()
+in the current thread; stages outside of a catalog search (e.g. serializing
+a response) have empty backend and catalog labels. The MongoDB connection
+pool is instrumented per server address, and the hits, misses and size of
+each cache registered with register_cache() are read when rendering.
+
+Metrics are kept per process. With several worker processes, each one
+reports its own, and they should be scraped (or summed) accordingly.
+"""
+
+import math
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Sequence, Tuple
+
+# seconds
+TIME_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+Labels = Tuple[str, ...]
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return (
+        "{"
+        + ",".join(f'{name}="{escape(value)}"' for name, value in zip(names, values))
+        + "}"
+    )
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        all_metrics.append(self)
+
+    def label_values(self, labels: Dict[str, str]) -> Labels:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> Iterator[Tuple[str, Labels, Labels, float]]:
+        """
+        :returns: (suffix, extra label names, label values, value) per sample
+        """
+        raise NotImplementedError
+
+    def clear(self) -> None:
+        with self._lock:
+            self._values.clear()  # type: ignore[attr-defined]
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for suffix, extra_names, values, value in self.samples():
+            labels = format_labels(self.labelnames + extra_names, values)
+            lines.append(f"{self.name}{suffix}{labels} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, /, **labels: str) -> None:
+        key = self.label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels: str) -> float:
+        return self._values.get(self.label_values(labels), 0)
+
+    def samples(self) -> Iterator[Tuple[str, Labels, Labels, float]]:
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield "", (), key, value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, /, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = TIME_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # per label set: count per bucket (not cumulative), sum
+        self._values: Dict[Labels, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, /, **labels: str) -> None:
+        key = self.label_values(labels)
+        # first bucket with an upper bound >= value
+        idx = next(i for i, bound in enumerate(self.buckets) if value <= bound)
+        with self._lock:
+            if (entry := self._values.get(key)) is None:
+                entry = self._values[key] = ([0] * len(self.buckets), [0.0])
+            entry[0][idx] += 1
+            entry[1][0] += value
+
+    def count(self, **labels: str) -> int:
+        if (entry := self._values.get(self.label_values(labels))) is None:
+            return 0
+        return sum(entry[0])
+
+    def samples(self) -> Iterator[Tuple[str, Labels, Labels, float]]:
+        with self._lock:
+            values = sorted(
+                (key, (list(counts), total[0]))
+                for key, (counts, total) in self._values.items()
+            )
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield "_bucket", ("le",), key + (format_value(bound),), cumulative
+            yield "_sum", (), key, total
+            yield "_count", (), key, cumulative
+
+
+class Collected(Metric):
+    """
+    Metric whose samples are computed when rendered, from state kept
+    elsewhere
+    """
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str],
+        kind: str,
+        collect: Callable[[], Iterable[Tuple[Labels, float]]],
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.kind = kind
+        self.collect = collect
+
+    def samples(self) -> Iterator[Tuple[str, Labels, Labels, float]]:
+        for key, value in sorted(self.collect()):
+            yield "", (), key, value
+
+    def clear(self) -> None:
+        # nothing is recorded here
+        pass
+
+
+all_metrics: List[Metric] = []
+
+
+def render() -> str:
+    return "".join(metric.render() for metric in all_metrics)
+
+
+def reset() -> None:
+    for metric in all_metrics:
+        metric.clear()
+
+
+search_seconds = Histogram(
+    "catalogserver_search_seconds",
+    "Time spent searching a catalog",
+    ["backend", "catalog", "method"],
+)
+search_results = Counter(
+    "catalogserver_search_results_total",
+    "Sources returned from catalog searches",
+    ["backend", "catalog", "method"],
+)
+search_errors = Counter(
+    "catalogserver_search_errors_total",
+    "Catalog searches that raised an exception",
+    ["backend", "catalog", "method"],
+)
+search_timeouts = Counter(
+    "catalogserver_search_timeouts_total",
+    "Catalog searches abandoned at their deadline",
+    ["backend", "catalog", "method"],
+)
+stage_seconds = Histogram(
+    "catalogserver_stage_seconds",
+    "Time spent in each stage of catalog searches",
+    ["backend", "catalog", "stage"],
+)
+mongo_checkouts = Counter(
+    "catalogserver_mongo_checkouts_total",
+    "Connections checked out of the MongoDB connection pool",
+    ["address"],
+)
+mongo_checkout_failures = Counter(
+    "catalogserver_mongo_checkout_failures_total",
+    "Failed checkouts from the MongoDB connection pool, e.g. on timeout",
+    ["address", "reason"],
+)
+mongo_checkout_seconds = Histogram(
+    "catalogserver_mongo_checkout_seconds",
+    "Time spent waiting for a connection from the MongoDB connection pool",
+    ["address"],
+)
+mongo_connections = Gauge(
+    "catalogserver_mongo_connections",
+    "Open connections in the MongoDB connection pool",
+    ["address"],
+)
+mongo_connections_in_use = Gauge(
+    "catalogserver_mongo_connections_in_use",
+    "Connections currently checked out of the MongoDB connection pool",
+    ["address"],
+)
+
+admitted_searches = Gauge(
+    "catalogserver_admitted_searches",
+    "Searches in progress, by estimated cost class",
+    ["cost_class"],
+)
+rejected_searches = Counter(
+    "catalogserver_rejected_searches_total",
+    "Searches rejected because their cost class was at its limit",
+    ["cost_class"],
+)
+
+# functions that return each cache (or None if disabled), by name
+caches: Dict[str, Callable[[], Any]] = {}
+
+
+def register_cache(name: str, get_cache: Callable[[], Any]) -> None:
+    caches[name] = get_cache
+
+
+def cache_attribute(attribute: str) -> Callable[[], Iterator[Tuple[Labels, float]]]:
+    def collect() -> Iterator[Tuple[Labels, float]]:
+        for name, get_cache in caches.items():
+            if (value := getattr(get_cache(), attribute, None)) is not None:
+                yield (name,), value
+
+    return collect
+
+
+def cache_sizes() -> Iterator[Tuple[Labels, float]]:
+    for name, get_cache in caches.items():
+        if (cache := get_cache()) is not None:
+            yield (name,), len(cache)
+
+
+cache_hits = Collected(
+    "catalogserver_cache_hits_total",
+    "Lookups answered from a cache",
+    ["cache"],
+    "counter",
+    cache_attribute("hits"),
+)
+cache_misses = Collected(
+    "catalogserver_cache_misses_total",
+    "Lookups not answered from a cache",
+    ["cache"],
+    "counter",
+    cache_attribute("misses"),
+)
+cache_evictions = Collected(
+    "catalogserver_cache_evictions_total",
+    "Entries evicted from a cache to make room for others",
+    ["cache"],
+    "counter",
+    cache_attribute("evictions"),
+)
+cache_entries = Collected(
+    "catalogserver_cache_entries",
+    "Entries in a cache",
+    ["cache"],
+    "gauge",
+    cache_sizes,
+)
+cache_errors = Counter(
+    "catalogserver_cache_errors_total",
+    "Cache operations that failed, after which the search ran uncached",
+    ["cache", "operation"],
+)
+cache_bytes = Collected(
+    "catalogserver_cache_bytes",
+    "Size of the arrays in a cache",
+    ["cache"],
+    "gauge",
+    cache_attribute("nbytes"),
+)
+
+# (backend, catalog) being searched in the current thread
+current_catalog: ContextVar[Tuple[str, str]] = ContextVar(
+    "current_catalog", default=("", "")
+)
+
+
+@contextmanager
+def catalog_context(backend: str, catalog: str) -> Iterator[None]:
+    token = current_catalog.set((backend, catalog))
+    try:
+        yield
+    finally:
+        current_catalog.reset(token)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """
+    Time a stage of the current catalog search
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        backend, catalog = current_catalog.get()
+        stage_seconds.observe(
+            time.perf_counter() - start, backend=backend, catalog=catalog, stage=name
+        )
+
+
+def result_size(result: Any) -> int:
+    """
+    Count the sources in a search result
+    """
+    if result is None:
+        return 0
+    elif isinstance(result, bool):
+        return int(result)
+    elif isinstance(result, dict):
+        # a single match
+        return 1
+    elif isinstance(result, list):
+        return sum(result_size(r) for r in result)
+    else:
+        # tables
+        return len(result)
@@ -6,11 +6,9 @@ if sys.version_info >= (3, 8):
 else:
     from typing_extensions import Literal
 
-from catsHTM.script import get_CatDir, params
-from pydantic import BaseModel, Field, validator
+from pydantic import BaseModel, Field, root_validator, validator
 
-from .mongo import get_catq
-from .settings import settings
+from .registry import registry
 
 
 class CatalogQueryItem(BaseModel):
@@ -20,6 +18,11 @@ class CatalogQueryItem(BaseModel):
         None,
         description="Fields from catalog record to include in result. If null, return the entire record.",
     )
+    timeout_s: Optional[float] = Field(
+        None,
+        gt=0,
+        description="Time limit for searching this catalog in seconds. If exceeded, the result for this catalog is null, and its index is listed in the X-Timed-Out-Catalogs response header.",
+    )
 
 
 class ExtcatsQueryItem(CatalogQueryItem):
@@ -33,7 +36,7 @@ class ExtcatsQueryItem(CatalogQueryItem):
 
     @validator("name")
     def check_name(cls, value):
-        if (catq := get_catq(value)) is None:
+        if not registry.has_extcats(value):
             raise ValueError(f"Unknown extcats catalog '{value}'")
         return value
 
@@ -43,13 +46,7 @@ class CatsHTMQueryItem(CatalogQueryItem):
 
     @validator("name")
     def check_name(cls, value):
-
-        try:
-            if not (
-                settings.catshtm_dir / get_CatDir(value) / (params.ColCelFile % value)
-            ).exists():
-                raise FileNotFoundError
-        except:
+        if not registry.has_catshtm(value):
             raise ValueError(f"Unknown catsHTM catalog '{value}'")
         return value
 
@@ -67,6 +64,57 @@ class ConeSearchRequest(BaseModel):
         ..., description="Declination (J2000) of field center in degrees"
     )
     catalogs: Sequence[Union[ExtcatsQueryItem, CatsHTMQueryItem]]
+    timeout_s: Optional[float] = Field(
+        None,
+        gt=0,
+        description="Time limit for the search in seconds. Catalogs not searched in time are reported as for the timeout_s of each catalog.",
+    )
+    max_results: Optional[int] = Field(
+        None,
+        gt=0,
+        description="Maximum number of sources returned per catalog (and position) by /all. The nearest sources are kept, and the indices of truncated catalogs are listed in the X-Truncated-Catalogs response header.",
+    )
+
+
+class PositionList(BaseModel):
+    ra_deg: List[float] = Field(
+        ..., description="Right ascensions (J2000) of field centers in degrees"
+    )
+    dec_deg: List[float] = Field(
+        ..., description="Declinations (J2000) of field centers in degrees"
+    )
+
+    @root_validator(skip_on_failure=True)
+    def check_lengths(cls, values):
+        if len(values["ra_deg"]) != len(values["dec_deg"]):
+            raise ValueError("ra_deg and dec_deg must have the same length")
+        return values
+
+
+class BatchConeSearchRequest(PositionList):
+    catalogs: Sequence[Union[ExtcatsQueryItem, CatsHTMQueryItem]]
+    timeout_s: Optional[float] = Field(
+        None,
+        gt=0,
+        description="Time limit for the search in seconds. Catalogs not searched in time are reported as for the timeout_s of each catalog.",
+    )
+    max_results: Optional[int] = Field(
+        None,
+        gt=0,
+        description="Maximum number of sources returned per catalog (and position) by /all. The nearest sources are kept, and the indices of truncated catalogs are listed in the X-Truncated-Catalogs response header.",
+    )
+
+
+class CrossmatchRequest(PositionList):
+    catalog: Union[ExtcatsQueryItem, CatsHTMQueryItem]
+    all: bool = Field(
+        False,
+        description="Return all sources in the search radius rather than only the nearest",
+    )
+
+
+class NameLookupRequest(BaseModel):
+    names: List[str] = Field(..., description="Names of catalog sources")
 
 
 class CatalogField(BaseModel):
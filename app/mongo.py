@@ -1,24 +1,372 @@
 import logging
+import math
+import threading
+import time
 from functools import lru_cache
-from typing import Optional
+from itertools import islice
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional, Tuple
 
-from extcats.CatalogQuery import CatalogQuery
+import numpy as np
 from pymongo import MongoClient
+from pymongo.errors import OperationFailure
+from pymongo.monitoring import ConnectionPoolListener
 
+from . import metrics
+from .metrics import stage
 from .settings import settings
+from .spherical import separation, to_arcsec
+
+if TYPE_CHECKING:
+    # extcats pulls in healpy and astropy; import it on first use
+    from extcats.CatalogQuery import CatalogQuery
 
 log = logging.getLogger(__name__)
-mongo_db = MongoClient(settings.mongo_uri)
+# connected on first use, so that importing the app does not wait for Mongo
+mongo_db: Optional[MongoClient] = None
+_mongo_lock = threading.Lock()
+
+# healpix cells (or merged cell ranges) per bulk query
+MAX_CELLS_PER_QUERY = 1000
+
+
+class PoolMetrics(ConnectionPoolListener):
+    """
+    Record connection pool usage in app.metrics
+    """
+
+    def __init__(self) -> None:
+        # checkouts start and end in the same thread
+        self._local = threading.local()
+
+    @staticmethod
+    def _address(event) -> str:
+        return "%s:%s" % event.address
+
+    def _waited(self, event) -> float:
+        # pymongo >= 4.7 reports the duration itself
+        if (duration := getattr(event, "duration", None)) is None:
+            duration = time.perf_counter() - getattr(
+                self._local, "start", time.perf_counter()
+            )
+        return duration
+
+    def pool_created(self, event) -> None:
+        pass
+
+    def pool_ready(self, event) -> None:
+        pass
+
+    def pool_cleared(self, event) -> None:
+        pass
+
+    def pool_closed(self, event) -> None:
+        pass
+
+    def connection_created(self, event) -> None:
+        metrics.mongo_connections.inc(address=self._address(event))
+
+    def connection_ready(self, event) -> None:
+        pass
+
+    def connection_closed(self, event) -> None:
+        metrics.mongo_connections.dec(address=self._address(event))
+
+    def connection_check_out_started(self, event) -> None:
+        self._local.start = time.perf_counter()
+
+    def connection_check_out_failed(self, event) -> None:
+        address = self._address(event)
+        metrics.mongo_checkout_seconds.observe(self._waited(event), address=address)
+        metrics.mongo_checkout_failures.inc(address=address, reason=event.reason)
+
+    def connection_checked_out(self, event) -> None:
+        address = self._address(event)
+        metrics.mongo_checkout_seconds.observe(self._waited(event), address=address)
+        metrics.mongo_checkouts.inc(address=address)
+        metrics.mongo_connections_in_use.inc(address=address)
+
+    def connection_checked_in(self, event) -> None:
+        metrics.mongo_connections_in_use.dec(address=self._address(event))
+
+
+def client_options() -> Dict[str, Any]:
+    """
+    MongoClient options from settings. These take precedence over the same
+    options in settings.mongo_uri.
+    """
+    options: Dict[str, Any] = {
+        "maxPoolSize": settings.mongo_max_pool_size,
+        "minPoolSize": settings.mongo_min_pool_size,
+        "readPreference": settings.mongo_read_preference,
+        "event_listeners": [PoolMetrics()],
+    }
+    if settings.mongo_wait_queue_timeout_ms is not None:
+        options["waitQueueTimeoutMS"] = settings.mongo_wait_queue_timeout_ms
+    if settings.mongo_max_time_ms is not None:
+        # applies to every operation, including those issued by extcats, and
+        # is sent to the server as maxTimeMS
+        options["timeoutMS"] = settings.mongo_max_time_ms
+    return options
 
 
 def get_mongo() -> MongoClient:
+    global mongo_db
+    if mongo_db is None:
+        with _mongo_lock:
+            if mongo_db is None:
+                mongo_db = MongoClient(settings.mongo_uri, **client_options())
     return mongo_db
 
 
+def close_mongo() -> None:
+    """
+    Disconnect from Mongo, and drop the handles that refer to the connection.
+    The next use connects anew.
+    """
+    global mongo_db
+    with _mongo_lock:
+        client, mongo_db = mongo_db, None
+    get_catq.cache_clear()
+    has_name_index.cache_clear()
+    if client is not None:
+        client.close()
+
+
 @lru_cache(maxsize=128)
-def get_catq(name: str) -> Optional[CatalogQuery]:
+def get_catq(name: str) -> Optional["CatalogQuery"]:
+    from extcats.CatalogQuery import CatalogQuery
+
     try:
         return CatalogQuery(name, dbclient=get_mongo())
     except:
         log.exception(f"{name} is not a valid extcats catalog")
         return None
+
+
+@lru_cache(maxsize=128)
+def has_name_index(name: str) -> bool:
+    """
+    Whether the sources of a catalog are indexed by name
+    """
+    try:
+        indexes = get_mongo()[name].get_collection("srcs").index_information()
+    except OperationFailure:
+        # unauthorized, or no such collection
+        return False
+    return any("name" in dict(idx["key"]) for idx in indexes.values())
+
+
+def cone_filter(
+    catq: "CatalogQuery", ra: float, dec: float, rs_arcsec: float
+) -> Optional[Dict[str, Any]]:
+    """
+    Index query for sources in (or, for healpix, around) a cone, using the
+    same index as CatalogQuery.findwithin. Returns None for catalogs without
+    a usable index.
+    """
+    if catq.default_method == "2dsphere":
+        return {
+            catq.s2d_key: {
+                "$geoWithin": {
+                    "$centerSphere": [
+                        [ra - 360 if ra > 180 else ra, dec],
+                        math.radians(rs_arcsec / 3600),
+                    ]
+                }
+            }
+        }
+    elif catq.default_method == "healpix":
+        from healpy import ang2vec, query_disc
+
+        pixels = query_disc(
+            2 ** catq.hp_order,
+            ang2vec(ra, dec, lonlat=True),
+            math.radians(rs_arcsec / 3600),
+            inclusive=True,
+            nest=catq.hp_nest,
+        )
+        return {catq.hp_key: {"$in": pixels.tolist()}}
+    else:
+        return None
+
+
+def document_position(catq: "CatalogQuery", doc: Dict[str, Any]) -> Tuple[float, float]:
+    if catq.ra_key in doc and catq.dec_key in doc:
+        return doc[catq.ra_key], doc[catq.dec_key]
+    else:
+        return tuple(doc[catq.s2d_key]["coordinates"])  # type: ignore[return-value]
+
+
+def iter_within(
+    catq: "CatalogQuery",
+    ra: float,
+    dec: float,
+    rs_arcsec: float,
+    projection: Dict[str, Any],
+    pre_filter: Optional[Dict[str, Any]] = None,
+    post_filter: Optional[Dict[str, Any]] = None,
+    batch_size: int = 1000,
+) -> Iterator[Tuple[Dict[str, Any], float]]:
+    """
+    Iterate over (document, distance in arcsec) for sources within
+    rs_arcsec of ra, dec (degrees), reading the cursor in batches
+    """
+    from extcats.catquery_utils import filters_logical_and
+
+    docs: Iterator[Dict[str, Any]]
+    if (index_filter := cone_filter(catq, ra, dec, rs_arcsec)) is None:
+        # no index to build a cursor from; take the table from extcats
+        with stage("mongo_query"):
+            table = catq.findwithin(
+                ra,
+                dec,
+                rs_arcsec,
+                projection=projection,
+                pre_filter=pre_filter,
+                post_filter=post_filter,
+            )
+        docs = iter(
+            []
+            if table is None
+            else [dict(zip(table.keys(), row)) for row in table.iterrows()]
+        )
+    else:
+        docs = catq.src_coll.find(
+            filters_logical_and(pre_filter, index_filter, post_filter),
+            projection,
+            batch_size=batch_size,
+        )
+    while True:
+        with stage("mongo_query"):
+            if not (batch := list(islice(docs, batch_size))):
+                break
+        with stage("distance"):
+            positions = np.radians([document_position(catq, doc) for doc in batch])
+            dists = to_arcsec(
+                separation(
+                    math.radians(ra),
+                    math.radians(dec),
+                    positions[:, 0],
+                    positions[:, 1],
+                )
+            )
+        for doc, dist in zip(batch, dists):
+            if dist <= rs_arcsec:
+                yield doc, dist
+
+
+def disc_cells(
+    catq: "CatalogQuery", ra: np.ndarray, dec: np.ndarray, rs_arcsec: float
+) -> Tuple[np.ndarray, np.ndarray, int]:
+    """
+    Find the healpix cells that overlap the cone around each position (degrees)
+
+    For nested catalogs, the cells are of the coarsest order whose resolution
+    is still no larger than the search radius, so that each covers a
+    contiguous range of 4**shift catalog pixels.
+
+    :returns: position and cell of each (position, cell) pair, and shift
+    """
+    from healpy import ang2vec, nside2resol, query_disc
+
+    radius = math.radians(rs_arcsec / 3600)
+    order = catq.hp_order
+    if catq.hp_nest:
+        while order > 0 and nside2resol(2 ** (order - 1)) <= radius:
+            order -= 1
+    cells = [
+        query_disc(2 ** order, vec, radius, inclusive=True, nest=catq.hp_nest)
+        for vec in ang2vec(ra, dec, lonlat=True).reshape(-1, 3)
+    ]
+    pos = np.repeat(np.arange(len(cells)), [len(c) for c in cells])
+    return (
+        pos,
+        np.concatenate([np.empty(0, dtype=np.int64)] + cells),
+        catq.hp_order - order,
+    )
+
+
+def cells_filter(catq: "CatalogQuery", cells: np.ndarray, shift: int) -> Dict[str, Any]:
+    """
+    Index query for sources in the given (sorted, unique) cells
+    """
+    if shift == 0:
+        return {catq.hp_key: {"$in": cells.tolist()}}
+    # merge runs of consecutive cells into pixel ranges
+    breaks = np.flatnonzero(np.diff(cells) != 1) + 1
+    starts = np.concatenate([cells[:1], cells[breaks]])
+    stops = np.concatenate([cells[breaks - 1], cells[-1:]]) + 1
+    return {
+        "$or": [
+            {catq.hp_key: {"$gte": int(lo << 2 * shift), "$lt": int(hi << 2 * shift)}}
+            for lo, hi in zip(starts, stops)
+        ]
+    }
+
+
+def find_within_batch(
+    catq: "CatalogQuery",
+    ra: np.ndarray,
+    dec: np.ndarray,
+    rs_arcsec: float,
+    projection: Dict[str, Any],
+    pre_filter: Optional[Dict[str, Any]] = None,
+    post_filter: Optional[Dict[str, Any]] = None,
+) -> Optional[Tuple[List[Dict[str, Any]], np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    Find sources within rs_arcsec of many positions (degrees) with a few bulk
+    queries over the healpix index, rather than one query per position
+
+    :returns: the documents found, and the position, document and distance
+        in arcsec of each match, sorted by position and document. None if
+        the catalog is not queried by healpix index.
+    """
+    if catq.default_method != "healpix":
+        return None
+    from extcats.catquery_utils import filters_logical_and
+
+    pos, cells, shift = disc_cells(catq, ra, dec, rs_arcsec)
+    if any(v for k, v in projection.items() if k != "_id"):
+        # the cell of each document is needed to assign it to positions
+        projection = {**projection, catq.hp_key: 1}
+    uniq = np.unique(cells)
+    docs: List[Dict[str, Any]] = []
+    for start in range(0, len(uniq), MAX_CELLS_PER_QUERY):
+        index_filter = cells_filter(
+            catq, uniq[start : start + MAX_CELLS_PER_QUERY], shift
+        )
+        with stage("mongo_query"):
+            docs.extend(
+                catq.src_coll.find(
+                    filters_logical_and(pre_filter, index_filter, post_filter),
+                    projection,
+                )
+            )
+    # join (position, cell) pairs with the documents in each cell
+    doc_cells = np.array([doc[catq.hp_key] for doc in docs], dtype=np.int64) >> (
+        2 * shift
+    )
+    doc_order = np.argsort(doc_cells, kind="stable")
+    starts = np.searchsorted(doc_cells[doc_order], cells, side="left")
+    sizes = np.searchsorted(doc_cells[doc_order], cells, side="right") - starts
+    pair_pos = np.repeat(pos, sizes)
+    pair_doc = doc_order[
+        np.repeat(starts - (np.cumsum(sizes) - sizes), sizes) + np.arange(sizes.sum())
+    ]
+    # then apply the distance cut to all pairs at once
+    with stage("distance"):
+        positions = np.radians(
+            np.reshape([document_position(catq, doc) for doc in docs], (-1, 2))
+        )
+        dists = to_arcsec(
+            separation(
+                np.radians(ra)[pair_pos],
+                np.radians(dec)[pair_pos],
+                positions[pair_doc, 0],
+                positions[pair_doc, 1],
+            )
+        )
+    keep = dists <= rs_arcsec
+    pair_pos, pair_doc, dists = pair_pos[keep], pair_doc[keep], dists[keep]
+    order = np.lexsort((pair_doc, pair_pos))
+    return docs, pair_pos[order], pair_doc[order], dists[order]
@@ -0,0 +1,48 @@
+"""
+Shared catalog state for preforked worker processes
+
+preload() runs in a parent process (e.g. the gunicorn arbiter, see
+app/gunicorn_conf.py) after the application has been imported, and before
+any worker is forked. It builds the catalog registry and descriptions, opens
+every catalog (reading the HTM index of each catsHTM catalog), and imports
+the backends, so that workers inherit all of it copy-on-write instead of
+building it once per process.
+
+Connections are not shared: the parent disconnects from Mongo before
+forking, and after_fork() drops whatever else a worker must not use from
+its parent. Each worker reconnects to Mongo when its startup handler
+refreshes the registry.
+"""
+
+import gc
+import logging
+import time
+
+from . import admission, metrics, result_cache
+from .catalogs import catalog_descriptions
+from .mongo import close_mongo
+from .registry import registry
+from .warmup import warm_up
+
+log = logging.getLogger(__name__)
+
+
+def preload() -> None:
+    start = time.perf_counter()
+    registry.refresh()
+    catalog_descriptions.refresh()
+    warm_up()
+    # MongoClient is not fork-safe
+    close_mongo()
+    # samples recorded while warming up belong to no worker
+    metrics.reset()
+    # keep the collector from touching (and so copying) inherited objects
+    gc.freeze()
+    log.info(f"Preloaded catalogs in {time.perf_counter() - start:.1f} s")
+
+
+def after_fork() -> None:
+    if isinstance(cache := result_cache.result_cache, result_cache.SQLiteCache):
+        cache.reconnect()
+    result_cache.extcats_version.cache_clear()
+    admission.extcats_density.cache_clear()
@@ -0,0 +1,168 @@
+"""
+In-memory index of the available catalogs
+
+Validating a request only consults this index, so request parsing costs no
+filesystem or database access. The index is built at startup, and rebuilt
+every settings.catalog_refresh_interval seconds or on SIGHUP, so that catalogs
+added (or replaced) in the meantime are picked up without a restart.
+"""
+
+import asyncio
+import logging
+import signal
+import threading
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Dict, Optional
+
+from starlette.concurrency import run_in_threadpool
+
+from .catshtm import get_catshtm, trixel_cache
+from .mongo import get_catq, get_mongo, has_name_index
+from .settings import settings
+
+if TYPE_CHECKING:
+    from extcats.CatalogQuery import CatalogQuery
+
+log = logging.getLogger(__name__)
+
+
+def find_catshtm_catalogs(catalogs_dir: Optional[Path]) -> Dict[str, Path]:
+    """
+    Find catsHTM catalogs by their ColCell files
+
+    :returns: the HTM index file of each catalog, by name
+    """
+    catalogs: Dict[str, Path] = {}
+    if catalogs_dir is None:
+        return catalogs
+    from catsHTM import params
+    from catsHTM.script import get_CatDir
+
+    suffix = params.ColCelFile % ""
+    for colcell in Path(catalogs_dir).glob(f"**/*{suffix}"):
+        name = colcell.name[: -len(suffix)]
+        try:
+            catalog_dir = Path(catalogs_dir) / get_CatDir(name)
+        except ValueError:
+            continue
+        # catsHTM only looks for catalogs in their canonical directory
+        if colcell.parent == catalog_dir:
+            catalogs[name] = catalog_dir / (params.IndexFileTemplate % name)
+    return catalogs
+
+
+def find_extcats_catalogs() -> Dict[str, "CatalogQuery"]:
+    catalogs: Dict[str, "CatalogQuery"] = {}
+    mongo = get_mongo()
+    for db in mongo.list_database_names():
+        if db in {"local", "config", "admin"} or not {"meta", "srcs"}.issubset(
+            mongo[db].list_collection_names()
+        ):
+            continue
+        if (catq := get_catq(db)) is not None:
+            catalogs[db] = catq
+    return catalogs
+
+
+class CatalogRegistry:
+    def __init__(self) -> None:
+        self.catshtm: Dict[str, Path] = {}
+        self.extcats: Dict[str, "CatalogQuery"] = {}
+        self._versions: Dict[str, int] = {}
+        self.refreshed: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def _refresh_catshtm(self) -> None:
+        try:
+            catshtm = find_catshtm_catalogs(settings.catshtm_dir)
+            versions = {name: path.stat().st_mtime_ns for name, path in catshtm.items()}
+        except Exception:
+            log.exception("Failed to list catsHTM catalogs")
+            return
+        # catalogs that were replaced or removed on disk
+        if stale := [
+            name
+            for name, version in self._versions.items()
+            if versions.get(name) != version
+        ]:
+            get_catshtm.cache_clear()
+            for name in stale:
+                trixel_cache.discard(name)
+        self.catshtm, self._versions = catshtm, versions
+
+    def _refresh_extcats(self) -> None:
+        # pick up changes to extcats metadata
+        get_catq.cache_clear()
+        has_name_index.cache_clear()
+        try:
+            self.extcats = find_extcats_catalogs()
+        except Exception:
+            log.exception("Failed to list extcats catalogs")
+
+    def refresh(self) -> None:
+        """
+        Rescan catalogs. If a backend can not be reached, its previous
+        entries are kept.
+        """
+        with self._lock:
+            self._refresh_catshtm()
+            self._refresh_extcats()
+            self.refreshed = time.time()
+        log.info(
+            f"Found {len(self.catshtm)} catsHTM and {len(self.extcats)} extcats catalogs"
+        )
+
+    def invalidate(self) -> None:
+        """
+        Forget all catalogs, and rescan on next use
+        """
+        with self._lock:
+            self.catshtm, self.extcats, self._versions = {}, {}, {}
+            self.refreshed = None
+
+    def ensure(self) -> None:
+        """
+        Scan catalogs if that has not been done yet. This blocks on the
+        filesystem and Mongo, and so must not be called on the event loop.
+        """
+        if self.refreshed is None:
+            self.refresh()
+
+    # NB: lookups only consult the index, as they run while parsing requests
+    # on the event loop. The index is built at startup, before any request
+    # is served.
+
+    def has_catshtm(self, name: str) -> bool:
+        return name in self.catshtm
+
+    def has_extcats(self, name: str) -> bool:
+        return name in self.extcats
+
+
+registry = CatalogRegistry()
+
+
+async def refresh_periodically(refresh: Callable[[], None], interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        await run_in_threadpool(refresh)
+
+
+def install_refresh_handlers(refresh: Callable[[], None] = registry.refresh) -> None:
+    """
+    Call refresh (in the threadpool) on a timer and on SIGHUP
+    """
+    loop = asyncio.get_event_loop()
+    if settings.catalog_refresh_interval > 0:
+        loop.create_task(
+            refresh_periodically(refresh, settings.catalog_refresh_interval)
+        )
+    try:
+        loop.add_signal_handler(
+            signal.SIGHUP,
+            lambda: loop.create_task(run_in_threadpool(refresh)),
+        )
+    except (NotImplementedError, RuntimeError, ValueError):
+        # not in the main thread, or not on a POSIX platform
+        log.warning("Cannot refresh catalog registry on SIGHUP")
@@ -0,0 +1,306 @@
+"""
+Cache of single-position cone search results
+
+Keys combine the search, the catalog and its version, the search position
+quantized to settings.result_cache_quantum_arcsec, and the remaining search
+parameters, so that repeated alerts at (nearly) the same position reuse the
+result of the first search. Entries expire after settings.result_cache_ttl
+seconds, and the least recently used entries are evicted beyond
+settings.result_cache_size (and, in memory, settings.result_cache_bytes).
+
+By default the cache lives in process memory. Set RESULT_CACHE_PATH to share
+it between worker processes via an SQLite database.
+"""
+
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache, singledispatch
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, Dict, Hashable, Optional, Tuple, Union
+
+import orjson
+from astropy.coordinates import SkyCoord
+
+from . import metrics
+from .catshtm import get_catshtm
+from .models import CatsHTMQueryItem, ExtcatsQueryItem
+from .mongo import get_catq
+from .settings import Settings, settings
+
+if TYPE_CHECKING:
+    from extcats.CatalogQuery import CatalogQuery
+
+log = logging.getLogger(__name__)
+
+# sentinel for cache misses, as None is a valid search result
+MISSING = object()
+
+
+class MemoryCache:
+    """
+    Thread-safe LRU cache with per-entry expiry, bounded by the number of
+    entries and by their total size, as approximated by the length of their
+    JSON encoding
+    """
+
+    def __init__(self, ttl: float, max_entries: int, max_bytes: Optional[int] = None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # expiry, size, value
+        self._entries: "OrderedDict[Hashable, Tuple[float, int, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Any:
+        with self._lock:
+            if (entry := self._entries.get(key)) is None or entry[0] < time.time():
+                self.misses += 1
+                return MISSING
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[2]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        size = len(orjson.dumps(value))
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        with self._lock:
+            if (old := self._entries.pop(key, None)) is not None:
+                self.nbytes -= old[1]
+            self._entries[key] = (time.time() + self.ttl, size, value)
+            self.nbytes += size
+            while len(self._entries) > self.max_entries or (
+                self.max_bytes is not None and self.nbytes > self.max_bytes
+            ):
+                _, (_, evicted, _) = self._entries.popitem(last=False)
+                self.nbytes -= evicted
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self) -> Dict[str, Optional[int]]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+        }
+
+
+class SQLiteCache:
+    """
+    Cache shared between processes through an SQLite database. Values are
+    stored as JSON.
+    """
+
+    # trim the database every this many writes
+    trim_interval = 1000
+
+    def __init__(self, path: Path, ttl: float, max_entries: int):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS results "
+                "(key BLOB PRIMARY KEY, expires REAL, accessed REAL, value BLOB)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)"
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        # connections may not be shared between threads
+        if (conn := getattr(self._local, "conn", None)) is None:
+            conn = self._local.conn = sqlite3.connect(
+                self.path, timeout=1, isolation_level=None
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def reconnect(self) -> None:
+        """
+        Forget connections inherited from a parent process
+        """
+        self._local = threading.local()
+
+    def __len__(self) -> int:
+        return self._connection().execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def get(self, key: bytes) -> Any:
+        now = time.time()
+        conn = self._connection()
+        row = conn.execute(
+            "SELECT value FROM results WHERE key = ? AND expires >= ?", (key, now)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return MISSING
+        self.hits += 1
+        conn.execute("UPDATE results SET accessed = ? WHERE key = ?", (now, key))
+        return orjson.loads(row[0])
+
+    def put(self, key: bytes, value: Any) -> None:
+        now = time.time()
+        conn = self._connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+            (key, now + self.ttl, now, orjson.dumps(value)),
+        )
+        self._writes += 1
+        if self._writes % self.trim_interval == 0:
+            self.trim()
+
+    def trim(self) -> None:
+        """
+        Drop expired entries, and the least recently used beyond max_entries
+        """
+        conn = self._connection()
+        conn.execute("DELETE FROM results WHERE expires < ?", (time.time(),))
+        conn.execute(
+            "DELETE FROM results WHERE key IN "
+            "(SELECT key FROM results ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+
+    def clear(self) -> None:
+        self._connection().execute("DELETE FROM results")
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self),
+            "max_entries": self.max_entries,
+        }
+
+
+ResultCache = Union[MemoryCache, SQLiteCache]
+
+
+def make_cache(settings: Settings) -> Optional[ResultCache]:
+    if settings.result_cache_ttl <= 0 or settings.result_cache_size <= 0:
+        return None
+    elif settings.result_cache_path is not None:
+        return SQLiteCache(
+            settings.result_cache_path,
+            settings.result_cache_ttl,
+            settings.result_cache_size,
+        )
+    else:
+        return MemoryCache(
+            settings.result_cache_ttl,
+            settings.result_cache_size,
+            settings.result_cache_bytes,
+        )
+
+
+result_cache = make_cache(settings)
+metrics.register_cache("result", lambda: result_cache)
+
+
+@lru_cache(maxsize=128)
+def extcats_version(catq: "CatalogQuery") -> str:
+    # catalogs are read-only; a reloaded catalog changes size or ObjectIds
+    last = catq.src_coll.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+    return f"{catq.src_coll.estimated_document_count()}:{last and last['_id']}"
+
+
+@singledispatch
+def catalog_version(item) -> str:
+    """
+    Identify the contents of a catalog, so that cached results are not
+    reused once the catalog has been replaced
+    """
+    raise NotImplementedError
+
+
+@catalog_version.register  # type: ignore[no-redef]
+def _(item: CatsHTMQueryItem) -> str:
+    return get_catshtm(item.name, settings.catshtm_dir).version
+
+
+@catalog_version.register  # type: ignore[no-redef]
+def _(item: ExtcatsQueryItem) -> str:
+    if (catq := get_catq(item.name)) is None:
+        raise ValueError(f"{item.name} is not a valid extcats catalog")
+    return extcats_version(catq)
+
+
+def cache_key(
+    method: str, item: Union[ExtcatsQueryItem, CatsHTMQueryItem], coord: SkyCoord
+) -> bytes:
+    quantum = settings.result_cache_quantum_arcsec / 3600
+    return hashlib.blake2b(
+        orjson.dumps(
+            [
+                method,
+                item.use,
+                item.name,
+                catalog_version(item),
+                round(coord.ra.deg / quantum),
+                round(coord.dec.deg / quantum),
+                item.rs_arcsec,
+                None if item.keys_to_append is None else sorted(item.keys_to_append),
+                getattr(item, "pre_filter", None),
+                getattr(item, "post_filter", None),
+            ],
+            option=orjson.OPT_SORT_KEYS,
+        ),
+        digest_size=16,
+    ).digest()
+
+
+def cache_error(operation: str, exc: Exception) -> None:
+    metrics.cache_errors.inc(cache="result", operation=operation)
+    log.warning(f"Failed to {operation} result cache: {exc}")
+
+
+def cached_search(
+    search_item: Callable[..., Any],
+    method: str,
+    item: Union[ExtcatsQueryItem, CatsHTMQueryItem],
+    coord: SkyCoord,
+) -> Any:
+    """
+    Apply a single-position search through the result cache. The cache
+    fails open: if it can not be read (e.g. the SQLite database is locked by
+    other workers), the search runs uncached.
+    """
+    if (cache := result_cache) is None:
+        return search_item(item, coord)
+    key = cache_key(method, item, coord)
+    try:
+        result = cache.get(key)
+    except sqlite3.Error as exc:
+        cache_error("read", exc)
+        return search_item(item, coord)
+    if result is MISSING:
+        result = search_item(item, coord)
+        try:
+            cache.put(key, result)
+        except sqlite3.Error as exc:
+            cache_error("write", exc)
+    return result
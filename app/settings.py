@@ -1,3 +1,4 @@
+from pathlib import Path
 from typing import Optional, TYPE_CHECKING
 
 from pydantic import (
@@ -21,7 +22,112 @@ class Settings(BaseSettings):
     app_url: AnyHttpUrl = Field("http://127.0.0.1:8080", env="APP_URL")
     root_path: str = Field("", env="ROOT_PATH")
     mongo_uri: Optional[MongoUrl] = Field("mongodb://localhost:27018", env="MONGO_URI")
+    mongo_max_pool_size: int = Field(
+        100,
+        env="MONGO_MAX_POOL_SIZE",
+        description="Maximum number of connections per MongoDB server",
+    )
+    mongo_min_pool_size: int = Field(
+        0,
+        env="MONGO_MIN_POOL_SIZE",
+        description="Number of connections per MongoDB server to keep open",
+    )
+    mongo_wait_queue_timeout_ms: Optional[int] = Field(
+        None,
+        env="MONGO_WAIT_QUEUE_TIMEOUT_MS",
+        description="Milliseconds to wait for a free connection before failing",
+    )
+    mongo_read_preference: str = Field(
+        "secondaryPreferred",
+        env="MONGO_READ_PREFERENCE",
+        description="Replica set members to read from",
+    )
+    mongo_max_time_ms: Optional[int] = Field(
+        None,
+        env="MONGO_MAX_TIME_MS",
+        description="Time limit for each MongoDB query in milliseconds",
+    )
     catshtm_dir: Optional[DirectoryPath] = Field(None, env="CATSHTM_DIR")
+    catshtm_cache_bytes: int = Field(
+        256 * 2 ** 20,
+        env="CATSHTM_CACHE_BYTES",
+        description="Memory budget for decoded catsHTM trixels (0 to disable)",
+    )
+    max_parallelism: int = Field(
+        8,
+        env="MAX_PARALLELISM",
+        description="Maximum number of catalogs searched concurrently per request",
+    )
+    search_timeout: Optional[float] = Field(
+        None,
+        env="SEARCH_TIMEOUT",
+        description="Default time limit for cone searches in seconds",
+    )
+    catalog_timeout: Optional[float] = Field(
+        None,
+        env="CATALOG_TIMEOUT",
+        description="Default time limit for searching each catalog in seconds",
+    )
+    max_results: Optional[int] = Field(
+        None,
+        env="MAX_RESULTS",
+        description="Maximum number of sources returned per catalog and position by /all",
+    )
+    expensive_search_cost: float = Field(
+        100000,
+        env="EXPENSIVE_SEARCH_COST",
+        description="Estimated number of sources read above which a search is expensive",
+    )
+    max_cheap_searches: int = Field(
+        0,
+        env="MAX_CHEAP_SEARCHES",
+        description="Maximum number of concurrent cheap searches (0 for no limit)",
+    )
+    max_expensive_searches: int = Field(
+        0,
+        env="MAX_EXPENSIVE_SEARCHES",
+        description="Maximum number of concurrent expensive searches (0 for no limit)",
+    )
+    result_cache_ttl: float = Field(
+        3600,
+        env="RESULT_CACHE_TTL",
+        description="Lifetime of cached cone search results in seconds (0 to disable)",
+    )
+    result_cache_size: int = Field(
+        100000,
+        env="RESULT_CACHE_SIZE",
+        description="Maximum number of cached cone search results",
+    )
+    result_cache_bytes: int = Field(
+        64 * 2 ** 20,
+        env="RESULT_CACHE_BYTES",
+        description="Memory budget for cached cone search results, per process",
+    )
+    result_cache_quantum_arcsec: float = Field(
+        0.1,
+        env="RESULT_CACHE_QUANTUM_ARCSEC",
+        description="Positions are rounded to this grid (in arcsec) in cache keys, so searches this close together may share results",
+    )
+    result_cache_path: Optional[Path] = Field(
+        None,
+        env="RESULT_CACHE_PATH",
+        description="SQLite database to share the result cache between processes",
+    )
+    catalog_refresh_interval: float = Field(
+        600,
+        env="CATALOG_REFRESH_INTERVAL",
+        description="Seconds between rescans of available catalogs (0 to disable)",
+    )
+    catalog_snapshot_path: Optional[Path] = Field(
+        None,
+        env="CATALOG_SNAPSHOT_PATH",
+        description="JSON file in which to persist the catalog listing between restarts",
+    )
+    warm_up: bool = Field(
+        False,
+        env="WARM_UP",
+        description="Open all catalogs and search each once before serving requests",
+    )
 
     class Config:
         env_file = ".env"
@@ -0,0 +1,64 @@
+"""
+Vectorized spherical geometry on plain arrays of angles in radians
+"""
+
+from typing import Optional, Tuple, Union
+
+import numpy as np
+
+ArrayLike = Union[float, np.ndarray]
+
+
+def separation(
+    lon1: ArrayLike, lat1: ArrayLike, lon2: ArrayLike, lat2: ArrayLike
+) -> np.ndarray:
+    """
+    Angular separation between points, with the Vincenty formula used by
+    astropy's SkyCoord.separation(), which is accurate at all distances
+    """
+    sdlon = np.sin(lon2 - lon1)
+    cdlon = np.cos(lon2 - lon1)
+    slat1, clat1 = np.sin(lat1), np.cos(lat1)
+    slat2, clat2 = np.sin(lat2), np.cos(lat2)
+    num1 = clat2 * sdlon
+    num2 = clat1 * slat2 - slat1 * clat2 * cdlon
+    denominator = slat1 * slat2 + clat1 * clat2 * cdlon
+    return np.arctan2(np.hypot(num1, num2), denominator)
+
+
+def to_arcsec(angle: ArrayLike) -> np.ndarray:
+    return np.degrees(angle) * 3600
+
+
+def nearest(
+    lon: np.ndarray, lat: np.ndarray, lon0: float, lat0: float
+) -> Tuple[Optional[int], Optional[float]]:
+    """
+    Find the point closest to (lon0, lat0)
+
+    :returns: index of the point and its separation, or (None, None) if
+        there are no points
+    """
+    if not len(lon):
+        return None, None
+    dist = separation(lon0, lat0, lon, lat)
+    idx = int(np.argmin(dist))
+    return idx, float(dist[idx])
+
+
+def within(
+    lon: np.ndarray,
+    lat: np.ndarray,
+    lon0: ArrayLike,
+    lat0: ArrayLike,
+    radius: ArrayLike,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Find the points at most radius from (lon0, lat0). The center and radius
+    may also be arrays, one per point.
+
+    :returns: indices of the points, and their separations
+    """
+    dist = separation(lon0, lat0, lon, lat)
+    idx = np.flatnonzero(dist <= radius)
+    return idx, dist[idx]
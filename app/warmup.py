@@ -0,0 +1,41 @@
+"""
+Optional warm-up of a fresh worker process
+
+Loads the modules that are imported on first use, opens every catalog in
+the registry, and runs one small search against each, so that the first
+request to the worker does not pay for any of it.
+"""
+
+import logging
+import time
+from typing import List, Union
+
+from astropy.coordinates import SkyCoord
+
+from .cone_search import search_nearest_item
+from .models import CatsHTMQueryItem, ExtcatsQueryItem
+from .registry import registry
+
+log = logging.getLogger(__name__)
+
+
+def warm_up() -> None:
+    start = time.perf_counter()
+    registry.ensure()
+    items: List[Union[CatsHTMQueryItem, ExtcatsQueryItem]] = [
+        CatsHTMQueryItem.construct(name=name, rs_arcsec=1.0, keys_to_append=None)
+        for name in registry.catshtm
+    ]
+    items += [
+        ExtcatsQueryItem.construct(name=name, rs_arcsec=1.0, keys_to_append=None)
+        for name in registry.extcats
+    ]
+    probe = SkyCoord(0, 0, unit="deg")
+    for item in items:
+        try:
+            search_nearest_item(item, probe)
+        except Exception:
+            log.exception(f"Failed to warm up {item.use} catalog {item.name}")
+    log.info(
+        f"Warmed up {len(items)} catalogs in {time.perf_counter() - start:.1f} s"
+    )
@@ -0,0 +1,420 @@
+"""
+Benchmark cone searches end to end, and the hot paths behind them
+
+Runs offline: catsHTM searches use a synthetic catalog made by densifying
+the ROSATfsc test tile (each source is replaced by --densify jittered
+copies), and extcats searches use a densified copy of the milliquas test
+catalog in mongomock, or in the MongoDB at --mongo-uri.
+
+Requests go through the application in-process, and are timed per scenario
+(backend, method, search radius, number of catalogs per request). Each
+scenario reports latency percentiles, throughput at --concurrency requests
+in flight, and the mean number of sources returned. Microbenchmarks time
+table_to_json, sanitize_json and the catsHTM cone search on their own.
+
+Results can be saved with --output, and compared to a previous run with
+--baseline; the script exits with status 1 if any median latency grew by
+more than --tolerance.
+
+Usage: python -m benchmarks.bench_cone_search [--repeat N] [--output FILE] [--baseline FILE]
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple
+
+import h5py
+import numpy as np
+from bson import decode_all
+
+TEST_DATA = Path(__file__).parent.parent / "tests" / "test-data"
+
+# center of the ROSATfsc test tile
+CATSHTM_CENTER = (5.0, 5.0)
+RADII = {"catsHTM": [10.0, 60.0, 600.0], "extcats": [10.0, 60.0, 600.0]}
+# mongomock evaluates healpix index queries by scanning, which is too slow
+# for large radii
+MONGOMOCK_RADII = [2.0, 10.0, 30.0]
+METHODS = ["any", "nearest", "all"]
+CATALOG_COUNTS = [1, 4]
+
+
+def jitter(
+    rng: np.random.Generator,
+    lon: np.ndarray,
+    lat: np.ndarray,
+    copies: int,
+    scale: float,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Scatter copies of each position (radians) by up to scale radians
+    """
+    lon, lat = np.repeat(lon, copies), np.repeat(lat, copies)
+    dlat = rng.uniform(-scale, scale, len(lat))
+    dlon = rng.uniform(-scale, scale, len(lon)) / np.maximum(np.cos(lat), 1e-3)
+    return (lon + dlon) % (2 * np.pi), np.clip(lat + dlat, -np.pi / 2, np.pi / 2)
+
+
+def make_catshtm(dest: Path, copies: int, rng: np.random.Generator) -> Path:
+    """
+    Copy the ROSATfsc test catalog to dest, with each source replaced by
+    jittered copies
+    """
+    from catsHTM import params
+
+    catalog_dir = dest / "ROSATfsc"
+    shutil.copytree(TEST_DATA / "catsHTM2" / "ROSATfsc", catalog_dir)
+    name = "ROSATfsc"
+    counts = {}
+    for path in catalog_dir.glob(params.CatFileTemplate.replace("%06d", "*") % name):
+        with h5py.File(path, "r+") as f:
+            for key in [k for k in f.keys() if not k.endswith("_Ind")]:
+                srcs = np.asarray(f[key])
+                dense = np.repeat(srcs, copies, axis=1)
+                # trixels are degrees across, so most copies stay inside
+                dense[0], dense[1] = jitter(
+                    rng, srcs[0], srcs[1], copies, math.radians(60 / 3600)
+                )
+                del f[key]
+                f.create_dataset(key, data=dense)
+                counts[int(key.split("_")[1]) - 1] = dense.shape[1]
+    with h5py.File(catalog_dir / (params.IndexFileTemplate % name), "r+") as f:
+        index = np.asarray(f[f"{name}_HTM"])
+        for id, count in counts.items():
+            index[12, id] = count
+        f[f"{name}_HTM"][...] = index
+    return dest
+
+
+def make_extcats(mongo: Any, copies: int, rng: np.random.Generator) -> None:
+    """
+    Load the milliquas test catalog into mongo, with each source replaced by
+    jittered copies
+    """
+    from healpy import ang2pix
+
+    db = mongo.get_database("milliquas")
+    db.drop_collection("meta")
+    db.drop_collection("srcs")
+    dump = TEST_DATA / "minimongodumps" / "milliquas"
+    db.get_collection("meta").insert_many(decode_all((dump / "meta.bson").read_bytes()))
+    srcs = decode_all((dump / "srcs.bson").read_bytes())
+    ra, dec = jitter(
+        rng,
+        np.radians([s["ra"] for s in srcs]),
+        np.radians([s["dec"] for s in srcs]),
+        copies,
+        math.radians(30 / 3600),
+    )
+    ra, dec = np.degrees(ra), np.degrees(dec)
+    hpxid = ang2pix(2 ** 16, ra, dec, nest=True, lonlat=True)
+    docs = []
+    for i, (r, d, h) in enumerate(zip(ra, dec, hpxid)):
+        doc = {k: v for k, v in srcs[i // copies].items() if k != "_id"}
+        doc.update(
+            ra=float(r),
+            dec=float(d),
+            hpxid_16=int(h),
+            pos={"type": "Point", "coordinates": [float(r), float(d)]},
+        )
+        docs.append(doc)
+    db.get_collection("srcs").insert_many(docs)
+    db.get_collection("srcs").create_index("hpxid_16")
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    p50, p95, p99 = np.percentile(samples, [50, 95, 99]) * 1e3
+    return {
+        "p50_ms": float(p50),
+        "p95_ms": float(p95),
+        "p99_ms": float(p99),
+        "mean_ms": float(np.mean(samples) * 1e3),
+    }
+
+
+def count_results(body: Any) -> int:
+    if body is None or isinstance(body, bool):
+        return int(bool(body))
+    elif isinstance(body, list):
+        return sum(count_results(b) for b in body)
+    return 1
+
+
+async def run_scenario(
+    client: Any,
+    method: str,
+    catalogs: List[Dict[str, Any]],
+    sources: Tuple[np.ndarray, np.ndarray],
+    repeat: int,
+    concurrency: int,
+    rng: np.random.Generator,
+) -> Dict[str, float]:
+    # search around randomly chosen sources, so that the number of results
+    # grows with the search radius
+    idx = rng.integers(0, len(sources[0]), repeat)
+    ra, dec = jitter(
+        rng,
+        np.radians(sources[0][idx]),
+        np.radians(sources[1][idx]),
+        1,
+        math.radians(catalogs[0]["rs_arcsec"] / 3600 / 2),
+    )
+    ra, dec = np.degrees(ra), np.degrees(dec)
+    requests = [
+        {"ra_deg": float(r), "dec_deg": float(d), "catalogs": catalogs}
+        for r, d in zip(ra, dec)
+    ]
+    limit = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    results: List[int] = []
+
+    async def send(request: Dict[str, Any]) -> None:
+        async with limit:
+            start = time.perf_counter()
+            response = await client.post(f"/cone_search/{method}", json=request)
+            latencies.append(time.perf_counter() - start)
+        response.raise_for_status()
+        results.append(count_results(response.json()))
+
+    # warm up caches and code paths
+    await send(requests[0])
+    latencies.clear()
+    results.clear()
+    start = time.perf_counter()
+    await asyncio.gather(*(send(r) for r in requests))
+    elapsed = time.perf_counter() - start
+    return {
+        **percentiles(latencies),
+        "requests_per_s": repeat / elapsed,
+        "mean_results": float(np.mean(results)),
+    }
+
+
+def source_positions(
+    catalogs_dir: Path, mongo: Any
+) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+    """
+    Positions (degrees) of the sources in the benchmark catalogs
+    """
+    from app.catshtm import get_catshtm
+
+    catalog = get_catshtm("ROSATfsc", catalogs_dir)
+    (srcs,) = catalog.cone_search(
+        *(math.radians(v) for v in CATSHTM_CENTER), math.radians(20)
+    )
+    docs = list(
+        mongo.get_database("milliquas")
+        .get_collection("srcs")
+        .find({}, {"_id": 0, "ra": 1, "dec": 1})
+    )
+    return {
+        "catsHTM": (np.degrees(srcs[:, 0]), np.degrees(srcs[:, 1])),
+        "extcats": (
+            np.array([d["ra"] for d in docs]),
+            np.array([d["dec"] for d in docs]),
+        ),
+    }
+
+
+async def run_endpoints(
+    args: argparse.Namespace,
+    rng: np.random.Generator,
+    sources: Dict[str, Tuple[np.ndarray, np.ndarray]],
+) -> Dict[str, Dict[str, float]]:
+    from httpx import AsyncClient
+
+    from app.main import app
+
+    radii = {**RADII, **({} if args.mongo_uri else {"extcats": MONGOMOCK_RADII})}
+    scenarios = {}
+    async with AsyncClient(app=app, base_url="http://bench") as client:
+        for use, name in (("catsHTM", "ROSATfsc"), ("extcats", "milliquas")):
+            for method in METHODS:
+                for radius in radii[use]:
+                    for count in CATALOG_COUNTS:
+                        catalogs = [
+                            {"use": use, "name": name, "rs_arcsec": radius}
+                        ] * count
+                        key = f"{method}/{use}/r={radius:g}/n={count}"
+                        scenarios[key] = await run_scenario(
+                            client,
+                            method,
+                            catalogs,
+                            sources[use],
+                            args.repeat,
+                            args.concurrency,
+                            rng,
+                        )
+                        print(format_result(key, scenarios[key]), flush=True)
+    return scenarios
+
+
+def time_calls(func: Callable[[], Any], repeat: int) -> Dict[str, float]:
+    seconds = timeit.repeat(func, number=1, repeat=repeat)
+    return percentiles(seconds)
+
+
+def run_micro(
+    args: argparse.Namespace, catalogs_dir: Path, mongo: Any
+) -> Dict[str, Dict[str, float]]:
+    from astropy.table import Table
+
+    from app.catshtm import get_catshtm
+    from app.cone_search import sanitize_json, table_to_json
+
+    catalog = get_catshtm("ROSATfsc", catalogs_dir)
+    ra, dec = (math.radians(v) for v in CATSHTM_CENTER)
+    rng = np.random.default_rng(0)
+    many_ra = ra + rng.uniform(-0.002, 0.002, 1000)
+    many_dec = dec + rng.uniform(-0.002, 0.002, 1000)
+    radius = math.radians(600 / 3600)
+    (srcs,) = catalog.cone_search(ra, dec, math.radians(20))
+    table = Table(srcs, names=catalog.colnames)
+    docs = list(
+        mongo.get_database("milliquas").get_collection("srcs").find({}, {"_id": 0})
+    )
+    micro = {
+        f"table_to_json/rows={len(table)}": lambda: table_to_json(table, None),
+        f"sanitize_json/docs={len(docs)}": lambda: sanitize_json(docs),
+        "catshtm.cone_search/positions=1": lambda: catalog.cone_search(
+            ra, dec, radius
+        ),
+        "catshtm.cone_search/positions=1000": lambda: catalog.cone_search(
+            many_ra, many_dec, radius
+        ),
+    }
+    results = {}
+    for key, func in micro.items():
+        results[key] = time_calls(func, args.repeat)
+        print(format_result(key, results[key]), flush=True)
+    return results
+
+
+def format_result(key: str, result: Dict[str, float]) -> str:
+    line = (
+        f"{key:<40} p50 {result['p50_ms']:8.2f} ms  p95 {result['p95_ms']:8.2f} ms"
+        f"  p99 {result['p99_ms']:8.2f} ms"
+    )
+    if "requests_per_s" in result:
+        line += (
+            f"  {result['requests_per_s']:7.1f} req/s"
+            f"  {result['mean_results']:8.1f} results"
+        )
+    return line
+
+
+def compare(
+    results: Dict[str, Dict[str, float]],
+    baseline: Dict[str, Dict[str, float]],
+    tolerance: float,
+) -> List[str]:
+    """
+    :returns: descriptions of the benchmarks whose median latency grew by
+        more than the given factor
+    """
+    regressions = []
+    for key, result in results.items():
+        if (previous := baseline.get(key)) is None:
+            continue
+        if (ratio := result["p50_ms"] / previous["p50_ms"]) > tolerance:
+            regressions.append(
+                f"{key}: p50 {previous['p50_ms']:.2f} ms -> {result['p50_ms']:.2f} ms"
+                f" ({ratio:.2f}x)"
+            )
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=50, help="requests per scenario")
+    parser.add_argument(
+        "--concurrency", type=int, default=4, help="requests in flight"
+    )
+    parser.add_argument(
+        "--densify", type=int, default=20, help="copies of each test catalog source"
+    )
+    parser.add_argument("--mongo-uri", help="use this MongoDB instead of mongomock")
+    parser.add_argument("--output", type=Path, help="save results as JSON")
+    parser.add_argument("--baseline", type=Path, help="compare to saved results")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=1.25,
+        help="largest acceptable ratio of median latency to the baseline",
+    )
+    parser.add_argument(
+        "--micro-only", action="store_true", help="skip the endpoint benchmarks"
+    )
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    workdir = Path(tempfile.mkdtemp(prefix="catalogserver-bench-"))
+    try:
+        catalogs_dir = make_catshtm(workdir / "catsHTM", args.densify, rng)
+        # settings are read at import; searches should not be answered
+        # from the result cache
+        os.environ["CATSHTM_DIR"] = str(catalogs_dir)
+        os.environ["RESULT_CACHE_TTL"] = "0"
+        os.environ["CATALOG_REFRESH_INTERVAL"] = "0"
+
+        import app.mongo
+
+        if args.mongo_uri:
+            from pymongo import MongoClient
+
+            mongo = MongoClient(args.mongo_uri)
+        else:
+            import mongomock
+
+            mongo = mongomock.MongoClient()
+        make_extcats(mongo, args.densify, rng)
+        app.mongo.mongo_db = mongo
+
+        results = {"micro": run_micro(args, catalogs_dir, mongo)}
+        if not args.micro_only:
+            results["endpoints"] = asyncio.run(
+                run_endpoints(args, rng, source_positions(catalogs_dir, mongo))
+            )
+    finally:
+        shutil.rmtree(workdir)
+
+    flat = {f"{group}:{k}": v for group, r in results.items() for k, v in r.items()}
+    if args.output:
+        args.output.write_text(
+            json.dumps(
+                {
+                    "meta": {
+                        "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                        "python": platform.python_version(),
+                        "platform": platform.platform(),
+                        "numpy": np.__version__,
+                        "mongo": args.mongo_uri or "mongomock",
+                        "densify": args.densify,
+                        "repeat": args.repeat,
+                        "concurrency": args.concurrency,
+                    },
+                    "results": flat,
+                },
+                indent=2,
+            )
+        )
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text())["results"]
+        if regressions := compare(flat, baseline, args.tolerance):
+            print("Regressions:\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+        print(f"No regressions beyond {args.tolerance:g}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Compare response serialization via pydantic models with the direct ORJSON path
+
+Serializes the result of a /cone_search/all query that covers the whole
+ROSATfsc test tile, once through CatalogItem models and response_model
+validation (as FastAPI does for a returned list of models), and once as
+plain dicts rendered by ORJSONResponse.
+
+Usage: python -m benchmarks.bench_response [--repeat N]
+"""
+
+import argparse
+import json
+import math
+import timeit
+from pathlib import Path
+from typing import List, Optional
+
+from astropy.coordinates import SkyCoord
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, ORJSONResponse
+from pydantic import parse_obj_as
+
+from app.catshtm import get_catshtm
+from app.cone_search import catshtm_all
+from app.models import CatalogItem, CatsHTMQueryItem
+
+CATALOGS_DIR = Path(__file__).parent.parent / "tests" / "test-data" / "catsHTM2"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    item = CatsHTMQueryItem.construct(
+        name="ROSATfsc", rs_arcsec=20 * 3600, keys_to_append=None
+    )
+    coord = SkyCoord(5, 5, unit="deg")
+    catalog = get_catshtm(item.name, CATALOGS_DIR)
+    (srcs,) = catalog.cone_search(
+        coord.ra.rad, coord.dec.rad, math.radians(item.rs_arcsec / 3600)
+    )
+    matches = catshtm_all(item, coord, srcs, catalog.colnames)
+    assert matches is not None
+    print(f"{len(matches)} sources, {len(catalog.colnames)} columns")
+
+    def models() -> bytes:
+        content = [[CatalogItem(**m) for m in matches]]  # type: ignore[union-attr]
+        validated = parse_obj_as(List[Optional[List[CatalogItem]]], content)
+        return JSONResponse(jsonable_encoder(validated)).body
+
+    def direct() -> bytes:
+        return ORJSONResponse([matches]).body
+
+    # both paths produce the same document
+    assert json.loads(models()) == json.loads(direct())
+
+    for label, func in (("pydantic models", models), ("direct orjson", direct)):
+        seconds = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        print(f"{label:>16}: {seconds*1e3:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Measure worker cold start: import time, startup time and time to first response
+
+Each measurement runs in a fresh interpreter, which imports app.main, runs
+the application's startup handlers (including the warm-up with --warm-up),
+and then sends a single cone search for the ROSATfsc test catalog and the
+milliquas test catalog (in mongomock).
+
+Usage: python -m benchmarks.bench_startup [--repeat N] [--warm-up]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+TEST_DATA = Path(__file__).parent.parent / "tests" / "test-data"
+
+FIRST_REQUEST = {
+    "ra_deg": 265.0,
+    "dec_deg": -89.58,
+    "catalogs": [
+        {"use": "catsHTM", "name": "ROSATfsc", "rs_arcsec": 3600},
+        {"use": "extcats", "name": "milliquas", "rs_arcsec": 60},
+    ],
+}
+
+
+def mock_mongo():
+    import mongomock
+    from bson import decode_all
+
+    mongo = mongomock.MongoClient()
+    dump = TEST_DATA / "minimongodumps" / "milliquas"
+    db = mongo.get_database("milliquas")
+    for collection in ("meta", "srcs"):
+        db.get_collection(collection).insert_many(
+            decode_all((dump / f"{collection}.bson").read_bytes())
+        )
+    return mongo
+
+
+def child() -> None:
+    """
+    Measure a single cold start, and print the timings as JSON
+    """
+    import asyncio
+
+    start = time.perf_counter()
+    import app.main
+
+    imported = time.perf_counter()
+
+    import app.mongo
+    from httpx import AsyncClient
+
+    # not part of the measurement
+    app.mongo.mongo_db = mock_mongo()
+
+    async def first_response() -> float:
+        begin = time.perf_counter()
+        await app.main.app.router.startup()
+        started = time.perf_counter()
+        async with AsyncClient(app=app.main.app, base_url="http://bench") as client:
+            response = await client.post("/cone_search/nearest", json=FIRST_REQUEST)
+            response.raise_for_status()
+        return started - begin, time.perf_counter() - started
+
+    startup, request = asyncio.run(first_response())
+    print(
+        json.dumps(
+            {"import_s": imported - start, "startup_s": startup, "request_s": request}
+        )
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--warm-up", action="store_true", help="warm up catalogs at startup"
+    )
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child()
+        return
+
+    env = {
+        **os.environ,
+        "CATSHTM_DIR": str(TEST_DATA / "catsHTM2"),
+        "CATALOG_REFRESH_INTERVAL": "0",
+        "WARM_UP": "1" if args.warm_up else "0",
+    }
+    runs = []
+    for _ in range(args.repeat):
+        output = subprocess.check_output(
+            [sys.executable, "-m", "benchmarks.bench_startup", "--child"],
+            cwd=Path(__file__).parent.parent,
+            env=env,
+            stderr=subprocess.DEVNULL,
+        )
+        runs.append(json.loads(output.splitlines()[-1]))
+    for key, label in (
+        ("import_s", "import app.main"),
+        ("startup_s", "startup handlers"),
+        ("request_s", "first request"),
+    ):
+        values = np.array([run[key] for run in runs])
+        print(
+            f"{label:>18}: median {np.median(values):6.2f} s"
+            f"  min {values.min():6.2f} s  max {values.max():6.2f} s"
+        )
+    total = np.array([sum(run.values()) for run in runs])
+    print(f"{'first response':>18}: median {np.median(total):6.2f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,8 +9,11 @@ import pytest
 from bson import decode_all
 from httpx import AsyncClient
 
+from app.catalogs import catalog_descriptions
 from app.main import app
-from app.mongo import get_catq
+from app.mongo import get_catq, has_name_index
+from app.registry import registry
+from app.result_cache import MemoryCache
 from app.settings import Settings
 
 
@@ -45,6 +48,7 @@ def mock_mongoclient():
 def mock_extcats(monkeypatch, mock_mongoclient):
     monkeypatch.setattr("app.mongo.mongo_db", mock_mongoclient)
     get_catq.cache_clear()
+    has_name_index.cache_clear()
 
 
 @pytest.fixture
@@ -69,6 +73,28 @@ def without_keys_doc(mock_mongoclient):
     meta.insert_one(doc)
 
 
+@pytest.fixture(autouse=True)
+def result_cache(monkeypatch):
+    """
+    Start each test with an empty result cache
+    """
+    cache = MemoryCache(ttl=3600, max_entries=1000)
+    monkeypatch.setattr("app.result_cache.result_cache", cache)
+    return cache
+
+
+@pytest.fixture(autouse=True)
+def catalog_registry():
+    """
+    Rescan catalogs for each test, as fixtures change what is available
+    """
+    registry.invalidate()
+    catalog_descriptions.invalidate()
+    yield registry
+    registry.invalidate()
+    catalog_descriptions.invalidate()
+
+
 @pytest.fixture
 def mock_catshtm(monkeypatch):
     settings = Settings(catshtm_dir=Path(__file__).parent / "test-data" / "catsHTM2")
@@ -81,7 +107,15 @@ def mock_catshtm(monkeypatch):
         settings,
     )
     monkeypatch.setattr(
-        "app.models.settings",
+        "app.registry.settings",
+        settings,
+    )
+    monkeypatch.setattr(
+        "app.result_cache.settings",
+        settings,
+    )
+    monkeypatch.setattr(
+        "app.admission.settings",
         settings,
     )
     
@@ -89,6 +123,8 @@ def mock_catshtm(monkeypatch):
 
 @pytest.fixture
 async def mock_client(mock_extcats, mock_catshtm, without_keys_doc):
+    # as the startup handler would
+    registry.refresh()
     async with AsyncClient(app=app, base_url="http://test") as client:
         yield client
 
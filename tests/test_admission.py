@@ -0,0 +1,208 @@
+import asyncio
+import gc
+from pathlib import Path
+
+import numpy as np
+import pytest
+from astropy.coordinates import SkyCoord
+from astropy.table import Table
+from fastapi import HTTPException
+
+from app.admission import Admission, admission, search_cost
+from app.catshtm import get_catshtm, loaded_catshtm
+from app.cone_search import search_all, truncate_table
+from app.models import CatsHTMQueryItem, ConeSearchRequest, ExtcatsQueryItem
+from app.mongo import get_catq
+from app.registry import registry
+from app.settings import Settings
+
+CATSHTM_DIR = Path(__file__).parent / "test-data" / "catsHTM2"
+
+
+@pytest.fixture
+def limits(monkeypatch, mock_catshtm):
+    def set_limits(**kwargs):
+        monkeypatch.setattr(
+            "app.admission.settings", Settings(catshtm_dir=CATSHTM_DIR, **kwargs)
+        )
+
+    return set_limits
+
+
+def test_search_cost(mock_extcats, mock_catshtm):
+    coords = SkyCoord([5, 100], [5, 30], unit="deg")
+    catshtm = [
+        search_cost(CatsHTMQueryItem.construct(name="ROSATfsc", rs_arcsec=rs), coords)
+        for rs in (1, 3600, 36000)
+    ]
+    assert 0 < catshtm[0] < catshtm[1] < catshtm[2]
+    assert catshtm[2] < 2 * get_catshtm("ROSATfsc", CATSHTM_DIR).num_sources.sum()
+
+    extcats = [
+        search_cost(ExtcatsQueryItem.construct(name="milliquas", rs_arcsec=rs), coords)
+        for rs in (1, 3600, 180 * 3600)
+    ]
+    assert extcats[0] < extcats[1] < extcats[2]
+    # the whole sky, once per position
+    count = get_catq("milliquas").src_coll.count_documents({})
+    assert extcats[2] == pytest.approx(2 * count)
+
+
+def test_admission_limits(limits):
+    limits(expensive_search_cost=100, max_expensive_searches=1, max_cheap_searches=2)
+    control = Admission()
+    expensive = control.acquire(1000)
+    assert expensive == "expensive"
+    with pytest.raises(HTTPException) as exc:
+        control.acquire(1000)
+    assert exc.value.status_code == 429
+    assert exc.value.headers["Retry-After"] == "1"
+    # cheap searches are admitted separately
+    cheap = [control.acquire(10), control.acquire(100)]
+    assert cheap == ["cheap", "cheap"]
+    with pytest.raises(HTTPException) as exc:
+        control.acquire(10)
+    assert exc.value.status_code == 503
+    control.release(expensive)
+    assert control.acquire(1000) == "expensive"
+
+
+@pytest.mark.asyncio
+async def test_admission_disabled():
+    # costs are not estimated without limits
+    assert await Admission().admit([object()], SkyCoord(0, 0, unit="deg")) is None
+
+
+@pytest.mark.asyncio
+async def test_admit_inline(limits, monkeypatch):
+    limits(max_cheap_searches=10)
+    threadpool_calls = []
+
+    async def run_in_threadpool(func, *args):
+        threadpool_calls.append(func)
+        return func(*args)
+
+    monkeypatch.setattr("app.admission.run_in_threadpool", run_in_threadpool)
+    get_catshtm.cache_clear()
+    gc.collect()
+    assert loaded_catshtm("ROSATfsc", CATSHTM_DIR) is None
+    control = Admission()
+    items = [CatsHTMQueryItem.construct(name="ROSATfsc", rs_arcsec=1)]
+    coord = SkyCoord(5, 5, unit="deg")
+    # the index is loaded in the threadpool
+    assert await control.admit(items, coord) == "cheap"
+    assert len(threadpool_calls) == 1
+    assert loaded_catshtm("ROSATfsc", CATSHTM_DIR) is not None
+    # and then used on the event loop
+    assert await control.admit(items, coord) == "cheap"
+    assert len(threadpool_calls) == 1
+    # but not for many positions
+    coords = SkyCoord([5, 6], [5, 6], unit="deg")
+    assert await control.admit(items, coords) == "cheap"
+    assert len(threadpool_calls) == 2
+    # nor for wide cones
+    wide = [CatsHTMQueryItem.construct(name="ROSATfsc", rs_arcsec=36000)]
+    await control.admit(wide, coord)
+    assert len(threadpool_calls) == 3
+
+
+@pytest.mark.parametrize("accept", ["application/json", "application/x-ndjson"])
+@pytest.mark.asyncio
+async def test_search_rejected(accept, mock_client, limits):
+    limits(expensive_search_cost=100, max_expensive_searches=1)
+    request = {
+        "ra_deg": 5,
+        "dec_deg": 5,
+        "catalogs": [{"use": "catsHTM", "name": "ROSATfsc", "rs_arcsec": 3600}],
+    }
+    headers = {"Accept": accept}
+    held = admission.acquire(1000)
+    try:
+        response = await mock_client.post(
+            "/cone_search/all", json=request, headers=headers
+        )
+        assert response.status_code == 429
+        assert response.headers["Retry-After"] == "1"
+        # cheap searches are unaffected
+        cheap = {**request["catalogs"][0], "rs_arcsec": 1}
+        response = await mock_client.post(
+            "/cone_search/any", json={**request, "catalogs": [cheap]}
+        )
+        assert response.status_code == 200
+    finally:
+        admission.release(held)
+    response = await mock_client.post(
+        "/cone_search/all", json=request, headers=headers
+    )
+    assert response.status_code == 200
+    assert admission.active == {"cheap": 0, "expensive": 0}
+
+
+@pytest.mark.asyncio
+async def test_stream_released_when_dropped(limits, mock_extcats):
+    limits(max_cheap_searches=1)
+    registry.refresh()
+    request = ConeSearchRequest(
+        ra_deg=5,
+        dec_deg=5,
+        catalogs=[{"use": "catsHTM", "name": "ROSATfsc", "rs_arcsec": 1}],
+    )
+    response = await search_all(request, accept="application/x-ndjson")
+    assert admission.active["cheap"] == 1
+    # the response is never sent
+    del response
+    gc.collect()
+    assert admission.active["cheap"] == 0
+
+    # the client is gone before the body starts
+    response = await search_all(request, accept="application/x-ndjson")
+
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        await asyncio.sleep(1)
+
+    await response({"type": "http"}, receive, send)
+    assert admission.active["cheap"] == 0
+    # released only once
+    del response
+    gc.collect()
+    assert admission.active["cheap"] == 0
+
+
+@pytest.mark.parametrize("batch", [False, True])
+@pytest.mark.asyncio
+async def test_max_results(batch, mock_client):
+    catalog = {"use": "catsHTM", "name": "ROSATfsc", "rs_arcsec": 3600}
+    request = {
+        "ra_deg": [5, 5] if batch else 5,
+        "dec_deg": [5, 5] if batch else 5,
+        "catalogs": [catalog, {**catalog, "rs_arcsec": 1}],
+    }
+    path = "/cone_search/batch/all" if batch else "/cone_search/all"
+    response = await mock_client.post(path, json=request)
+    response.raise_for_status()
+    full = response.json()[0][0] if batch else response.json()[0]
+    assert len(full) > 3
+
+    response = await mock_client.post(path, json={**request, "max_results": 3})
+    response.raise_for_status()
+    assert response.headers["X-Truncated-Catalogs"] == "0"
+    for results in response.json() if batch else [response.json()]:
+        assert results[0] == sorted(full, key=lambda m: m["dist_arcsec"])[:3]
+        assert results[1] is None
+
+
+def test_truncate_table():
+    table = Table(
+        {
+            "position": [0, 0, 0, 1, 1, 2],
+            "dist_arcsec": [3.0, 1.0, 2.0, 5.0, 4.0, 1.0],
+            "id": np.arange(6),
+        }
+    )
+    assert list(truncate_table(table, 2)["id"]) == [1, 2, 3, 4, 5]
+    assert truncate_table(table, 3) is table
+    del table["position"]
+    assert list(truncate_table(table, 2)["id"]) == [1, 5]
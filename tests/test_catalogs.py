@@ -82,3 +82,97 @@ async def test_missing_keys_doc(without_keys_doc, mock_client):
     response.raise_for_status()
     body = response.json()
     assert not [c for c in body if c["name"] == "milliquas"]
+
+
+@pytest.fixture
+def catalog_snapshot(monkeypatch, tmp_path, mock_catshtm):
+    from app.settings import Settings
+
+    path = tmp_path / "catalogs.json"
+    monkeypatch.setattr(
+        "app.catalogs.settings", Settings(catalog_snapshot_path=path, max_parallelism=2)
+    )
+    return path
+
+
+def test_catalog_snapshot(catalog_snapshot, mock_extcats):
+    from app.catalogs import CatalogDescriptions
+
+    descriptions = CatalogDescriptions()
+    assert not descriptions.load_snapshot()
+    expected = descriptions.get()
+    assert [c["name"] for c in expected] == ["TNS", "milliquas", "ROSATfsc"]
+    assert catalog_snapshot.exists()
+
+    # a fresh instance serves the snapshot without touching the catalogs
+    descriptions = CatalogDescriptions()
+    assert descriptions.load_snapshot()
+    assert descriptions.get() == expected
+
+
+def test_catalog_refresh(mock_extcats, mock_catshtm, mock_mongoclient):
+    from app.catalogs import catalog_descriptions
+    from app.registry import registry
+
+    assert len(catalog_descriptions.get()) == 3
+    db = mock_mongoclient.get_database("milliquas_copy")
+    for name in ("meta", "srcs"):
+        db.get_collection(name).insert_many(
+            mock_mongoclient.get_database("milliquas").get_collection(name).find()
+        )
+    try:
+        # cached until refreshed
+        assert len(catalog_descriptions.get()) == 3
+        registry.refresh()
+        assert "milliquas_copy" in [c["name"] for c in catalog_descriptions.refresh()]
+    finally:
+        mock_mongoclient.drop_database("milliquas_copy")
+
+
+@pytest.fixture
+def name_index(mock_mongoclient):
+    from app.mongo import has_name_index
+
+    srcs = mock_mongoclient.get_database("TNS").get_collection("srcs")
+    srcs.create_index("name")
+    has_name_index.cache_clear()
+    yield srcs
+    srcs.drop_index("name_1")
+    has_name_index.cache_clear()
+
+
+@pytest.mark.asyncio
+async def test_lookup(mock_client, name_index):
+    response = await mock_client.get("/catalogs/TNS/2020atz")
+    response.raise_for_status()
+    assert response.json()["name"] == "2020atz"
+    response = await mock_client.get("/catalogs/TNS/nonesuch")
+    response.raise_for_status()
+    assert response.json() is None
+
+
+@pytest.mark.asyncio
+async def test_lookup_unindexed(mock_client):
+    response = await mock_client.get("/catalogs/milliquas/WISEA J043431.62-894617.9")
+    assert response.status_code == 404
+    response = await mock_client.post("/catalogs/milliquas", json={"names": ["foo"]})
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_lookup_batch(mock_client, name_index, monkeypatch):
+    monkeypatch.setattr("app.catalogs.NAME_CHUNK_SIZE", 2)
+    names = ["2020atz", "nonesuch", "2019pww", "2018djb", "2020atz"]
+    response = await mock_client.post("/catalogs/TNS", json={"names": names})
+    response.raise_for_status()
+    body = response.json()
+    assert [doc and doc["name"] for doc in body] == [
+        "2020atz",
+        None,
+        "2019pww",
+        "2018djb",
+        "2020atz",
+    ]
+    for name, doc in zip(names, body):
+        single = await mock_client.get(f"/catalogs/TNS/{name}")
+        assert single.json() == doc
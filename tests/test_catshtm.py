@@ -0,0 +1,157 @@
+import math
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pytest
+from catsHTM import cone_search
+from catsHTM.script import search_htm_ind
+
+from app.catshtm import CatsHTMCatalog, TrixelCache
+from app.columnar import write_columnar
+from app.spherical import within
+
+CATALOGS_DIR = Path(__file__).parent / "test-data" / "catsHTM2"
+
+
+@pytest.fixture
+def trixel_cache(monkeypatch):
+    cache = TrixelCache(2 ** 20)
+    monkeypatch.setattr("app.catshtm.trixel_cache", cache)
+    return cache
+
+
+@pytest.fixture
+def rosat(trixel_cache):
+    return CatsHTMCatalog("ROSATfsc", CATALOGS_DIR)
+
+
+POSITIONS = [(5, 5, 3600), (5.5, 4.5, 600), (6, 6, 7200), (4, 5, 60)]
+
+
+def test_trixels(rosat):
+    ra, dec, rs_arcsec = map(np.array, zip(*POSITIONS))
+    radius = np.radians(rs_arcsec / 3600)
+    trixels = rosat.trixels(np.radians(ra), np.radians(dec), radius)
+    assert len(trixels) == len(POSITIONS)
+    for r, d, rad, ids in zip(ra, dec, radius, trixels):
+        expected = search_htm_ind(
+            "ROSATfsc_htm.hdf5",
+            math.radians(r),
+            math.radians(d),
+            rad,
+            str(CATALOGS_DIR),
+            CatDir="ROSATfsc",
+        )
+        assert sorted(ids.tolist()) == sorted(expected.tolist())
+
+
+def test_cone_search(rosat):
+    ra, dec, rs_arcsec = map(np.array, zip(*POSITIONS))
+    results = rosat.cone_search(
+        np.radians(ra), np.radians(dec), np.radians(rs_arcsec / 3600)
+    )
+    assert len(results) == len(POSITIONS)
+    assert sum(len(srcs) for srcs in results) > 0
+    for r, d, rs, srcs in zip(ra, dec, rs_arcsec, results):
+        expected, _, _ = cone_search(
+            "ROSATfsc",
+            math.radians(r),
+            math.radians(d),
+            rs,
+            catalogs_dir=str(CATALOGS_DIR),
+        )
+        assert srcs.shape[0] == len(expected)
+        assert sorted(map(tuple, srcs)) == sorted(map(tuple, np.asarray(expected)))
+
+
+@pytest.mark.parametrize("rs_deg", [91, 135, 180])
+def test_cone_search_large_radius(rosat, rs_deg):
+    ra, dec, radius = math.radians(5), math.radians(5), math.radians(rs_deg)
+    (srcs,) = rosat.cone_search(ra, dec, radius)
+    ids = np.flatnonzero(rosat.is_leaf & (rosat.num_sources > 0))
+    every = np.concatenate(list(rosat.read_trixels(ids.tolist()).values()))
+    idx, _ = within(every[:, 0], every[:, 1], ra, dec, radius)
+    assert len(srcs) == len(idx)
+    assert sorted(map(tuple, srcs)) == sorted(map(tuple, every[idx]))
+
+
+def test_cone_search_empty(rosat):
+    assert rosat.cone_search(np.array([]), np.array([]), 0.01) == []
+    (srcs,) = rosat.cone_search(0.0, math.radians(-89), 0.01)
+    assert srcs.shape == (0, len(rosat.colnames))
+
+
+def test_trixel_cache(rosat, trixel_cache):
+    args = (math.radians(5), math.radians(5), math.radians(1))
+    (first,) = rosat.cone_search(*args)
+    assert trixel_cache.hits == 0
+    assert (misses := trixel_cache.misses) > 0
+    assert len(trixel_cache) > 0
+    (second,) = rosat.cone_search(*args)
+    assert trixel_cache.hits == misses
+    assert trixel_cache.misses == misses
+    assert (first == second).all()
+
+
+def test_trixel_cache_versioned(trixel_cache, tmp_path):
+    shutil.copytree(CATALOGS_DIR / "ROSATfsc", tmp_path / "ROSATfsc")
+    args = (math.radians(5), math.radians(5), math.radians(1))
+    CatsHTMCatalog("ROSATfsc", tmp_path).cone_search(*args)
+    misses = trixel_cache.misses
+    # the catalog is replaced on disk
+    index = tmp_path / "ROSATfsc" / "ROSATfsc_htm.hdf5"
+    os.utime(index, ns=(index.stat().st_atime_ns, index.stat().st_mtime_ns + 1))
+    CatsHTMCatalog("ROSATfsc", tmp_path).cone_search(*args)
+    assert trixel_cache.hits == 0
+    assert trixel_cache.misses == 2 * misses
+
+
+def test_trixel_cache_eviction():
+    cache = TrixelCache(3 * 8 * 10)
+    for i in range(4):
+        cache.put(i, np.zeros(10))
+    assert cache.evictions == 1
+    assert cache.nbytes == 3 * 8 * 10
+    assert cache.get(0) is None
+    assert cache.get(1) is not None
+    # 1 is now most recently used
+    cache.put(4, np.zeros(10))
+    assert cache.get(2) is None
+    assert cache.get(1) is not None
+    # entries larger than the budget are not cached
+    cache.put(5, np.zeros(100))
+    assert cache.get(5) is None
+    assert cache.stats()["hits"] == 2
+
+
+def test_columnar(rosat, tmp_path):
+    shutil.copytree(CATALOGS_DIR / "ROSATfsc", tmp_path / "ROSATfsc")
+    sidecar = write_columnar(CatsHTMCatalog("ROSATfsc", tmp_path))
+    assert sidecar == tmp_path / "ROSATfsc" / "ROSATfsc_columnar"
+    columnar = CatsHTMCatalog("ROSATfsc", tmp_path)
+    assert columnar.columnar is not None
+    assert columnar.columnar.offsets[-1] == 703
+
+    ra, dec, rs_arcsec = map(np.array, zip(*POSITIONS))
+    args = (np.radians(ra), np.radians(dec), np.radians(rs_arcsec / 3600))
+    for expected, srcs in zip(rosat.cone_search(*args), columnar.cone_search(*args)):
+        assert srcs.shape == expected.shape
+        assert (srcs == expected).all()
+    (srcs,) = columnar.cone_search(0.0, math.radians(-89), 0.01)
+    assert srcs.shape == (0, len(columnar.colnames))
+
+
+def test_columnar_stale(tmp_path):
+    shutil.copytree(CATALOGS_DIR / "ROSATfsc", tmp_path / "ROSATfsc")
+    write_columnar(CatsHTMCatalog("ROSATfsc", tmp_path))
+    # the catalog is replaced on disk, but not converted again
+    index = tmp_path / "ROSATfsc" / "ROSATfsc_htm.hdf5"
+    os.utime(index, ns=(index.stat().st_atime_ns, index.stat().st_mtime_ns + 1))
+    catalog = CatsHTMCatalog("ROSATfsc", tmp_path)
+    assert catalog.columnar is None
+    (srcs,) = catalog.cone_search(math.radians(5), math.radians(5), math.radians(1))
+    assert len(srcs) > 0
+    write_columnar(catalog)
+    assert CatsHTMCatalog("ROSATfsc", tmp_path).columnar is not None
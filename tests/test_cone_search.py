@@ -1,10 +1,29 @@
+import asyncio
+import json
+import math
+import threading
+import time
+
+import numpy as np
+import orjson
 import pytest
+from astropy.coordinates import SkyCoord
+from astropy.table import Table
+from pymongo.errors import ExecutionTimeout, OperationFailure
 
 from app.cone_search import (
     CatsHTMQueryItem,
     ConeSearchRequest,
+    Deadline,
     ExtcatsQueryItem,
+    LatencyTracker,
+    search_catalog,
+    search_first,
+    search_items,
+    stream_all,
+    table_to_json,
 )
+from app.settings import Settings
 
 
 @pytest.mark.parametrize("method", ["any", "nearest", "all"])
@@ -178,3 +197,343 @@ async def test_post_filter(
     body = response.json()
     assert len(body) == 1 and body[0] is None
 
+
+
+@pytest.mark.parametrize("method", ["any", "nearest", "all"])
+@pytest.mark.parametrize(
+    "positions,catalogs",
+    [
+        (
+            [(5, 5), (5.5, 4.5), (5, 5), (6, 6)],
+            [{"use": "catsHTM", "name": "ROSATfsc", "rs_arcsec": 3600}],
+        ),
+        (
+            [(265, -89.58), (5, 5), (265, -89.58), (264, -89.6)],
+            [{"use": "extcats", "name": "milliquas", "rs_arcsec": 60}],
+        ),
+        (
+            [(5, 5), (5.5, 4.5), (5, 5)],
+            [
+                {"use": "catsHTM", "name": "ROSATfsc", "rs_arcsec": 600},
+                {"use": "extcats", "name": "milliquas", "rs_arcsec": 60},
+            ],
+        ),
+    ],
+)
+@pytest.mark.asyncio
+async def test_batch_search(method, positions, catalogs, test_client):
+    """
+    Batched searches return the same results as individual searches
+    """
+    response = await test_client.post(
+        f"/cone_search/batch/{method}",
+        json={
+            "ra_deg": [ra for ra, _ in positions],
+            "dec_deg": [dec for _, dec in positions],
+            "catalogs": catalogs,
+        },
+    )
+    response.raise_for_status()
+    body = response.json()
+    assert len(body) == len(positions)
+    for (ra, dec), result in zip(positions, body):
+        assert result == await search(
+            test_client,
+            method,
+            {"ra_deg": ra, "dec_deg": dec, "catalogs": catalogs},
+        )
+
+
+@pytest.mark.asyncio
+async def test_batch_search_mismatched_lengths(test_client):
+    request = {
+        "ra_deg": [0, 1],
+        "dec_deg": [0],
+        "catalogs": [{"use": "catsHTM", "name": "ROSATfsc", "rs_arcsec": 60}],
+    }
+    response = await test_client.post("/cone_search/batch/any", json=request)
+    assert response.status_code == 422
+
+
+def parse_ndjson(response):
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    return [json.loads(line) for line in response.text.splitlines()]
+
+
+def sort_key(entry):
+    return json.dumps(entry, sort_keys=True)
+
+
+@with_request([None] * 5)
+@pytest.mark.asyncio
+async def test_search_all_ndjson(request_dict, expected, test_client):
+    """
+    Streamed matches are the same as the JSON response
+    """
+    (matches,) = await search(test_client, "all", request_dict)
+    response = await test_client.post(
+        "/cone_search/all",
+        json=request_dict,
+        headers={"Accept": "application/x-ndjson"},
+    )
+    response.raise_for_status()
+    lines = parse_ndjson(response)
+    assert {line.pop("catalog") for line in lines} <= {0}
+    assert sorted(lines, key=sort_key) == sorted(matches or [], key=sort_key)
+
+
+@pytest.mark.asyncio
+async def test_batch_search_all_ndjson(test_client):
+    positions = [(5, 5), (5.5, 4.5), (265, -89.58)]
+    request_dict = {
+        "ra_deg": [ra for ra, _ in positions],
+        "dec_deg": [dec for _, dec in positions],
+        "catalogs": [
+            {"use": "catsHTM", "name": "ROSATfsc", "rs_arcsec": 3600},
+            {"use": "extcats", "name": "milliquas", "rs_arcsec": 60},
+        ],
+    }
+    response = await test_client.post("/cone_search/batch/all", json=request_dict)
+    response.raise_for_status()
+    expected = [
+        {"position": i, "catalog": j, **m}
+        for i, result in enumerate(response.json())
+        for j, matches in enumerate(result)
+        for m in matches or []
+    ]
+    assert expected
+    response = await test_client.post(
+        "/cone_search/batch/all",
+        json=request_dict,
+        headers={"Accept": "application/x-ndjson"},
+    )
+    response.raise_for_status()
+    assert sorted(parse_ndjson(response), key=sort_key) == sorted(
+        expected, key=sort_key
+    )
+
+
+def test_stream_all_chunks(mock_catshtm, monkeypatch):
+    monkeypatch.setattr("app.cone_search.STREAM_CHUNK_LINES", 4)
+    item = CatsHTMQueryItem.construct(name="ROSATfsc", rs_arcsec=3600)
+    chunks = list(stream_all([item], SkyCoord(5, 5, unit="deg")))
+    lines = [line for chunk in chunks for line in chunk.splitlines()]
+    assert len(lines) == 9
+    assert [len(chunk.splitlines()) for chunk in chunks] == [4, 4, 1]
+    assert all(chunk.endswith(b"\n") for chunk in chunks)
+
+
+@pytest.mark.asyncio
+async def test_search_mixed_catalogs(test_client):
+    """
+    Results are returned in request order when catalogs are queried concurrently
+    """
+    catalogs = [
+        {"use": "extcats", "name": "milliquas", "rs_arcsec": 60},
+        {"use": "catsHTM", "name": "ROSATfsc", "rs_arcsec": 60},
+        {"use": "extcats", "name": "milliquas", "rs_arcsec": 1},
+        {"use": "catsHTM", "name": "ROSATfsc", "rs_arcsec": 3600},
+    ]
+    body = await search(
+        test_client, "any", {"ra_deg": 265, "dec_deg": -89.58, "catalogs": catalogs}
+    )
+    assert body == [True, False, False, False]
+    body = await search(
+        test_client, "any", {"ra_deg": 5, "dec_deg": 5, "catalogs": catalogs}
+    )
+    assert body == [False, False, False, True]
+
+
+@pytest.mark.parametrize("max_parallelism", [1, 3])
+@pytest.mark.asyncio
+async def test_search_items_parallelism(max_parallelism, monkeypatch):
+    """
+    Catalogs are searched concurrently, up to the configured limit
+    """
+    monkeypatch.setattr(
+        "app.cone_search.settings", Settings(max_parallelism=max_parallelism)
+    )
+    lock = threading.Lock()
+    active, max_active = 0, 0
+
+    def search_item(item, coord):
+        nonlocal active, max_active
+        with lock:
+            active += 1
+            max_active = max(active, max_active)
+        time.sleep(0.05)
+        with lock:
+            active -= 1
+        return item.name
+
+    items = [
+        (CatsHTMQueryItem if i % 2 else ExtcatsQueryItem).construct(
+            name=str(i), rs_arcsec=1
+        )
+        for i in range(6)
+    ]
+    assert await search_items(search_item, items, None) == [str(i) for i in range(6)]
+    assert max_active == max_parallelism
+
+
+@pytest.mark.asyncio
+async def test_search_any_short_circuit(test_client):
+    catalogs = [
+        {"use": "extcats", "name": "milliquas", "rs_arcsec": 60},
+        {"use": "catsHTM", "name": "ROSATfsc", "rs_arcsec": 3600},
+    ]
+    for ra, dec, expected in [(265, -89.58, True), (5, 5, True), (100, 30, False)]:
+        response = await test_client.post(
+            "/cone_search/any",
+            params={"short_circuit": True},
+            json={"ra_deg": ra, "dec_deg": dec, "catalogs": catalogs},
+        )
+        response.raise_for_status()
+        assert response.json() is expected
+
+
+@pytest.mark.asyncio
+async def test_search_first(monkeypatch):
+    """
+    Catalogs are searched cheapest-first, and the search stops at the first hit
+    """
+    monkeypatch.setattr("app.cone_search.settings", Settings(max_parallelism=1))
+    latency = LatencyTracker()
+    monkeypatch.setattr("app.cone_search.search_latency", latency)
+    items = [
+        CatsHTMQueryItem.construct(name=name, rs_arcsec=1)
+        for name in ("slow", "hit", "miss")
+    ]
+    for item, seconds in zip(items, (1, 0.2, 0.1)):
+        latency.observe(item, seconds)
+    searched = []
+
+    def search_item(item, coord):
+        searched.append(item.name)
+        return item.name == "hit"
+
+    assert await search_first(search_item, items, None)
+    assert searched == ["miss", "hit"]
+    searched.clear()
+    assert not await search_first(search_item, items[:1] + items[2:], None)
+    assert searched == ["miss", "slow"]
+
+
+@pytest.mark.asyncio
+async def test_search_items_deadline():
+    """
+    Catalogs that miss their deadline are reported, and do not hold up the rest
+    """
+
+    def search_item(item, coord):
+        time.sleep(0.5 if item.name.startswith("slow") else 0)
+        return item.name
+
+    items = [
+        CatsHTMQueryItem.construct(name="slow", rs_arcsec=1, timeout_s=0.05),
+        ExtcatsQueryItem.construct(name="fast", rs_arcsec=1, timeout_s=0.05),
+        ExtcatsQueryItem.construct(name="slow, unlimited", rs_arcsec=1),
+    ]
+    deadline = Deadline()
+    assert await search_items(search_item, items, None, deadline=deadline) == [
+        None,
+        "fast",
+        "slow, unlimited",
+    ]
+    assert deadline.timed_out == {0}
+    assert deadline.headers == {"X-Timed-Out-Catalogs": "0"}
+
+    # the request deadline applies to all catalogs
+    deadline = Deadline(0.1)
+    start = time.monotonic()
+    assert await search_items(search_item, items, None, deadline=deadline) == [
+        None,
+        "fast",
+        None,
+    ]
+    assert time.monotonic() - start < 0.4
+    assert deadline.headers == {"X-Timed-Out-Catalogs": "0,2"}
+
+
+@pytest.mark.asyncio
+async def test_search_items_mongo_timeout():
+    """
+    Mongo operations stopped at the deadline count as timed out; other
+    errors are raised
+    """
+
+    def search_item(item, coord):
+        if item.name == "timeout":
+            raise ExecutionTimeout("operation exceeded time limit", 50)
+        raise OperationFailure("unauthorized")
+
+    deadline = Deadline()
+    item = ExtcatsQueryItem.construct(name="timeout", rs_arcsec=1, timeout_s=1)
+    assert await search_items(search_item, [item], None, deadline=deadline) == [None]
+    assert deadline.timed_out == {0}
+    item = ExtcatsQueryItem.construct(name="error", rs_arcsec=1, timeout_s=1)
+    with pytest.raises(OperationFailure):
+        await search_items(search_item, [item], None, deadline=Deadline())
+
+
+@pytest.mark.parametrize("method", ["any", "nearest", "all"])
+@pytest.mark.asyncio
+async def test_search_timed_out_catalogs(method, mock_client, monkeypatch):
+    async def slow_search_catalog(search_item, item, *args, **kwargs):
+        if item.use == "catsHTM":
+            await asyncio.sleep(1)
+        return await search_catalog(search_item, item, *args, **kwargs)
+
+    monkeypatch.setattr("app.cone_search.search_catalog", slow_search_catalog)
+    catalogs = [
+        {"use": "catsHTM", "name": "ROSATfsc", "rs_arcsec": 3600, "timeout_s": 0.05},
+        {"use": "extcats", "name": "milliquas", "rs_arcsec": 60},
+    ]
+    response = await mock_client.post(
+        f"/cone_search/{method}",
+        json={"ra_deg": 265, "dec_deg": -89.58, "catalogs": catalogs},
+    )
+    response.raise_for_status()
+    assert response.headers["X-Timed-Out-Catalogs"] == "0"
+    body = response.json()
+    assert body[0] is None
+    assert body[1]
+
+    response = await mock_client.post(
+        f"/cone_search/batch/{method}",
+        json={"ra_deg": [265, 5], "dec_deg": [-89.58, 5], "catalogs": catalogs},
+    )
+    response.raise_for_status()
+    assert response.headers["X-Timed-Out-Catalogs"] == "0"
+    assert [r[0] for r in response.json()] == [None, None]
+
+
+def test_table_to_json():
+    table = Table(
+        [
+            {"f": 1.5, "i": 2, "s": "x", "v": [1.0, math.nan], "o": {"k": math.nan}},
+            {"f": math.nan, "i": 3, "v": [2.0, 3.0], "o": {"k": 1}},
+        ]
+    )
+    assert table_to_json(table, None) == [
+        {"f": 1.5, "i": 2, "s": "x", "v": [1.0, None], "o": {"k": None}},
+        {"f": None, "i": 3, "s": None, "v": [2.0, 3.0], "o": {"k": 1}},
+    ]
+    assert table_to_json(table, {"f", "i"}, {"i"}) == [{"f": 1.5}, {"f": None}]
+    assert table_to_json(table, set()) == [{}, {}]
+    assert table_to_json(None, None) is None
+    rows = table_to_json(table, None)
+    assert type(rows[0]["i"]) is int and type(rows[0]["f"]) is float
+
+
+def test_table_to_json_bytes():
+    table = Table(
+        {
+            "b": np.array([b"abc", b"d\xc3\xa9"]),
+            "o": np.array([{"k": b"x"}, b"y"], dtype=object),
+        }
+    )
+    rows = table_to_json(table, None)
+    assert rows == [{"b": "abc", "o": {"k": "x"}}, {"b": "d\u00e9", "o": "y"}]
+    # serializable as such
+    orjson.dumps(rows)
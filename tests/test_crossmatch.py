@@ -0,0 +1,95 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from app.cone_search import search_catalog
+
+CATALOGS = [
+    {"use": "catsHTM", "name": "ROSATfsc", "rs_arcsec": 1800},
+    {"use": "extcats", "name": "milliquas", "rs_arcsec": 60},
+]
+
+
+@pytest.fixture
+def positions():
+    rng = np.random.default_rng(42)
+    # scatter around the sources in the test catalogs
+    return [
+        (float(ra), float(dec))
+        for center in ((5, 5), (265, -89.58))
+        for ra, dec in np.asarray(center) + rng.normal(scale=[0.5, 0.005], size=(8, 2))
+    ] + [(5, 5), (265, -89.58), (5, 5)]
+
+
+@pytest.mark.parametrize("all_matches", [False, True])
+@pytest.mark.parametrize("catalog", CATALOGS)
+@pytest.mark.parametrize("chunk_size", [7, 10000])
+@pytest.mark.asyncio
+async def test_crossmatch(
+    catalog, all_matches, chunk_size, positions, mock_client, monkeypatch
+):
+    """
+    Crossmatch gives the same results as batch cone searches, in input order
+    """
+    monkeypatch.setattr("app.crossmatch.CHUNK_SIZE", chunk_size)
+    ra_deg = [ra for ra, _ in positions]
+    dec_deg = [dec for _, dec in positions]
+    response = await mock_client.post(
+        "/crossmatch",
+        json={
+            "ra_deg": ra_deg,
+            "dec_deg": dec_deg,
+            "catalog": catalog,
+            "all": all_matches,
+        },
+    )
+    response.raise_for_status()
+    body = response.json()
+
+    response = await mock_client.post(
+        "/cone_search/batch/all" if all_matches else "/cone_search/batch/nearest",
+        json={"ra_deg": ra_deg, "dec_deg": dec_deg, "catalogs": [catalog]},
+    )
+    response.raise_for_status()
+    expected = [result[0] for result in response.json()]
+    assert any(expected)
+    assert body == expected
+
+
+@pytest.mark.asyncio
+async def test_crossmatch_empty(mock_client):
+    response = await mock_client.post(
+        "/crossmatch", json={"ra_deg": [], "dec_deg": [], "catalog": CATALOGS[0]}
+    )
+    response.raise_for_status()
+    assert response.json() == []
+
+
+@pytest.mark.asyncio
+async def test_crossmatch_mismatched_lengths(mock_client):
+    response = await mock_client.post(
+        "/crossmatch", json={"ra_deg": [0, 1], "dec_deg": [0], "catalog": CATALOGS[0]}
+    )
+    assert response.status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_crossmatch_timeout(positions, mock_client, monkeypatch):
+    async def slow_search_catalog(search_item, item, *args, **kwargs):
+        await asyncio.sleep(1)
+        return await search_catalog(search_item, item, *args, **kwargs)
+
+    monkeypatch.setattr("app.cone_search.search_catalog", slow_search_catalog)
+    monkeypatch.setattr("app.crossmatch.CHUNK_SIZE", 7)
+    response = await mock_client.post(
+        "/crossmatch",
+        json={
+            "ra_deg": [ra for ra, _ in positions],
+            "dec_deg": [dec for _, dec in positions],
+            "catalog": {**CATALOGS[0], "timeout_s": 0.05},
+        },
+    )
+    response.raise_for_status()
+    assert response.headers["X-Timed-Out-Catalogs"] == "0"
+    assert response.json() == [None] * len(positions)
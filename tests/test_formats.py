@@ -0,0 +1,229 @@
+import io
+import math
+
+import numpy as np
+import orjson
+import pytest
+from astropy.io.votable import parse
+from astropy.table import MaskedColumn, Table
+
+from app import formats
+from app.cone_search import Deadline
+
+CATALOGS = [
+    {"use": "catsHTM", "name": "ROSATfsc", "rs_arcsec": 3600},
+    {"use": "extcats", "name": "milliquas", "rs_arcsec": 60},
+    {"use": "catsHTM", "name": "ROSATfsc", "rs_arcsec": 60},
+]
+
+
+def read_votable(content):
+    return [
+        (table.name, table.to_table(use_names_over_ids=True))
+        for table in parse(io.BytesIO(content)).iter_tables()
+    ]
+
+
+def read_arrow(content):
+    pa = pytest.importorskip("pyarrow")
+    reader = pa.ipc.open_stream(content)
+    names = orjson.loads(reader.schema.metadata[b"catalogs"])
+    tables = []
+    # one record batch per catalog
+    for i, (name, batch) in enumerate(zip(names, reader)):
+        assert batch.column("catalog").to_pylist() == [i] * batch.num_rows
+        tables.append((name, batch.to_pydict()))
+    assert len(tables) == len(names)
+    return tables
+
+
+READERS = {
+    formats.VOTABLE: read_votable,
+    formats.ARROW_STREAM: read_arrow,
+}
+
+
+def assert_matches(columns, matches):
+    """
+    Compare a table (mapping of column names to sequences) to the JSON
+    representation of the same matches
+    """
+    if matches is None:
+        assert len(columns["dist_arcsec"]) == 0
+        return
+    assert list(columns["dist_arcsec"]) == pytest.approx(
+        [m["dist_arcsec"] for m in matches]
+    )
+    for key in matches[0]["body"]:
+        for value, m in zip(columns[key], matches):
+            if isinstance(m["body"][key], float):
+                assert float(value) == pytest.approx(m["body"][key], nan_ok=True)
+            elif m["body"][key] is not None and not isinstance(m["body"][key], dict):
+                assert value == m["body"][key]
+
+
+@pytest.mark.parametrize("media_type", [formats.VOTABLE, formats.ARROW_STREAM])
+@pytest.mark.asyncio
+async def test_search_all_table(media_type, mock_client):
+    read = READERS[media_type]
+    request_dict = {"ra_deg": 5, "dec_deg": 5, "catalogs": CATALOGS}
+    response = await mock_client.post("/cone_search/all", json=request_dict)
+    response.raise_for_status()
+    expected = response.json()
+
+    response = await mock_client.post(
+        "/cone_search/all", json=request_dict, headers={"Accept": media_type}
+    )
+    response.raise_for_status()
+    assert response.headers["content-type"] == media_type
+    tables = read(response.content)
+    assert [name for name, _ in tables] == [c["name"] for c in CATALOGS]
+    for (_, columns), matches in zip(tables, expected):
+        assert_matches(columns, matches)
+
+
+@pytest.mark.parametrize("media_type", [formats.VOTABLE, formats.ARROW_STREAM])
+@pytest.mark.asyncio
+async def test_batch_search_all_table(media_type, mock_client):
+    read = READERS[media_type]
+    positions = [(5, 5), (265, -89.58), (5.5, 4.5), (5, 5)]
+    request_dict = {
+        "ra_deg": [ra for ra, _ in positions],
+        "dec_deg": [dec for _, dec in positions],
+        "catalogs": CATALOGS[:2],
+    }
+    response = await mock_client.post("/cone_search/batch/all", json=request_dict)
+    response.raise_for_status()
+    expected = response.json()
+
+    response = await mock_client.post(
+        "/cone_search/batch/all", json=request_dict, headers={"Accept": media_type}
+    )
+    response.raise_for_status()
+    tables = read(response.content)
+    assert len(tables) == 2
+    for i, (_, columns) in enumerate(tables):
+        position = np.asarray(columns["position"])
+        for j, result in enumerate(expected):
+            selected = {k: np.asarray(v)[position == j] for k, v in columns.items()}
+            assert_matches(selected, result[i])
+
+
+@pytest.mark.asyncio
+async def test_search_all_keys_to_append(mock_client):
+    request_dict = {
+        "ra_deg": 5,
+        "dec_deg": 5,
+        "catalogs": [{**CATALOGS[0], "keys_to_append": ["CountRate"]}],
+    }
+    response = await mock_client.post(
+        "/cone_search/all", json=request_dict, headers={"Accept": formats.VOTABLE}
+    )
+    response.raise_for_status()
+    ((_, table),) = read_votable(response.content)
+    assert table.colnames == ["CountRate", "dist_arcsec"]
+    assert len(table) == 9
+
+
+def test_masked_and_object_columns():
+    table = Table(
+        {
+            "a": MaskedColumn([1.0, math.nan, 3.0], mask=[False, False, True]),
+            "nested": np.array([{"x": 1}, None, [1, 2]], dtype=object),
+            "dist_arcsec": [0.0, 1.0, 2.0],
+        }
+    )
+    ((name, votable),) = read_votable(formats.to_votable(["foo"], [table]))
+    assert name == "foo"
+    # NaN and masked values are both null in VOTable
+    assert votable["a"].mask.tolist() == [False, True, True]
+    assert list(votable["nested"]) == ['{"x":1}', "null", "[1,2]"]
+    ((name, columns),) = read_arrow(formats.to_arrow(["foo"], [table]))
+    assert columns["a"][0] == 1.0 and columns["a"][2] is None
+    assert columns["nested"] == ['{"x":1}', "null", "[1,2]"]
+
+
+def test_bytes_columns():
+    table = Table(
+        {
+            "b": MaskedColumn(np.array([b"abc", b"d\xc3\xa9"]), mask=[False, True]),
+            "nested": np.array([{"k": b"x"}, b"y"], dtype=object),
+            "dist_arcsec": [0.0, 1.0],
+        }
+    )
+    ((_, votable),) = read_votable(formats.to_votable(["foo"], [table]))
+    assert votable["b"][0] == "abc"
+    assert list(votable["nested"]) == ['{"k":"x"}', '"y"']
+    ((_, columns),) = read_arrow(formats.to_arrow(["foo"], [table]))
+    assert columns["b"] == ["abc", None]
+    assert columns["nested"] == ['{"k":"x"}', '"y"']
+
+
+def test_arrow_single_stream():
+    pa = pytest.importorskip("pyarrow")
+    tables = [
+        Table({"id": [1, 2], "ra": [1.0, 2.0], "dist_arcsec": [0.5, 1.5]}),
+        None,
+        Table({"id": ["a"], "mag": [20.0], "dist_arcsec": [2.5]}),
+    ]
+    content = formats.to_arrow(["foo", "bar", "baz"], tables, timed_out={1})
+    reader = pa.ipc.open_stream(content)
+    assert orjson.loads(reader.schema.metadata[b"timed_out"]) == [1]
+    table = reader.read_all()
+    assert table.column_names == ["catalog", "id", "ra", "dist_arcsec", "mag"]
+    # conflicting types fall back to strings
+    assert table.schema.field("id").type == pa.string()
+    assert table.to_pydict() == {
+        "catalog": [0, 0, 2],
+        "id": ["1", "2", "a"],
+        "ra": [1.0, 2.0, None],
+        "dist_arcsec": [0.5, 1.5, 2.5],
+        "mag": [None, None, 20.0],
+    }
+
+
+@pytest.mark.parametrize("media_type", [formats.VOTABLE, formats.ARROW_STREAM])
+@pytest.mark.asyncio
+async def test_search_all_table_timed_out(media_type, mock_client, monkeypatch):
+    read = READERS[media_type]
+    original = Deadline.remaining
+    monkeypatch.setattr(
+        Deadline,
+        "remaining",
+        lambda self, item: 0 if item.name == "milliquas" else original(self, item),
+    )
+    request_dict = {"ra_deg": 5, "dec_deg": 5, "catalogs": CATALOGS}
+    response = await mock_client.post(
+        "/cone_search/all", json=request_dict, headers={"Accept": media_type}
+    )
+    response.raise_for_status()
+    assert response.headers["X-Timed-Out-Catalogs"] == "1"
+    if media_type == formats.VOTABLE:
+        timed_out = [
+            i
+            for i, table in enumerate(parse(io.BytesIO(response.content)).iter_tables())
+            if any(info.name == "timed_out" for info in table.infos)
+        ]
+    else:
+        pa = pytest.importorskip("pyarrow")
+        schema = pa.ipc.open_stream(response.content).schema
+        timed_out = orjson.loads(schema.metadata[b"timed_out"])
+    assert timed_out == [1]
+    (_, columns) = read(response.content)[1]
+    assert len(columns["dist_arcsec"]) == 0
+
+
+@pytest.mark.parametrize(
+    "accept,expected",
+    [
+        (None, None),
+        ("application/json", None),
+        ("application/x-votable+xml", formats.VOTABLE),
+        (
+            "application/json;q=0.5, application/vnd.apache.arrow.stream",
+            formats.ARROW_STREAM,
+        ),
+    ],
+)
+def test_requested_media_type(accept, expected):
+    assert formats.requested_media_type(accept) == expected
@@ -0,0 +1,113 @@
+import numpy as np
+import pytest
+
+from app import metrics
+from app.catshtm import TrixelCache
+from app.result_cache import MemoryCache
+
+
+def test_histogram_render():
+    histogram = metrics.Histogram("test_seconds", "A test", ["name"], buckets=[1, 2])
+    metrics.all_metrics.remove(histogram)
+    histogram.observe(0.5, name='a"b')
+    histogram.observe(1.5, name='a"b')
+    histogram.observe(3, name='a"b')
+    assert histogram.count(name='a"b') == 3
+    assert histogram.render().splitlines() == [
+        "# HELP test_seconds A test",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{name="a\\"b",le="1.0"} 1.0',
+        'test_seconds_bucket{name="a\\"b",le="2.0"} 2.0',
+        'test_seconds_bucket{name="a\\"b",le="+Inf"} 3.0',
+        'test_seconds_sum{name="a\\"b"} 5.0',
+        'test_seconds_count{name="a\\"b"} 3.0',
+    ]
+
+
+def test_stage_outside_search():
+    before = metrics.stage_seconds.count(backend="", catalog="", stage="test")
+    with metrics.stage("test"):
+        pass
+    assert metrics.stage_seconds.count(backend="", catalog="", stage="test") == before + 1
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint(mock_client):
+    labels = {"backend": "catsHTM", "catalog": "ROSATfsc"}
+    searches = metrics.search_seconds.count(**labels, method="search_all_item")
+    results = metrics.search_results.get(**labels, method="search_all_item")
+    reads = metrics.stage_seconds.count(**labels, stage="hdf5_read")
+    queries = metrics.stage_seconds.count(
+        backend="extcats", catalog="milliquas", stage="mongo_query"
+    )
+    request_dict = {
+        "ra_deg": 5,
+        "dec_deg": 5,
+        "catalogs": [
+            {"use": "catsHTM", "name": "ROSATfsc", "rs_arcsec": 3600},
+            {"use": "extcats", "name": "milliquas", "rs_arcsec": 60},
+        ],
+    }
+    response = await mock_client.post("/cone_search/all", json=request_dict)
+    response.raise_for_status()
+    num_results = len(response.json()[0])
+    assert metrics.search_seconds.count(**labels, method="search_all_item") == searches + 1
+    assert (
+        metrics.search_results.get(**labels, method="search_all_item")
+        == results + num_results
+    )
+    assert metrics.stage_seconds.count(**labels, stage="hdf5_read") == reads + 1
+    assert (
+        metrics.stage_seconds.count(
+            backend="extcats", catalog="milliquas", stage="mongo_query"
+        )
+        == queries + 1
+    )
+
+    response = await mock_client.get("/metrics")
+    response.raise_for_status()
+    assert response.headers["content-type"].startswith("text/plain")
+    lines = response.text.splitlines()
+    assert "# TYPE catalogserver_stage_seconds histogram" in lines
+    assert (
+        'catalogserver_search_results_total{backend="catsHTM",catalog="ROSATfsc",'
+        f'method="search_all_item"}} {float(results + num_results)}'
+    ) in lines
+
+
+def test_counter_label_named_amount():
+    counter = metrics.Counter("test_total", "A test", ["amount"])
+    metrics.all_metrics.remove(counter)
+    counter.inc(2, amount="x")
+    counter.inc(amount="x")
+    assert counter.get(amount="x") == 3
+
+
+def test_cache_metrics(monkeypatch):
+    cache = TrixelCache(3 * 8 * 10)
+    monkeypatch.setattr("app.catshtm.trixel_cache", cache)
+    monkeypatch.setattr("app.result_cache.result_cache", None)
+    for i in range(4):
+        cache.put(i, np.zeros(10))
+    cache.get(1)
+    cache.get(0)
+    lines = metrics.render().splitlines()
+    assert "# TYPE catalogserver_cache_hits_total counter" in lines
+    assert 'catalogserver_cache_hits_total{cache="trixel"} 1.0' in lines
+    assert 'catalogserver_cache_misses_total{cache="trixel"} 1.0' in lines
+    assert 'catalogserver_cache_evictions_total{cache="trixel"} 1.0' in lines
+    assert 'catalogserver_cache_entries{cache="trixel"} 3.0' in lines
+    assert 'catalogserver_cache_bytes{cache="trixel"} 240.0' in lines
+    # disabled caches are not reported
+    assert not any('cache="result"' in line for line in lines)
+
+    result_cache = MemoryCache(ttl=10, max_entries=1)
+    monkeypatch.setattr("app.result_cache.result_cache", result_cache)
+    result_cache.put("a", 1)
+    result_cache.put("b", 2)
+    result_cache.get("b")
+    lines = metrics.render().splitlines()
+    assert 'catalogserver_cache_hits_total{cache="result"} 1.0' in lines
+    assert 'catalogserver_cache_evictions_total{cache="result"} 1.0' in lines
+    assert 'catalogserver_cache_entries{cache="result"} 1.0' in lines
+    assert 'catalogserver_cache_bytes{cache="result"} 1.0' in lines
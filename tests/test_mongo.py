@@ -0,0 +1,128 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from astropy.coordinates import SkyCoord
+from pymongo import MongoClient
+from pymongo.read_preferences import ReadPreference
+
+from app import metrics
+from app.mongo import PoolMetrics, client_options, find_within_batch, get_catq
+from app.settings import Settings
+
+
+@pytest.fixture
+def milliquas(mock_extcats):
+    return get_catq("milliquas")
+
+
+@pytest.mark.parametrize("rs_arcsec", [1, 60, 600, 3600])
+def test_find_within_batch(rs_arcsec, milliquas):
+    """
+    Bulk queries find the same sources as a brute-force search
+    """
+    catq = milliquas
+    rng = np.random.default_rng(42)
+    ra = np.concatenate([rng.uniform(0, 360, 50), [265.9083611, 265.9083611]])
+    dec = np.concatenate([rng.uniform(-89.9, -89.3, 50), [-89.5872778, -89.5872778]])
+
+    docs, pos, doc_idx, dists = find_within_batch(
+        catq, ra, dec, rs_arcsec, projection={"_id": 0}
+    )
+    assert (np.diff(pos) >= 0).all()
+
+    srcs = list(catq.src_coll.find({}, {"_id": 0}))
+    seps = (
+        SkyCoord(ra[:, None], dec[:, None], unit="deg")
+        .separation(
+            SkyCoord(
+                [s[catq.ra_key] for s in srcs],
+                [s[catq.dec_key] for s in srcs],
+                unit="deg",
+            )[None, :]
+        )
+        .arcsecond
+    )
+    expected_pos, expected_src = np.nonzero(seps <= rs_arcsec)
+    assert len(expected_pos) > 0
+    assert [(p, docs[d]) for p, d in zip(pos, doc_idx)] == [
+        (p, srcs[s]) for p, s in zip(expected_pos, expected_src)
+    ]
+    np.testing.assert_allclose(dists, seps[expected_pos, expected_src], rtol=1e-9)
+
+
+def test_find_within_batch_projection(milliquas):
+    docs, pos, doc_idx, dists = find_within_batch(
+        milliquas,
+        np.array([265.9]),
+        np.array([-89.59]),
+        60,
+        projection={"ra": 1, "dec": 1},
+    )
+    assert len(pos) == 1
+    assert set(docs[doc_idx[0]].keys()) <= {"_id", "ra", "dec", milliquas.hp_key}
+
+
+def test_find_within_batch_without_healpix(mock_extcats):
+    # TNS has a 2dsphere index only
+    catq = get_catq("TNS")
+    assert (
+        find_within_batch(catq, np.array([0.0]), np.array([0.0]), 60, projection={})
+        is None
+    )
+
+
+def test_client_options(monkeypatch):
+    monkeypatch.setattr(
+        "app.mongo.settings",
+        Settings(
+            mongo_max_pool_size=7,
+            mongo_wait_queue_timeout_ms=250,
+            mongo_max_time_ms=1000,
+        ),
+    )
+    client = MongoClient("mongodb://localhost:27018", connect=False, **client_options())
+    try:
+        assert client.options.pool_options.max_pool_size == 7
+        assert client.options.pool_options.wait_queue_timeout == 0.25
+        assert client.options.timeout == 1
+        assert client.read_preference == ReadPreference.SECONDARY_PREFERRED
+    finally:
+        client.close()
+
+
+def test_pool_metrics(monkeypatch):
+    monkeypatch.setattr(metrics, "all_metrics", [])
+    for name in (
+        "mongo_checkouts",
+        "mongo_checkout_failures",
+        "mongo_checkout_seconds",
+        "mongo_connections",
+        "mongo_connections_in_use",
+    ):
+        metric = getattr(metrics, name)
+        monkeypatch.setattr(
+            metrics,
+            name,
+            type(metric)(metric.name, metric.documentation, metric.labelnames),
+        )
+    listener = PoolMetrics()
+    address = ("mongo", 27017)
+    labels = {"address": "mongo:27017"}
+
+    listener.connection_created(SimpleNamespace(address=address))
+    for _ in range(2):
+        listener.connection_check_out_started(SimpleNamespace(address=address))
+        listener.connection_checked_out(SimpleNamespace(address=address))
+    listener.connection_checked_in(SimpleNamespace(address=address))
+    listener.connection_check_out_started(SimpleNamespace(address=address))
+    listener.connection_check_out_failed(
+        SimpleNamespace(address=address, reason="timeout", duration=0.5)
+    )
+
+    assert metrics.mongo_connections.get(**labels) == 1
+    assert metrics.mongo_checkouts.get(**labels) == 2
+    assert metrics.mongo_connections_in_use.get(**labels) == 1
+    assert metrics.mongo_checkout_failures.get(**labels, reason="timeout") == 1
+    assert metrics.mongo_checkout_seconds.count(**labels) == 3
+    assert "# TYPE catalogserver_mongo_connections gauge" in metrics.render()
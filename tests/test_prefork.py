@@ -0,0 +1,67 @@
+import gc
+
+import pytest
+
+import app.mongo
+from app import prefork
+from app.catalogs import catalog_descriptions
+from app.catshtm import get_catshtm
+from app.main import load_catalogs
+from app.metrics import stage_seconds
+from app.mongo import get_catq
+from app.registry import registry
+from app.result_cache import SQLiteCache
+
+
+@pytest.fixture
+def preloaded(mock_extcats, mock_catshtm):
+    get_catshtm.cache_clear()
+    try:
+        prefork.preload()
+        yield
+    finally:
+        gc.unfreeze()
+
+
+def test_preload(preloaded):
+    assert set(registry.catshtm) == {"ROSATfsc"}
+    assert {"milliquas", "TNS"}.issubset(registry.extcats)
+    assert {d["name"] for d in catalog_descriptions.descriptions} >= {
+        "ROSATfsc",
+        "milliquas",
+    }
+    # catsHTM indexes are kept for the workers
+    assert get_catshtm.cache_info().currsize == 1
+    # Mongo connections are not
+    assert app.mongo.mongo_db is None
+    assert get_catq.cache_info().currsize == 0
+    # nor are metrics recorded while warming up
+    assert "_bucket" not in stage_seconds.render()
+
+
+@pytest.mark.asyncio
+async def test_startup_after_preload(preloaded, mock_mongoclient, monkeypatch):
+    def rebuild():
+        raise AssertionError("descriptions rebuilt in worker")
+
+    descriptions = catalog_descriptions.descriptions
+    monkeypatch.setattr(catalog_descriptions, "refresh", rebuild)
+    monkeypatch.setattr("app.main.install_refresh_handlers", lambda refresh: None)
+    # the worker connects anew
+    monkeypatch.setattr(
+        "app.mongo.MongoClient", lambda uri, **options: mock_mongoclient
+    )
+    prefork.after_fork()
+    await load_catalogs()
+    assert catalog_descriptions.descriptions is descriptions
+    assert app.mongo.mongo_db is mock_mongoclient
+    assert registry.extcats["milliquas"].dbclient is mock_mongoclient
+    assert get_catshtm.cache_info().currsize == 1
+
+
+def test_after_fork_reconnects_result_cache(tmp_path, monkeypatch):
+    cache = SQLiteCache(tmp_path / "cache.db", ttl=10, max_entries=10)
+    monkeypatch.setattr("app.result_cache.result_cache", cache)
+    inherited = cache._connection()
+    prefork.after_fork()
+    assert cache._connection() is not inherited
@@ -0,0 +1,107 @@
+import math
+import os
+import shutil
+from pathlib import Path
+
+import h5py
+import pytest
+
+from app.catshtm import TrixelCache, get_catshtm
+from app.registry import find_catshtm_catalogs, registry
+from app.settings import Settings
+
+CATSHTM_DIR = Path(__file__).parent / "test-data" / "catsHTM2"
+
+
+def test_find_catshtm_catalogs():
+    catalogs = find_catshtm_catalogs(CATSHTM_DIR)
+    assert list(catalogs.keys()) == ["ROSATfsc"]
+    assert catalogs["ROSATfsc"].exists()
+    assert find_catshtm_catalogs(None) == {}
+
+
+def test_refresh(mock_extcats, mock_catshtm):
+    registry.refresh()
+    assert set(registry.extcats.keys()) == {"TNS", "milliquas"}
+    assert registry.has_catshtm("ROSATfsc")
+    assert not registry.has_catshtm("TNS")
+    assert not registry.has_extcats("ROSATfsc")
+
+
+def test_refresh_picks_up_new_catalogs(monkeypatch, tmp_path, mock_extcats):
+    settings = Settings(catshtm_dir=tmp_path)
+    monkeypatch.setattr("app.registry.settings", settings)
+    registry.refresh()
+    assert not registry.has_catshtm("ROSATfsc")
+    shutil.copytree(CATSHTM_DIR / "ROSATfsc", tmp_path / "ROSATfsc")
+    # still cached
+    assert not registry.has_catshtm("ROSATfsc")
+    registry.refresh()
+    assert registry.has_catshtm("ROSATfsc")
+
+
+def test_refresh_serves_replaced_catalogs(monkeypatch, tmp_path, mock_extcats):
+    monkeypatch.setattr("app.registry.settings", Settings(catshtm_dir=tmp_path))
+    cache = TrixelCache(2 ** 20)
+    monkeypatch.setattr("app.catshtm.trixel_cache", cache)
+    monkeypatch.setattr("app.registry.trixel_cache", cache)
+    shutil.copytree(CATSHTM_DIR / "ROSATfsc", tmp_path / "ROSATfsc")
+    registry.refresh()
+    args = (math.radians(5), math.radians(5), math.radians(1))
+    (before,) = get_catshtm("ROSATfsc", tmp_path).cone_search(*args)
+    assert len(before) > 0
+    assert len(cache) > 0
+
+    # replace the catalog with one whose count rates differ
+    catalog_dir = tmp_path / "ROSATfsc"
+    with h5py.File(catalog_dir / "ROSATfsc_htm_000600.hdf5", "r+") as f:
+        for name, dataset in f.items():
+            if not name.endswith("_Ind"):
+                dataset[3] = dataset[3] + 1
+    index = catalog_dir / "ROSATfsc_htm.hdf5"
+    os.utime(index, ns=(index.stat().st_atime_ns, index.stat().st_mtime_ns + 1))
+    registry.refresh()
+    # tiles of the old catalog are dropped
+    assert len(cache) == 0
+    (after,) = get_catshtm("ROSATfsc", tmp_path).cone_search(*args)
+    assert (after[:, 3] == before[:, 3] + 1).all()
+    assert (after[:, :3] == before[:, :3]).all()
+
+
+def test_refresh_keeps_catalogs_on_error(monkeypatch, mock_extcats, mock_catshtm):
+    registry.refresh()
+
+    def fail():
+        raise ConnectionError
+
+    monkeypatch.setattr("app.registry.get_mongo", fail)
+    registry.refresh()
+    assert registry.has_extcats("milliquas")
+
+
+@pytest.mark.asyncio
+async def test_validation_does_not_query_mongo(monkeypatch, mock_client):
+    request_dict = {
+        "ra_deg": 5,
+        "dec_deg": 5,
+        "catalogs": [{"use": "extcats", "name": "nonesuch", "rs_arcsec": 1}],
+    }
+    registry.refresh()
+    monkeypatch.setattr(
+        "app.registry.get_mongo", lambda: pytest.fail("registry was rescanned")
+    )
+    response = await mock_client.post("/cone_search/any", json=request_dict)
+    assert response.status_code == 422
+
+
+def test_lookups_do_not_scan(monkeypatch):
+    # before the first refresh, nothing is known, and nothing is scanned
+    monkeypatch.setattr(
+        "app.registry.find_catshtm_catalogs",
+        lambda catalogs_dir: pytest.fail("catalogs scanned on lookup"),
+    )
+    monkeypatch.setattr(
+        "app.registry.get_mongo", lambda: pytest.fail("Mongo queried on lookup")
+    )
+    assert not registry.has_catshtm("ROSATfsc")
+    assert not registry.has_extcats("milliquas")
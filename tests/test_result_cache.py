@@ -0,0 +1,167 @@
+import sqlite3
+
+import orjson
+import pytest
+from astropy.coordinates import SkyCoord
+
+from app import metrics
+from app import result_cache as rc
+from app.models import CatsHTMQueryItem, ExtcatsQueryItem
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("app.result_cache.time.time", lambda: now[0])
+    return now
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_expiry(backend, clock, tmp_path):
+    if backend == "memory":
+        cache = rc.MemoryCache(ttl=10, max_entries=10)
+    else:
+        cache = rc.SQLiteCache(tmp_path / "cache.db", ttl=10, max_entries=10)
+    assert cache.get(b"a") is rc.MISSING
+    cache.put(b"a", None)
+    cache.put(b"b", [{"body": {"x": 1}, "dist_arcsec": 0.5}])
+    assert cache.get(b"a") is None
+    assert cache.get(b"b") == [{"body": {"x": 1}, "dist_arcsec": 0.5}]
+    clock[0] += 11
+    assert cache.get(b"a") is rc.MISSING
+    assert cache.stats()["hits"] == 2
+    assert cache.stats()["misses"] == 2
+
+
+def test_memory_eviction():
+    cache = rc.MemoryCache(ttl=10, max_entries=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is rc.MISSING
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert cache.evictions == 1
+
+
+def test_memory_eviction_by_size():
+    value = [{"body": {"x": "y" * 80}, "dist_arcsec": 0.5}]
+    size = len(orjson.dumps(value))
+    cache = rc.MemoryCache(ttl=10, max_entries=10, max_bytes=3 * size)
+    for key in "abcd":
+        cache.put(key, value)
+    assert cache.evictions == 1
+    assert cache.nbytes == 3 * size
+    assert cache.get("a") is rc.MISSING
+    assert cache.get("b") == value
+    # replacing an entry does not count it twice
+    cache.put("b", value)
+    assert cache.nbytes == 3 * size
+    # results larger than the budget are not cached
+    cache.put("e", value * 4)
+    assert cache.get("e") is rc.MISSING
+    assert len(cache) == 3
+
+
+def test_sqlite_shared(clock, tmp_path):
+    """
+    Caches backed by the same database see each other's entries, and are
+    trimmed to size
+    """
+    first = rc.SQLiteCache(tmp_path / "cache.db", ttl=10, max_entries=2)
+    second = rc.SQLiteCache(tmp_path / "cache.db", ttl=10, max_entries=2)
+    first.put(b"a", True)
+    assert second.get(b"a") is True
+    clock[0] += 1
+    second.put(b"b", False)
+    clock[0] += 1
+    second.put(b"c", True)
+    clock[0] += 1
+    assert first.get(b"a") is True
+    first.trim()
+    assert len(first) == 2
+    assert second.get(b"b") is rc.MISSING
+
+
+@pytest.fixture
+def versioned(monkeypatch):
+    version = ["1"]
+    monkeypatch.setattr("app.result_cache.catalog_version", lambda item: version[0])
+    return version
+
+
+def test_cache_key(versioned, monkeypatch):
+    monkeypatch.setattr("app.result_cache.settings.result_cache_quantum_arcsec", 0.1)
+    item = CatsHTMQueryItem.construct(
+        name="foo", rs_arcsec=1, keys_to_append=["a", "b"], use="catsHTM"
+    )
+    coord = SkyCoord(10, 20, unit="deg")
+    key = rc.cache_key("nearest", item, coord)
+    # nearby positions share entries
+    assert rc.cache_key("nearest", item, SkyCoord(10, 20 + 0.01 / 3600, unit="deg")) == key
+    assert rc.cache_key("nearest", item, SkyCoord(10, 20 + 1 / 3600, unit="deg")) != key
+    # as do projections in a different order
+    assert (
+        rc.cache_key("nearest", item.copy(update={"keys_to_append": ["b", "a"]}), coord)
+        == key
+    )
+    for other in (
+        item.copy(update={"rs_arcsec": 2}),
+        item.copy(update={"keys_to_append": None}),
+        item.copy(update={"name": "bar"}),
+        ExtcatsQueryItem.construct(
+            name="foo", rs_arcsec=1, keys_to_append=["a", "b"], use="extcats"
+        ),
+    ):
+        assert rc.cache_key("nearest", other, coord) != key
+    assert rc.cache_key("all", item, coord) != key
+    extcats_item = ExtcatsQueryItem.construct(
+        name="foo", rs_arcsec=1, keys_to_append=None, use="extcats"
+    )
+    assert rc.cache_key(
+        "all", extcats_item.copy(update={"pre_filter": {"a": 1}}), coord
+    ) != rc.cache_key("all", extcats_item.copy(update={"pre_filter": {"a": 2}}), coord)
+    versioned[0] = "2"
+    assert rc.cache_key("nearest", item, coord) != key
+
+
+@pytest.mark.parametrize(
+    "catalog",
+    [
+        {"use": "catsHTM", "name": "ROSATfsc", "rs_arcsec": 3600},
+        {"use": "extcats", "name": "milliquas", "rs_arcsec": 60},
+    ],
+)
+@pytest.mark.parametrize("method", ["any", "nearest", "all"])
+@pytest.mark.asyncio
+async def test_cached_search(method, catalog, mock_client, result_cache):
+    request = {"ra_deg": 265, "dec_deg": -89.58, "catalogs": [catalog]}
+    if catalog["use"] == "catsHTM":
+        request.update(ra_deg=5, dec_deg=5)
+    response = await mock_client.post(f"/cone_search/{method}", json=request)
+    response.raise_for_status()
+    assert result_cache.stats()["hits"] == 0
+    assert len(result_cache) == 1
+    cached = await mock_client.post(f"/cone_search/{method}", json=request)
+    cached.raise_for_status()
+    assert result_cache.stats()["hits"] == 1
+    assert cached.json() == response.json()
+
+
+@pytest.mark.parametrize("operation", ["get", "put"])
+def test_cached_search_fails_open(operation, versioned, tmp_path, monkeypatch):
+    cache = rc.SQLiteCache(tmp_path / "cache.db", ttl=10, max_entries=10)
+    monkeypatch.setattr("app.result_cache.result_cache", cache)
+
+    def locked(*args):
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(cache, operation, locked)
+    item = CatsHTMQueryItem.construct(
+        name="foo", rs_arcsec=1, keys_to_append=None, use="catsHTM"
+    )
+    labels = {"cache": "result", "operation": "read" if operation == "get" else "write"}
+    before = metrics.cache_errors.get(**labels)
+    search = lambda item, coord: [1]
+    assert rc.cached_search(search, "all", item, SkyCoord(0, 0, unit="deg")) == [1]
+    assert metrics.cache_errors.get(**labels) == before + 1
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+from astropy.coordinates import SkyCoord
+
+from app import spherical
+
+
+@pytest.fixture
+def points():
+    rng = np.random.default_rng(42)
+    lon = rng.uniform(0, 2 * np.pi, 1000)
+    lat = np.arcsin(rng.uniform(-1, 1, 1000))
+    return lon, lat
+
+
+@pytest.mark.parametrize("lon0,lat0", [(0, 0), (1, 1.5), (4.6, -1.57), (3.14, 0.1)])
+def test_separation(lon0, lat0, points):
+    lon, lat = points
+    expected = (
+        SkyCoord(lon0, lat0, unit="rad")
+        .separation(SkyCoord(lon, lat, unit="rad"))
+        .arcsecond
+    )
+    dist = spherical.to_arcsec(spherical.separation(lon0, lat0, lon, lat))
+    np.testing.assert_allclose(dist, expected, rtol=1e-12, atol=1e-9)
+
+
+def test_separation_small():
+    # 1 milliarcsecond apart, where the haversine and cosine formulas lose
+    # precision
+    lat = np.radians(1e-3 / 3600)
+    assert spherical.to_arcsec(spherical.separation(1, 0, 1, lat)) == pytest.approx(
+        1e-3, rel=1e-9
+    )
+
+
+def test_nearest(points):
+    lon, lat = points
+    idx, dist = spherical.nearest(lon, lat, 1, 0.5)
+    seps = spherical.separation(1, 0.5, lon, lat)
+    assert dist == seps.min()
+    assert idx == np.argmin(seps)
+    assert spherical.nearest(lon[:0], lat[:0], 1, 0.5) == (None, None)
+
+
+def test_within(points):
+    lon, lat = points
+    radius = 0.3
+    idx, dist = spherical.within(lon, lat, 1, 0.5, radius)
+    seps = spherical.separation(1, 0.5, lon, lat)
+    assert len(idx)
+    assert (idx == np.flatnonzero(seps <= radius)).all()
+    assert (dist == seps[idx]).all()
+
+
+def test_within_per_point(points):
+    lon, lat = points
+    lon0, lat0 = np.full(len(lon), 1.0), np.where(np.arange(len(lon)) % 2, 0.5, -0.5)
+    idx, dist = spherical.within(lon, lat, lon0, lat0, 0.3)
+    seps = spherical.separation(lon0, lat0, lon, lat)
+    assert len(idx)
+    assert (idx == np.flatnonzero(seps <= 0.3)).all()
+    assert (dist == seps[idx]).all()
@@ -0,0 +1,33 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+from app.catshtm import get_catshtm
+from app.mongo import get_catq
+from app.warmup import warm_up
+
+
+def test_import_is_lazy():
+    """
+    Importing the app neither connects to Mongo nor loads catalog backends
+    """
+    deferred = ["extcats", "healpy", "catsHTM", "h5py", "scipy.io", "pyarrow"]
+    code = (
+        "import json, sys, app.main, app.mongo; "
+        f"print(json.dumps([app.mongo.mongo_db is None, [m for m in {deferred!r} if m in sys.modules]]))"
+    )
+    output = subprocess.check_output(
+        [sys.executable, "-c", code], cwd=Path(__file__).parent.parent
+    )
+    assert json.loads(output.splitlines()[-1]) == [True, []]
+
+
+def test_warm_up(mock_extcats, mock_catshtm, caplog):
+    get_catshtm.cache_clear()
+    warm_up()
+    # mongomock does not support the geoJSON queries needed for TNS
+    errors = [r.getMessage() for r in caplog.records if r.levelname == "ERROR"]
+    assert errors == ["Failed to warm up extcats catalog TNS"]
+    assert get_catshtm.cache_info().currsize == 1
+    assert get_catq.cache_info().currsize >= 2